@@ -0,0 +1,340 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from models import db, QuizAttempt, Topic, Subtopic, Quiz, SubtopicQuiz
+from jobs import jobs
+
+# Question ids of the two quiz tables share one key space: id * 2 + type
+QUIZ_TYPES = {'topic': 0, 'subtopic': 1}
+QUESTION_TABLES = {0: Quiz, 1: SubtopicQuiz}
+
+
+def group_sums(keys, *values):
+    """Distinct rows of keys and the per-row sum of every value array"""
+    unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    return unique, [np.bincount(inverse, weights=value, minlength=len(unique)) for value in values]
+
+
+def ratio(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, numerator / denominator, 0.0)
+
+
+def correlation(n, sx, sy, sxx, syy, sxy):
+    """Pearson correlation from grouped sums, 0 where it is undefined"""
+    variance = (n * sxx - sx ** 2) * (n * syy - sy ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (n * sxy - sx * sy) / np.sqrt(variance)
+    return np.where(variance > 0, r, 0.0)
+
+
+def slope(n, sx, sy, sxx, sxy):
+    """Least-squares slope of y over x from grouped sums"""
+    return ratio(n * sxy - sx * sy, n * sxx - sx ** 2)
+
+
+def load_attempts(since, after_id=0):
+    """Attempt columns and one row per answered question, as numpy arrays, of
+    the attempts since a date with an id above after_id"""
+    rows = (
+        db.session.query(
+            QuizAttempt.id, QuizAttempt.user_id, QuizAttempt.quiz_type, QuizAttempt.topic_id,
+            QuizAttempt.subtopic_id, QuizAttempt.correct_questions, QuizAttempt.total_questions,
+            QuizAttempt.answers, QuizAttempt.created_at
+        )
+        .filter(QuizAttempt.created_at >= since, QuizAttempt.id > after_id)
+        .order_by(QuizAttempt.id)
+        .all()
+    )
+
+    attempts = {
+        'id': np.array([row.id for row in rows], dtype=np.int64),
+        'created': np.array([row.created_at for row in rows], dtype='datetime64[us]'),
+        'user': np.array([row.user_id for row in rows], dtype=np.int64),
+        'type': np.array([QUIZ_TYPES[row.quiz_type] for row in rows], dtype=np.int64),
+        'topic': np.array([row.topic_id for row in rows], dtype=np.int64),
+        'subtopic': np.array([row.subtopic_id or -1 for row in rows], dtype=np.int64),
+        'correct': np.array([row.correct_questions for row in rows], dtype=np.float64),
+        'total': np.array([row.total_questions for row in rows], dtype=np.float64)
+    }
+
+    attempt_index, items, answers_correct = [], [], []
+    for i, row in enumerate(rows):
+        quiz_type = QUIZ_TYPES[row.quiz_type]
+        for result in json.loads(row.answers):
+            attempt_index.append(i)
+            items.append(result['question_id'] * 2 + quiz_type)
+            answers_correct.append(result['is_correct'])
+    responses = {
+        'attempt': np.array(attempt_index, dtype=np.int64),
+        'item': np.array(items, dtype=np.int64),
+        'correct': np.array(answers_correct, dtype=np.float64)
+    }
+    return attempts, responses
+
+
+def merge_attempts(old, new, since):
+    """Attempts of old followed by those of new, without the ones created before since"""
+    (attempts, responses), (new_attempts, new_responses) = old, new
+    new_responses = dict(new_responses, attempt=new_responses['attempt'] + len(attempts['id']))
+    attempts = {name: np.concatenate([attempts[name], new_attempts[name]]) for name in attempts}
+    responses = {name: np.concatenate([responses[name], new_responses[name]]) for name in responses}
+
+    keep = attempts['created'] >= np.datetime64(since, 'us')
+    if keep.all():
+        return attempts, responses
+    # Answers follow their attempt to its new position
+    position = np.cumsum(keep) - 1
+    kept_responses = keep[responses['attempt']]
+    responses = {name: values[kept_responses] for name, values in responses.items()}
+    responses['attempt'] = position[responses['attempt']]
+    return {name: values[keep] for name, values in attempts.items()}, responses
+
+
+def compute_snapshot(attempts, responses):
+    """Every metric over the loaded attempts, computed in one vectorized pass"""
+    snapshot = {'attempts': len(attempts['id']), 'computed_at': datetime.utcnow().isoformat()}
+    if not snapshot['attempts']:
+        return snapshot
+
+    ones = np.ones(len(attempts['id']))
+    score = ratio(attempts['correct'], attempts['total'])
+
+    # Accuracy per student and topic (subtopic quizzes count towards their topic)
+    keys, (correct, total, count) = group_sums(
+        np.column_stack([attempts['user'], attempts['topic']]), attempts['correct'], attempts['total'], ones
+    )
+    snapshot['user_topic'] = {'user': keys[:, 0], 'topic': keys[:, 1], 'correct': correct, 'total': total, 'attempts': count}
+
+    # Accuracy per student and subtopic
+    has_subtopic = attempts['subtopic'] >= 0
+    keys, (correct, total, count) = group_sums(
+        np.column_stack([attempts['user'][has_subtopic], attempts['subtopic'][has_subtopic]]).reshape(-1, 2),
+        attempts['correct'][has_subtopic], attempts['total'][has_subtopic], ones[has_subtopic]
+    )
+    snapshot['user_subtopic'] = {'user': keys[:, 0], 'subtopic': keys[:, 1], 'correct': correct, 'total': total, 'attempts': count}
+
+    # Trend of the score over successive attempts of the same quiz
+    quiz_id = np.where(attempts['type'] == 1, attempts['subtopic'], attempts['topic'])
+    order = np.lexsort((attempts['id'], quiz_id, attempts['type'], attempts['user']))
+    quiz_keys = np.column_stack([attempts['user'], attempts['type'], quiz_id])[order]
+    starts = np.r_[True, np.any(np.diff(quiz_keys, axis=0) != 0, axis=1)]
+    group = np.cumsum(starts) - 1
+    x = np.arange(len(order)) - np.flatnonzero(starts)[group]
+    y = score[order]
+    n, sx, sy, sxx, sxy = (np.bincount(group, weights=w) for w in (np.ones(len(order)), x, y, x * x, x * y))
+    snapshot['trend'] = {
+        'user': quiz_keys[starts, 0],
+        'type': quiz_keys[starts, 1],
+        'quiz': quiz_keys[starts, 2],
+        'attempts': n,
+        'last_score': y[np.r_[starts[1:], True]],
+        'slope': slope(n, sx, sy, sxx, sxy)
+    }
+
+    # Cohort accuracy per topic and number of students who took it
+    topics, (correct, total) = group_sums(attempts['topic'], attempts['correct'], attempts['total'])
+    students = np.bincount(np.searchsorted(topics, snapshot['user_topic']['topic']), minlength=len(topics))
+    snapshot['topic'] = {'topic': topics, 'accuracy': ratio(correct, total), 'students': students}
+
+    # Item analysis: difficulty is the share of correct answers, discrimination
+    # the correlation between answering correctly and the rest of the attempt
+    if len(responses['item']):
+        y = responses['correct']
+        attempt = responses['attempt']
+        rest = ratio(attempts['correct'][attempt] - y, attempts['total'][attempt] - 1)
+        items, (n, sy, sr, srr, syr) = group_sums(responses['item'], np.ones(len(y)), y, rest, rest * rest, y * rest)
+        snapshot['item'] = {
+            'item': items,
+            'responses': n,
+            'difficulty': ratio(sy, n),
+            'discrimination': correlation(n, sy, sr, sy, srr, syr)
+        }
+
+    snapshot['topic_names'] = dict(
+        db.session.query(Topic.id, Topic.topic_name).filter(Topic.id.in_(topics.tolist())).all()
+    )
+    subtopic_ids = np.unique(attempts['subtopic'][has_subtopic]).tolist()
+    snapshot['subtopic_names'] = dict(
+        db.session.query(Subtopic.id, Subtopic.subtopic_name).filter(Subtopic.id.in_(subtopic_ids)).all()
+    ) if subtopic_ids else {}
+    return snapshot
+
+
+class LearningAnalytics:
+    """Mastery, trends and item statistics over recent quiz attempts.
+
+    The attempts of the window are kept as arrays. A refresh reads and parses
+    only the attempts added since the previous one, then recomputes the
+    snapshot in one vectorized pass; reports are cheap slices of it.
+
+    Refreshes run on the job queue, after every quiz submission (invalidate)
+    and once the snapshot is ANALYTICS_CACHE_TTL seconds old, so requests
+    keep serving the current snapshot meanwhile. Only the first report of a
+    process waits for it. The attempts are loaded from scratch every
+    ANALYTICS_REBUILD_INTERVAL seconds and after a course was deleted, which
+    drops deleted attempts.
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 300
+        self.window_days = 90
+        self.min_questions = 5
+        self.rebuild_interval = 3600
+        self._data = None
+        self._last_id = 0
+        self._loaded_at = 0
+        self._rebuild = False
+        self._stale = False
+        self._snapshot = None
+        self._computed_at = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['ANALYTICS_CACHE_TTL']
+        self.window_days = app.config['ANALYTICS_WINDOW_DAYS']
+        self.min_questions = app.config['ANALYTICS_MIN_QUESTIONS']
+        self.rebuild_interval = app.config['ANALYTICS_REBUILD_INTERVAL']
+        app.extensions['analytics'] = self
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.refresh()
+        if self._stale or time.monotonic() - self._computed_at > self.ttl:
+            self.queue_refresh()
+        return snapshot
+
+    def invalidate(self, rebuild=False):
+        """Refresh in the background: after new attempts were committed, or with rebuild after some were deleted"""
+        self._stale = True
+        if rebuild:
+            self._rebuild = True
+        self.queue_refresh()
+
+    def queue_refresh(self):
+        jobs.submit(('analytics',), self.refresh)
+
+    def refresh(self):
+        with self._lock:
+            self._stale = False
+            since = datetime.utcnow() - timedelta(days=self.window_days)
+            # A full load also picks up attempts whose ids were committed out of order
+            if self._data is None or self._rebuild or time.monotonic() - self._loaded_at > self.rebuild_interval:
+                self._rebuild = False
+                self._data = load_attempts(since)
+                self._loaded_at = time.monotonic()
+            else:
+                self._data = merge_attempts(self._data, load_attempts(since, self._last_id), since)
+            ids = self._data[0]['id']
+            if len(ids):
+                self._last_id = max(self._last_id, int(ids[-1]))
+            self._snapshot = compute_snapshot(*self._data)
+            self._computed_at = time.monotonic()
+            return self._snapshot
+
+    def student_report(self, user_id, weak_limit=3):
+        """Topic and subtopic mastery, quiz trends and weakest subtopics of one student"""
+        snapshot = self.snapshot()
+        report = {'topics': [], 'subtopics': [], 'trends': [], 'weak_areas': []}
+        if not snapshot['attempts']:
+            return report
+
+        data = snapshot['user_topic']
+        mine = data['user'] == user_id
+        accuracy = ratio(data['correct'][mine], data['total'][mine])
+        for topic_id, value, questions in zip(data['topic'][mine], accuracy, data['total'][mine]):
+            report['topics'].append({
+                'topic_id': int(topic_id),
+                'name': snapshot['topic_names'].get(int(topic_id)),
+                'accuracy': round(float(value), 3),
+                'questions': int(questions)
+            })
+
+        data = snapshot['user_subtopic']
+        mine = data['user'] == user_id
+        accuracy = ratio(data['correct'][mine], data['total'][mine])
+        for subtopic_id, value, questions in zip(data['subtopic'][mine], accuracy, data['total'][mine]):
+            report['subtopics'].append({
+                'subtopic_id': int(subtopic_id),
+                'name': snapshot['subtopic_names'].get(int(subtopic_id)),
+                'accuracy': round(float(value), 3),
+                'questions': int(questions)
+            })
+
+        # Weak areas: lowest accuracy among subtopics with enough answered questions
+        candidates = [s for s in report['subtopics'] if s['questions'] >= self.min_questions and s['accuracy'] < 1]
+        report['weak_areas'] = sorted(candidates, key=lambda s: s['accuracy'])[:weak_limit]
+
+        data = snapshot['trend']
+        mine = np.flatnonzero(data['user'] == user_id)
+        for i in mine:
+            quiz_type = 'subtopic' if data['type'][i] == 1 else 'topic'
+            names = snapshot['subtopic_names'] if quiz_type == 'subtopic' else snapshot['topic_names']
+            report['trends'].append({
+                'quiz_type': quiz_type,
+                'quiz_id': int(data['quiz'][i]),
+                'name': names.get(int(data['quiz'][i])),
+                'attempts': int(data['attempts'][i]),
+                'last_score': round(float(data['last_score'][i]), 3),
+                'slope': round(float(data['slope'][i]), 3)
+            })
+        return report
+
+    def cohort_report(self, limit=10, min_responses=5):
+        """Topic accuracy across all students and the questions that need review"""
+        snapshot = self.snapshot()
+        report = {'attempts': snapshot['attempts'], 'computed_at': snapshot['computed_at'], 'topics': [], 'hardest_questions': [], 'weak_discrimination': []}
+        if not snapshot['attempts']:
+            return report
+
+        data = snapshot['topic']
+        for topic_id, accuracy, students in zip(data['topic'], data['accuracy'], data['students']):
+            report['topics'].append({
+                'topic_id': int(topic_id),
+                'name': snapshot['topic_names'].get(int(topic_id)),
+                'accuracy': round(float(accuracy), 3),
+                'students': int(students)
+            })
+
+        data = snapshot.get('item')
+        if data is None:
+            return report
+        enough = np.flatnonzero(data['responses'] >= min_responses)
+        hardest = enough[np.argsort(data['difficulty'][enough], kind='stable')][:limit]
+        # Questions that strong and weak students answer alike do not tell them apart
+        weak = enough[np.argsort(data['discrimination'][enough], kind='stable')]
+        weak = weak[data['discrimination'][weak] < 0.2][:limit]
+
+        questions = self._question_texts(data['item'][np.r_[hardest, weak]])
+        for key, indexes in (('hardest_questions', hardest), ('weak_discrimination', weak)):
+            for i in indexes:
+                item = int(data['item'][i])
+                report[key].append({
+                    'quiz_type': 'subtopic' if item % 2 else 'topic',
+                    'question_id': item // 2,
+                    'question': questions.get(item),
+                    'responses': int(data['responses'][i]),
+                    'difficulty': round(float(data['difficulty'][i]), 3),
+                    'discrimination': round(float(data['discrimination'][i]), 3)
+                })
+        return report
+
+    def _question_texts(self, items):
+        texts = {}
+        for quiz_type, model in QUESTION_TABLES.items():
+            ids = [int(item) // 2 for item in items if item % 2 == quiz_type]
+            if ids:
+                for question_id, question in db.session.query(model.id, model.question).filter(model.id.in_(ids)):
+                    texts[question_id * 2 + quiz_type] = question
+        return texts
+
+
+analytics = LearningAnalytics()
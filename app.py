@@ -1,27 +1,56 @@
 from datetime import timedelta
 import json
-from flask import Flask, render_template, url_for, flash, redirect, request, jsonify, session
+from flask import Flask, render_template, url_for, flash, redirect, request, jsonify, Response, stream_with_context, abort
+import click
 from flask_login import login_required, login_user, logout_user, UserMixin, LoginManager, current_user
 from forms import RegistrationForm, LoginForm
-from models import db, bcrypt, User, ChatHistory, CourseInfo, Course, Topic, Subtopic, Quiz, SubtopicQuiz, Note, StudentProgress
+from models import db, bcrypt, User, ChatHistory, CourseInfo, Course, Topic, Subtopic, Quiz, SubtopicQuiz, Note
 from dotenv import load_dotenv
 import requests
 import os
-import google.generativeai as genai
-from gemini import generation_config, model1, model2, model3, model4, model5, model6
-from markdown2 import Markdown
-from markupsafe import Markup
+from llm import gateway
+from context import conversations
+from jobs import jobs
+from singleflight import single_flight
+from quiz_state import quiz_states
+from grading import grade_quiz, parse_answers
+from progress import record_attempt, user_progress, has_attempted
+from analytics import analytics
+from rendering import renderer
+from search import search_index, queue_index_update
+from retrieval import retriever
+from semantic_cache import semantic_cache
+from pregenerate import pregenerate_course
+from deletion import course_subtopic_count, delete_course_tree
+from parsing import ParseError, parse_json
+from queries import dashboard_data, load_course_trees, load_course_tree
+from migrations import run_migrations, pending_migrations, stamp_migrations
+from generation import (
+    stream_text, current_user_id, note_prompt, chat_prompt, record_chat, course_answer,
+    build_explanation, save_note,
+    build_course, build_topic_quiz, build_subtopic_quiz, build_topic_quizzes, build_note
+)
+from markupsafe import Markup, escape
 import random
-from sqlalchemy import and_
+from sqlalchemy import inspect
 
 load_dotenv()
 app = Flask(__name__)
 login_manager = LoginManager()
-genai.configure(api_key=os.environ["GEMINI_API_KEY"])
 
 app.config.from_object('config.Config')
 db.init_app(app)
 bcrypt.init_app(app)
+gateway.init_app(app)
+conversations.init_app(app)
+jobs.init_app(app)
+single_flight.init_app(app)
+quiz_states.init_app(app)
+analytics.init_app(app)
+renderer.init_app(app)
+search_index.init_app(app)
+retriever.init_app(app)
+semantic_cache.init_app(app)
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
@@ -78,39 +107,17 @@ def delete_course(course_id):
         course_info = CourseInfo.query.get(course_id)
         
         if course_info:
-            # Get the associated course record
-            course = Course.query.filter_by(course_info_id=course_id).first()
-            
-            if course:
-                # Delete all associated records in the correct order
-                for topic in course.topics:
-                    # Delete quizzes associated with the topic
-                    Quiz.query.filter_by(topic_id=topic.id).delete()
-                    
-                    # Delete subtopic quizzes
-                    for subtopic in topic.subtopics:
-                        SubtopicQuiz.query.filter_by(subtopic_id=subtopic.id).delete()
-                        
-                        # Delete notes associated with subtopics
-                        Note.query.filter_by(topic_id=topic.id).delete()
-                        
-                        # Delete the subtopic
-                        db.session.delete(subtopic)
-                    
-                    # Delete the topic
-                    db.session.delete(topic)
-                
-                # Delete the course
-                db.session.delete(course)
-            
-            # Delete chat history
-            ChatHistory.query.filter_by(course_id=course_info.id).delete()
-            
-            # Delete the course info
-            db.session.delete(course_info)
-            
-            # Commit all changes
-            db.session.commit()
+            # Large course trees are deleted in the background
+            if course_subtopic_count(course_id) > app.config['COURSE_DELETE_ASYNC_SUBTOPICS']:
+                job = jobs.submit(
+                    ('delete_course', course_id), delete_course_tree, course_id,
+                    success_url=url_for('student_dashboard'),
+                    failure_url=url_for('student_dashboard')
+                )
+                return job_response(job, 'Deleting the course')
+
+            # Delete the course tree, its chat history and the course info with set-based deletes
+            delete_course_tree(course_id)
             flash('Course and all related data deleted successfully.', 'success')
         else:
             flash('Course not found!', 'error')
@@ -125,76 +132,39 @@ def delete_course(course_id):
 @app.route('/list_course/<int:course_id>', methods=['GET', 'POST'])
 @login_required
 def list_course(course_id):
-    # Retrieve AI message for the course
-    ai_messages = ChatHistory.query.filter_by(course_id=course_id, sender="ai").all()
+    course = load_course_tree(course_id)
     
-    if ai_messages:
-        # Use the latest AI message text to generate data
-        latest_ai_message = ai_messages[-1]
-        chat_data = {
-            'sender': latest_ai_message.sender,
-            'text': latest_ai_message.text,
-            'timestamp': latest_ai_message.timestamp.isoformat()
-        }
-        
-        # Generate or fetch the course data and save it if necessary
-        course = table(process_json_data(chat_data['text']), course_id=course_id)
-        
-        # Verify course was saved/retrieved successfully
-        if course:
-            if request.method == 'POST':
-                return redirect(url_for('list_course', course_id=course_id))
-            return render_template('list_course.html', course=course)
-        else:
-            flash('Failed to save or retrieve course data', 'error')
-            return redirect(url_for('student_dashboard'))
-    else:
+    if course:
+        if request.method == 'POST':
+            return redirect(url_for('list_course', course_id=course_id))
+        return render_template('list_course.html', course=course)
+
+    # Retrieve AI message for the course
+    if not ChatHistory.query.filter_by(course_id=course_id, sender="ai").first():
         flash('No AI messages found for this course', 'error')
         return redirect(url_for('student_dashboard'))
 
-def table(raw_data, course_id):
-    # Check if the course already exists based on `course_id`
-    existing_course = Course.query.filter(Course.course_info.has(CourseInfo.id == course_id)).first()
-    if not existing_course:
-        # Generate and process the raw data
-        data = generate_text(raw_data, model=model2)
-        data = process_json_data(data)
-        
-        # Create a new Course object
-        course = Course(course_name=data['course_name'], course_code=data['course_code'], course_info_id=course_id)
-        
-        # Add topics and subtopics
-        for topic_data in data['topics']:
-            topic = Topic(topic_name=topic_data['name'])
-            for subtopic_name in topic_data['subtopics']:
-                subtopic = Subtopic(subtopic_name=subtopic_name)
-                topic.subtopics.append(subtopic)
-            
-            course.topics.append(topic)
-        
-        try:
-            db.session.add(course)
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            print(f"Error saving data: {e}")
-            return None
-
-    # Return the course data, whether it was newly created or already existing
-    return existing_course or course
+    # Generate the syllabus in the background and come back once it is saved
+    job = jobs.submit(
+        ('course', course_id), build_course, course_id,
+        success_url=url_for('list_course', course_id=course_id),
+        failure_url=url_for('student_dashboard')
+    )
+    return job_response(job, 'Generating the course syllabus')
 
 @app.route('/dashboard/student', methods=['GET', 'POST'])
 @login_required
 def student_dashboard():
     if request.method == 'POST':
         prompt = request.form.get('user_question')
-        response_text = generate_text(prompt, model=model1)
+        response_text = course_answer(prompt)
         if response_text:
-            # If json data is returns empty
-            if process_json_data(response_text) == {}:
+            # Irrelevant questions get an empty JSON object, which fails the schema
+            try:
+                ai_json_response = parse_json(response_text, 'course')
+            except ParseError:
                 invalid_ans = True
             else:
-                ai_json_response = process_json_data(response_text)
                 existing_course = CourseInfo.query.filter_by(course_code=ai_json_response['course_code']).first()
                 if not existing_course:
                     course_info = CourseInfo(
@@ -204,272 +174,308 @@ def student_dashboard():
                     )
                     db.session.add(course_info)                
                     db.session.commit()
+                    queue_index_update()
                     
                     user_message = ChatHistory(
                         sender='user', 
                         course_id=course_info.id, 
+                        user_id=current_user.id,
                         text=prompt)
                     db.session.add(user_message)
                     db.session.commit()
                     chat_history_entry = ChatHistory(
                     course_id=course_info.id,  # Use the newly assigned ID from CourseInfo
+                    user_id=current_user.id,
                     sender='ai',
                     text=response_text
                     )
                     db.session.add(chat_history_entry)
                     db.session.commit()
 
-    courses= CourseInfo.query.all()
-    
-    historyAI = ChatHistory.query.filter_by(sender='ai').order_by(ChatHistory.timestamp).all()
-    historyUser = ChatHistory.query.filter_by(sender='user').order_by(ChatHistory.timestamp).all()
-    student_progress = StudentProgress.query.all()
-           
-    return render_template('student_dashboard.html', historyUser=historyUser, historyAI=historyAI, json_to_table=courses, student_progress=student_progress)
+    dashboard = dashboard_data(
+        current_user.id,
+        page=request.args.get('page', 1, type=int),
+        before_id=request.args.get('before', type=int),
+        history_limit=app.config['DASHBOARD_HISTORY_LIMIT'],
+        courses_per_page=app.config['DASHBOARD_COURSES_PER_PAGE']
+    )
+    dashboard['analytics'] = analytics.student_report(current_user.id)
+
+    return render_template('student_dashboard.html', dashboard=dashboard)
+
+def request_message():
+    """'message' of the JSON object posted to the chatbot, or None when the body is malformed"""
+    data = request.get_json(silent=True)
+    message = data.get('message') if isinstance(data, dict) else None
+    return message if isinstance(message, str) else None
 
 @app.route('/chatbot', methods=['GET', 'POST'])
 def chatbot():
     if request.method == 'POST':
-        data = request.get_json()
-        user_message = data.get('message')
-
-        if user_message == "Show my course":
-            courses = CourseInfo.query.all()
-            course_list = []
-
-            for course in courses:
-                # Add the course name and a URL to redirect to the course page
-                course_list.append({
-                    "course_name": course.course_name,
-                    "course_url": url_for('list_course', course_id=course.id)
-                })
-
-            # Format the response message with courses and links
-            ai_response = {
-                "courses": course_list
-            }
-            
-        elif user_message == "What to do":
-            ai_response = '''EduAI Assistant is your dedicated educational companion, ready to assist you with a variety of tasks related to your coursework.You can ask the bot to show your current courses, guide you on what tasks to prioritize, or provide insights into your academic progress.'''
+        user_message = request_message()
+        if user_message is None:
+            return jsonify({'error': 'Invalid request'}), 400
+
+        ai_response = chatbot_command(user_message)
+        if ai_response is None:
+            # Generate other AI responses, unless a stored note already answers the question
+            prompt, ai_response = chat_prompt(current_user_id(), user_message)
+            if ai_response is None:
+                ai_response = gateway.generate('chat', prompt)
+            record_chat(current_user_id(), user_message, ai_response, prompt)
+            return jsonify({'response': ai_response, 'html': str(renderer.render(ai_response))})
         
-        elif user_message == "Show my progress":
-            student_progress = StudentProgress.query.all()
-            test = {
-                "progress": [
-                    {
-                        "quiz_name": progress.quiz_name,
-                        "quiz_course_name": progress.quiz_course_name,
-                        "total_questions": progress.total_questions,
-                        "correct_questions": progress.correct_questions,
-                        "quiz_counter": progress.quiz_counter
-                    }
-                    for progress in student_progress
-                ]
-            }
+        return jsonify({'response': ai_response})
+    
+    return render_template('chat_ai.html')
+
+@app.route('/chatbot/stream', methods=['POST'])
+def chatbot_stream():
+    user_message = request_message()
+    if user_message is None:
+        return jsonify({'error': 'Invalid request'}), 400
+    user_id = current_user_id()
+
+    ai_response = chatbot_command(user_message)
+    if ai_response is not None:
+        return sse_response([sse_event({'response': ai_response})])
 
-            # Generate HTML dynamically for each quiz entry
-            ai_response = "<div>"
-            for progress in test["progress"]:
-                ai_response += f"""<div>
-                    <div class='progress-entry'>
-                        <p><strong>Quiz Name:</strong> {progress['quiz_name']}</p>
-                        <p><strong>Course Name:</strong> {progress['quiz_course_name']}</p>
-                        <p><strong>Total Questions:</strong> {progress['total_questions']}</p>
-                        <p><strong>Correct Answers:</strong> {progress['correct_questions']}</p>
-                        <p><strong>Attempt Count:</strong> {progress['quiz_counter']}</p>
-                        <hr>
-                    </div>
-                """
-            ai_response += "</div>"
-                
-        elif user_message == "Quiz Assistance":
-            # Retrieve all courses
-            courses = Course.query.all()
-            course_data = []
-
-            # Iterate through each course to gather topics and subtopics with quizzes
-            for course in courses:
-                course_info = {
-                    'course_name': course.course_name,
-                    'topics': []
+    def events():
+        parts = []
+        try:
+            prompt, answer = chat_prompt(user_id, user_message)
+            for chunk in [answer] if answer is not None else gateway.stream('chat', prompt):
+                parts.append(chunk)
+                yield sse_event({'delta': chunk})
+        except Exception as e:
+            print(f"Error in chatbot_stream: {str(e)}")
+            yield sse_event({'error': 'Sorry, I encountered an error. Please try again.'})
+            return
+
+        # Persist the full reply once the stream is complete
+        reply = ''.join(parts)
+        record_chat(user_id, user_message, reply, prompt)
+        yield sse_event({'done': True, 'html': str(renderer.render(reply))})
+
+    return sse_response(events())
+
+# Fixed assistant commands, everything else is sent to the chat model
+CHATBOT_COMMANDS = ("Show my course", "What to do", "Show my progress", "Quiz Assistance")
+# "Search <words>" looks the words up in courses, notes and quizzes
+SEARCH_COMMAND = "Search "
+
+def is_chatbot_command(user_message):
+    return user_message in CHATBOT_COMMANDS or (
+        isinstance(user_message, str) and user_message.startswith(SEARCH_COMMAND)
+    )
+
+def chatbot_command(user_message):
+    """Answer for the fixed assistant commands, None for free-text questions"""
+    if not is_chatbot_command(user_message):
+        return None
+
+    if user_message.startswith(SEARCH_COMMAND):
+        results = search_index.search(user_message[len(SEARCH_COMMAND):], limit=app.config['SEARCH_RESULTS'])
+        if not results:
+            return "No courses, notes or quizzes match your search."
+
+        ai_response = "<ul>"
+        for result in results:
+            ai_response += (
+                f"<li><div class='d-flex justify-content-between align-items-center'>"
+                f"<span><strong>{SEARCH_LABELS[result['kind']]}:</strong> {escape(result['title'])}</span>"
+                f"<a href='{search_result_url(result)}' class='btn btn-primary btn-sm ms-auto m-1' target='_blank'>Open</a></div>"
+                f"<small>{escape(result['snippet'])}</small></li>"
+            )
+        ai_response += "</ul>"
+
+    elif user_message == "Show my course":
+        courses = CourseInfo.query.all()
+        course_list = []
+
+        for course in courses:
+            # Add the course name and a URL to redirect to the course page
+            course_list.append({
+                "course_name": course.course_name,
+                "course_url": url_for('list_course', course_id=course.id)
+            })
+
+        # Format the response message with courses and links
+        ai_response = {
+            "courses": course_list
+        }
+        
+    elif user_message == "What to do":
+        ai_response = '''EduAI Assistant is your dedicated educational companion, ready to assist you with a variety of tasks related to your coursework.You can ask the bot to show your current courses, guide you on what tasks to prioritize, or provide insights into your academic progress. To find a course, note or quiz, type "Search" followed by what you are looking for.'''
+    
+    elif user_message == "Show my progress":
+        student_progress = user_progress(current_user_id())
+        test = {
+            "progress": [
+                {
+                    "quiz_name": progress.quiz_name,
+                    "quiz_course_name": progress.quiz_course_name,
+                    "total_questions": progress.total_questions,
+                    "correct_questions": progress.correct_questions,
+                    "quiz_counter": progress.quiz_counter
                 }
-                
-                for topic in course.topics:
-                    topic_info = {
-                        'topic_name': topic.topic_name,
-                        'subtopics': [],
-                        'topic_quiz_available': False,
-                        'topic_id': topic.id  # Add topic ID for the URL
-                    }
-                    
-                    # Find quizzes directly associated with this topic
-                    topic_quizzes = Quiz.query.filter_by(topic_id=topic.id).all()
-                    if topic_quizzes:
-                        topic_info['topic_quiz_available'] = True
-
-                    # Find subtopics under this topic that have quizzes
-                    subtopics_with_quizzes = (
-                        db.session.query(Subtopic)
-                        .join(SubtopicQuiz, Subtopic.id == SubtopicQuiz.subtopic_id)
-                        .filter(Subtopic.topic_id == topic.id)
-                        .all()
-                    )
+                for progress in student_progress
+            ]
+        }
 
-                    # Add each subtopic with quizzes to the topic's info
-                    for subtopic in subtopics_with_quizzes:
-                        topic_info['subtopics'].append({
+        # Generate HTML dynamically for each quiz entry
+        ai_response = "<div>"
+        for progress in test["progress"]:
+            ai_response += f"""<div>
+                <div class='progress-entry'>
+                    <p><strong>Quiz Name:</strong> {progress['quiz_name']}</p>
+                    <p><strong>Course Name:</strong> {progress['quiz_course_name']}</p>
+                    <p><strong>Total Questions:</strong> {progress['total_questions']}</p>
+                    <p><strong>Correct Answers:</strong> {progress['correct_questions']}</p>
+                    <p><strong>Attempt Count:</strong> {progress['quiz_counter']}</p>
+                    <hr>
+                </div>
+            """
+        ai_response += "</div>"
+
+        # Mastery and weak areas from the learning analytics snapshot
+        report = analytics.student_report(current_user_id())
+        if report['topics']:
+            ai_response += "<div class='progress-entry'><p><strong>Topic Mastery:</strong></p><ul>"
+            for topic in report['topics']:
+                ai_response += f"<li>{topic['name']}: {round(topic['accuracy'] * 100)}%</li>"
+            ai_response += "</ul></div>"
+        if report['weak_areas']:
+            ai_response += "<div class='progress-entry'><p><strong>Focus On:</strong></p><ul>"
+            for subtopic in report['weak_areas']:
+                ai_response += f"<li>{subtopic['name']} ({round(subtopic['accuracy'] * 100)}%)</li>"
+            ai_response += "</ul></div>"
+            
+    elif user_message == "Quiz Assistance":
+        course_data = []
+
+        # Load every course tree with its quiz flags in a fixed number of queries
+        for course in load_course_trees():
+            course_info = {
+                'course_name': course.course_name,
+                'topics': []
+            }
+            
+            for topic in course.topics:
+                topic_info = {
+                    'topic_name': topic.topic_name,
+                    'subtopics': [
+                        {
                             'name': subtopic.subtopic_name,
                             'id': subtopic.id  # Add subtopic ID for the URL
-                        })
-
-                    if topic_info['subtopics'] or topic_info['topic_quiz_available']:
-                        course_info['topics'].append(topic_info)
-
-                if course_info['topics']:
-                    course_data.append(course_info)
-
-            # Format the output in a list view with proper URLs
-            if course_data:
-                ai_response = "<ul>"
-                for course in course_data:
-                    ai_response += f"<li><strong>Course Name:</strong> {course['course_name']}<ul>"
-                    for topic in course['topics']:
-                        # Create topic quiz button with proper URL
-                        topic_quiz_button = (
-                            f"<a href='{url_for('take_topic_quiz', topic_id=topic['topic_id'])}' "
-                            "class='btn btn-primary btn-sm ms-auto m-1' target='_blank'> Go to Topic Quiz</a>"
-                            if topic['topic_quiz_available'] else ""
+                        }
+                        for subtopic in topic.subtopics if subtopic.has_quiz
+                    ],
+                    'topic_quiz_available': topic.has_quiz,
+                    'topic_id': topic.id  # Add topic ID for the URL
+                }
+
+                # Keep the topics and subtopics that have quizzes
+                if topic_info['subtopics'] or topic_info['topic_quiz_available']:
+                    course_info['topics'].append(topic_info)
+
+            if course_info['topics']:
+                course_data.append(course_info)
+
+        # Format the output in a list view with proper URLs
+        if course_data:
+            ai_response = "<ul>"
+            for course in course_data:
+                ai_response += f"<li><strong>Course Name:</strong> {course['course_name']}<ul>"
+                for topic in course['topics']:
+                    # Create topic quiz button with proper URL
+                    topic_quiz_button = (
+                        f"<a href='{url_for('take_topic_quiz', topic_id=topic['topic_id'])}' "
+                        "class='btn btn-primary btn-sm ms-auto m-1' target='_blank'> Go to Topic Quiz</a>"
+                        if topic['topic_quiz_available'] else ""
+                    )
+                    ai_response += f"<li><strong>Topic:</strong> {topic['topic_name']} {topic_quiz_button}<ul>"
+
+                    # Create subtopic quiz buttons with proper URLs
+                    for subtopic in topic['subtopics']:
+                        ai_response += (
+                            f"<div class='d-flex align-items-center'>"
+                            f"<div class='d-flex justify-content-between align-items-center'><li>{subtopic['name']} "
+                            f"<a href='{url_for('take_subtopic_quiz', subtopic_id=subtopic['id'])}' "
+                            "class='btn btn-primary btn-sm ms-auto m-1' target='_blank'>Go To Subtopic Quiz</a></li></div>"
                         )
-                        ai_response += f"<li><strong>Topic:</strong> {topic['topic_name']} {topic_quiz_button}<ul>"
-
-                        # Create subtopic quiz buttons with proper URLs
-                        for subtopic in topic['subtopics']:
-                            ai_response += (
-                                f"<div class='d-flex align-items-center'>"
-                                f"<div class='d-flex justify-content-between align-items-center'><li>{subtopic['name']} "
-                                f"<a href='{url_for('take_subtopic_quiz', subtopic_id=subtopic['id'])}' "
-                                "class='btn btn-primary btn-sm ms-auto m-1' target='_blank'>Go To Subtopic Quiz</a></li></div>"
-                            )
 
-                        ai_response += "</ul></li>"
                     ai_response += "</ul></li>"
-                ai_response += "</ul>"
-            else:
-                ai_response = "No courses with topics and subtopics containing quizzes are currently available."
+                ai_response += "</ul></li>"
+            ai_response += "</ul>"
+        else:
+            ai_response = "No courses with topics and subtopics containing quizzes are currently available."
 
+    else:
+        return None
 
-        else:
-            # Generate other AI responses
-            ai_response = generate_text(user_message, model=model4)
-        
-        return jsonify({'response': ai_response})
-    
-    return render_template('chat_ai.html')
+    return ai_response
 
 @app.route('/generate_topic_quiz/<int:topic_id>', methods=['POST', 'GET'])
 @login_required
 def generate_topic_quiz(topic_id):
     try:
-        # Check if quiz alread  y exists
+        # Check if quiz already exists
         existing_quiz = Quiz.query.filter_by(topic_id=topic_id).first()
         session_key = f'quiz_topic_{topic_id}'
         
-        if existing_quiz or session.get(session_key):
+        if existing_quiz or quiz_states.get(session_key):
             return redirect(url_for('take_topic_quiz', topic_id=topic_id))
         
         topic = Topic.query.get_or_404(topic_id)
         
-        # Create a more generic prompt
-        prompt = f"""Please create 10 multiple choice questions in JSON format about {topic.topic_name}. 
-        Focus on fundamental concepts and general understanding.
-        Each question should have 4 options (A, B, C, D) and indicate the correct answer.
-        
-        The response should be in this exact JSON format:
-        {{
-            "questions": [
-                {{
-                    "question": "What is...",
-                    "options": [
-                        "A) First option",
-                        "B) Second option",
-                        "C) Third option",
-                        "D) Fourth option"
-                    ],
-                    "correct": "A"
-                }},
-                ...
-            ]
-        }}"""
-        
-        try:
-            response = generate_text(prompt, model=model3)
-            questions_data = process_json_data(response)
-            
-            if not questions_data or 'questions' not in questions_data:
-                # Fallback to simplified prompt if first attempt fails
-                fallback_prompt = f"""Create 10 basic multiple choice questions about {topic.topic_name}.
-                Focus only on fundamental concepts. Return in JSON format with question, options, and correct answer."""
-                
-                response = generate_text(fallback_prompt, model=model3)
-                questions_data = process_json_data(response)
-            
-            # Randomize the answers
-            questions_data = process_and_randomize_quiz(questions_data)
-            
-            if questions_data and 'questions' in questions_data:
-                # Delete any existing quiz
-                Quiz.query.filter_by(topic_id=topic_id).delete()
-                
-                for q_data in questions_data['questions']:
-                    quiz = Quiz(
-                        topic_id=topic_id,
-                        question=q_data['question'],
-                        option_a=q_data['options'][0][3:],
-                        option_b=q_data['options'][1][3:],
-                        option_c=q_data['options'][2][3:],
-                        option_d=q_data['options'][3][3:],
-                        correct_answer=q_data['correct']
-                    )
-                    db.session.add(quiz)
-                
-                db.session.commit()
-                flash('Quiz generated successfully!', 'success')
-                return redirect(url_for('take_topic_quiz', topic_id=topic_id))
-            
-            flash('Unable to generate quiz questions. Please try again.', 'warning')
-            return redirect(url_for('list_course', course_id=topic.course.course_info.id))
-            
-        except Exception as e:
-            print(f"Generation error: {str(e)}")
-            db.session.rollback()
-            flash('Error generating quiz questions. Please try again.', 'danger')
-            return redirect(url_for('list_course', course_id=topic.course.course_info.id))
+        # Recreated quizzes must not be served from the response cache
+        refresh = request.args.get('refresh') == '1'
+
+        job = jobs.submit(
+            ('topic_quiz', topic_id), build_topic_quiz, topic_id, refresh,
+            success_url=url_for('take_topic_quiz', topic_id=topic_id),
+            failure_url=url_for('list_course', course_id=topic.course.course_info.id)
+        )
+        return job_response(job, 'Generating your quiz')
             
     except Exception as e:
         print(f"Error in generate_topic_quiz: {str(e)}")
         flash('An error occurred. Please try again.', 'danger')
         return redirect(url_for('student_dashboard'))
 
+@app.route('/generate_topic_quizzes/<int:topic_id>', methods=['POST'])
+@login_required
+def generate_topic_quizzes(topic_id):
+    # Topic quiz and every subtopic quiz in one model call
+    topic = Topic.query.get_or_404(topic_id)
+    job = jobs.submit(
+        ('topic_quizzes', topic_id), build_topic_quizzes, topic_id,
+        success_url=url_for('list_course', course_id=topic.course.course_info.id),
+        failure_url=url_for('list_course', course_id=topic.course.course_info.id)
+    )
+    return job_response(job, 'Generating all quizzes of the topic')
+
 @app.route('/take_topic_quiz/<int:topic_id>', methods=['GET', 'POST'])
 @login_required
 def take_topic_quiz(topic_id):
     try:
         topic = Topic.query.get_or_404(topic_id)
         
-        # Try to get existing quiz from session
+        # Try to get existing quiz from the quiz state store
         session_key = f'quiz_topic_{topic_id}'
-        questions = session.get(session_key)
+        questions = quiz_states.get(session_key)
         
         if not questions:
-            # If no quiz in session, get from database
+            # If no quiz is stored, get from database
             questions = Quiz.query.filter_by(topic_id=topic_id).all()
             
             if not questions:
                 flash('No quiz questions available for this topic.', 'warning')
                 return redirect(url_for('list_course', course_id=topic.course.course_info.id))
             
-            # Store questions in session
-            session[session_key] = [
+            # Keep the question set on the server, the cookie only carries its key
+            questions = [
                 {
                     'id': q.id,
                     'question': q.question,
@@ -481,6 +487,7 @@ def take_topic_quiz(topic_id):
                 }
                 for q in questions
             ]
+            quiz_states.set(session_key, questions)
             
         return render_template('quiz.html', topic=topic, questions=questions, is_subtopic_quiz=False)
         
@@ -496,80 +503,21 @@ def generate_subtopic_quiz(subtopic_id):
         session_key = f'quiz_subtopic_{subtopic_id}'
         existing_quiz = SubtopicQuiz.query.filter_by(subtopic_id=subtopic_id).first()
         
-        if existing_quiz or session.get(session_key):
+        if existing_quiz or quiz_states.get(session_key):
             return redirect(url_for('take_subtopic_quiz', subtopic_id=subtopic_id))
         
         subtopic = Subtopic.query.get_or_404(subtopic_id)
         topic = Topic.query.get(subtopic.topic_id)
         
-        prompt = f"""Create 5 multiple choice questions in JSON format about {subtopic.subtopic_name}.
-        Focus on testing understanding of basic concepts related to this specific subtopic.
-        Each question should have 4 options (A, B, C, D) and indicate the correct answer.
-        
-        The response should be in this exact JSON format:
-        {{
-            "questions": [
-                {{
-                    "question": "What is...",
-                    "options": [
-                        "A) First option",
-                        "B) Second option",
-                        "C) Third option",
-                        "D) Fourth option"
-                    ],
-                    "correct": "A"
-                }},
-                ...
-            ]
-        }}"""
-        
-        try:
-            response = generate_text(prompt, model=model3)
-            questions_data = process_json_data(response)
-            
-            if not questions_data or 'questions' not in questions_data:
-                fallback_prompt = f"""Generate 5 basic multiple choice questions about {subtopic.subtopic_name}.
-                Focus on fundamental concepts only. Return in JSON format with question, options, and correct answer."""
-                
-                response = generate_text(fallback_prompt, model=model3)
-                questions_data = process_json_data(response)
-            
-            # Randomize the answers
-            questions_data = process_and_randomize_quiz(questions_data)
-            
-            if questions_data and 'questions' in questions_data:
-                # Delete existing quiz if it exists
-                SubtopicQuiz.query.filter_by(subtopic_id=subtopic_id).delete()
-                
-                for q_data in questions_data['questions']:
-                    quiz = SubtopicQuiz(
-                        subtopic_id=subtopic_id,
-                        question=q_data['question'],
-                        option_a=q_data['options'][0][3:],
-                        option_b=q_data['options'][1][3:],
-                        option_c=q_data['options'][2][3:],
-                        option_d=q_data['options'][3][3:],
-                        correct_answer=q_data['correct']
-                    )
-                    db.session.add(quiz)
-                
-                db.session.commit()
-                
-                # Clear the session key to force fresh load
-                if session_key in session:
-                    session.pop(session_key)
-                    
-                flash('Quiz generated successfully!', 'success')
-                return redirect(url_for('take_subtopic_quiz', subtopic_id=subtopic_id))
-            
-            flash('Unable to generate quiz questions. Please try again.', 'warning')
-            return redirect(url_for('list_course', course_id=topic.course.course_info.id))
-            
-        except Exception as e:
-            print(f"Generation error: {str(e)}")
-            db.session.rollback()
-            flash('Error generating quiz questions. Please try again.', 'danger')
-            return redirect(url_for('list_course', course_id=topic.course.course_info.id))
+        # Recreated quizzes must not be served from the response cache
+        refresh = request.args.get('refresh') == '1'
+
+        job = jobs.submit(
+            ('subtopic_quiz', subtopic_id), build_subtopic_quiz, subtopic_id, refresh,
+            success_url=url_for('take_subtopic_quiz', subtopic_id=subtopic_id),
+            failure_url=url_for('list_course', course_id=topic.course.course_info.id)
+        )
+        return job_response(job, 'Generating your quiz')
             
     except Exception as e:
         print(f"Error in generate_subtopic_quiz: {str(e)}")
@@ -582,20 +530,20 @@ def take_subtopic_quiz(subtopic_id):
         subtopic = Subtopic.query.get_or_404(subtopic_id)
         topic = Topic.query.get(subtopic.topic_id)
         
-        # Try to get existing quiz from session
+        # Try to get existing quiz from the quiz state store
         session_key = f'quiz_subtopic_{subtopic_id}'
-        questions = session.get(session_key)
+        questions = quiz_states.get(session_key)
         
         if not questions:
-            # If no quiz in session, get from database
+            # If no quiz is stored, get from database
             questions = SubtopicQuiz.query.filter_by(subtopic_id=subtopic_id).all()
             
             if not questions:
                 flash('No quiz questions available for this subtopic.', 'warning')
                 return redirect(url_for('list_course', course_id=topic.course.course_info.id))
             
-            # Store questions in session
-            session[session_key] = [
+            # Keep the question set on the server, the cookie only carries its key
+            questions = [
                 {
                     'id': q.id,
                     'question': q.question,
@@ -607,6 +555,7 @@ def take_subtopic_quiz(subtopic_id):
                 }
                 for q in questions
             ]
+            quiz_states.set(session_key, questions)
             
         return render_template('quiz.html', topic=topic, subtopic=subtopic, questions=questions, is_subtopic_quiz=True)
         
@@ -615,32 +564,18 @@ def take_subtopic_quiz(subtopic_id):
         flash('An error occurred while loading the quiz.', 'danger')
         return redirect(url_for('student_dashboard'))
 
-def process_and_randomize_quiz(questions_data):
-    """Helper function to process quiz data and randomize answers"""
-    if not questions_data or 'questions' not in questions_data:
-        return None
-        
-    for question in questions_data['questions']:
-        # Get the correct answer's content
-        correct_option = question['options'][ord(question['correct']) - ord('A')]
-        
-        # Randomly shuffle the options
-        random.shuffle(question['options'])
-        
-        # Find the new position of the correct answer
-        for i, option in enumerate(question['options']):
-            if option == correct_option:
-                question['correct'] = chr(ord('A') + i)
-                break
-    
-    return questions_data
-
 @app.route('/check_answer', methods=['POST'])
 @login_required
 def check_answer():
-    question_id = request.form.get('question_id')
+    question_id = request.form.get('question_id', type=int)
     selected_answer = request.form.get('answer')
     quiz_type = request.form.get('quiz_type', 'topic')
+    if quiz_type not in ('topic', 'subtopic') or question_id is None:
+        return jsonify({'error': 'Invalid question'}), 400
+
+    # The answer key stays hidden until the quiz was submitted and graded on the server
+    if not has_attempted(current_user.id, quiz_type, question_id):
+        return jsonify({'error': 'Submit the quiz to check answers'}), 403
     
     if quiz_type == 'subtopic':
         question = SubtopicQuiz.query.get_or_404(question_id)
@@ -664,11 +599,11 @@ def retake_quiz(topic_id):
         # Clear any stored answers/state
         if is_subtopic:
             session_key = f'quiz_subtopic_{subtopic_id}'
-            session.pop(session_key, None)
+            quiz_states.pop(session_key)
             return redirect(url_for('take_subtopic_quiz', subtopic_id=subtopic_id))
         else:
             session_key = f'quiz_topic_{topic_id}'
-            session.pop(session_key, None)
+            quiz_states.pop(session_key)
             return redirect(url_for('take_topic_quiz', topic_id=topic_id))
             
     except Exception as e:
@@ -688,23 +623,21 @@ def recreate_quiz(topic_id):
             # Delete existing subtopic quiz
             SubtopicQuiz.query.filter_by(subtopic_id=int(subtopic_id)).delete()
             session_key = f'quiz_subtopic_{subtopic_id}'
-            if session_key in session:
-                session.pop(session_key)
+            quiz_states.pop(session_key)
             db.session.commit()
             
             # Generate new subtopic quiz
-            return redirect(url_for('generate_subtopic_quiz', subtopic_id=int(subtopic_id)))
+            return redirect(url_for('generate_subtopic_quiz', subtopic_id=int(subtopic_id), refresh=1))
         else:
             topic = Topic.query.get_or_404(topic_id)
             # Delete existing topic quiz
             Quiz.query.filter_by(topic_id=topic_id).delete()
             session_key = f'quiz_topic_{topic_id}'
-            if session_key in session:
-                session.pop(session_key)
+            quiz_states.pop(session_key)
             db.session.commit()
             
             # Generate new topic quiz
-            return redirect(url_for('generate_topic_quiz', topic_id=topic_id))
+            return redirect(url_for('generate_topic_quiz', topic_id=topic_id, refresh=1))
             
     except Exception as e:
         print(f"Error in recreate_quiz: {str(e)}")
@@ -713,69 +646,49 @@ def recreate_quiz(topic_id):
         return redirect(url_for('student_dashboard'))
     
 @app.route('/submit_quiz', methods=['POST', 'GET'])
+@login_required
 def submit_quiz():
     # Get form data
     quiz_type = request.form.get('quiz_type')
     topic_id = request.form.get('topic_id')
     subtopic_id = request.form.get('subtopic_id')
     
-    # Get questions and answers
-    answers = {}
-    correct_count = 0
-    for key, value in request.form.items():
-        if key.startswith('question_'):
-            question_id = key.replace('question_', '')
-            answers[question_id] = value
-            if value == request.form.get(f'correct_{question_id}'):
-                correct_count += 1
-    
-    total_questions = len(answers)
-    
     # Get quiz name and course name based on quiz type
     if quiz_type == 'subtopic':
         subtopic = Subtopic.query.get(subtopic_id)
         topic = Topic.query.get(topic_id)
         quiz_name = f"{subtopic.subtopic_name}"
         quiz_course_name = topic.course.course_code
+        quiz_id = subtopic.id
     else:
+        quiz_type = 'topic'
         topic = Topic.query.get(topic_id)
         quiz_name = f"{topic.topic_name}"
         quiz_course_name = topic.course.course_code
-    
-    # Check if progress record exists for this quiz
-    existing_progress = StudentProgress.query.filter(
-        and_(
-            StudentProgress.quiz_name == quiz_name,
-            StudentProgress.quiz_course_name == quiz_course_name
-        )
-    ).first()
-    
-    if existing_progress:
-        # Update existing record
-        existing_progress.total_questions += total_questions
-        existing_progress.correct_questions += correct_count
-        existing_progress.quiz_counter += 1
-    else:
-        # Create new progress record
-        new_progress = StudentProgress(
-            quiz_name=quiz_name,
-            quiz_course_name=quiz_course_name,
-            total_questions=total_questions,
-            correct_questions=correct_count,
-            quiz_counter=1
-        )
-        db.session.add(new_progress)
+        quiz_id = topic.id
+
+    # Grade every answer against the stored answer key in one pass
+    graded = grade_quiz(quiz_type, quiz_id, parse_answers(request.form))
+    correct_count = graded['correct']
+    total_questions = graded['total']
     
     try:
+        # Log the attempt and bump the user's progress row atomically, together with the grading
+        quiz_counter = record_attempt(
+            current_user.id, quiz_type, topic.id, subtopic.id if quiz_type == 'subtopic' else None,
+            quiz_name, quiz_course_name, graded
+        )
         db.session.commit()
+        analytics.invalidate()
         return jsonify({
             'success': True,
             'score': {
                 'correct': correct_count,
                 'total': total_questions,
-                'percentage': round((correct_count / total_questions) * 100, 1)
+                'percentage': round((correct_count / total_questions) * 100, 1) if total_questions else 0
             },
-            'quiz_counter': existing_progress.quiz_counter if existing_progress else 1
+            'results': graded['results'],
+            'quiz_counter': quiz_counter
         })
     except Exception as e:
         db.session.rollback()
@@ -793,18 +706,8 @@ def create_note(course_id):
             flash('Course not found!', 'error')
             return redirect(url_for('student_dashboard'))
         
-        # Create markdown converter with math support
-        markdowner = Markdown(extras={
-            'fenced-code-blocks': None,
-            'tables': None,
-            'break-on-newline': True,
-            'header-ids': None,
-            'markdown-in-html': True,
-            'math': None
-        })
-
-        # Then get the associated Course
-        course = Course.query.filter_by(course_info_id=course_id).first()
+        # Then get the associated Course with its topics and subtopics
+        course = load_course_tree(course_id)
         if course is None:
             flash('Course details not found!', 'error')
             return redirect(url_for('student_dashboard'))
@@ -818,9 +721,9 @@ def create_note(course_id):
             for topic in course.topics
         ]
         
-        # Form data handling
-        selected_topic = request.form.get('topic')
-        selected_subtopic = request.form.get('subtopic')
+        # Form data handling (query string when coming back from a note job)
+        selected_topic = request.values.get('topic')
+        selected_subtopic = request.values.get('subtopic')
         subtopics = []
         lecture_note = None
 
@@ -844,31 +747,13 @@ def create_note(course_id):
                             # Use the existing note
                             lecture_note = existing_note.content
                         else:
-                            try:
-                                # Generate a new note if it doesn't exist
-                                prompt = f"{selected_topic} - {selected_subtopic} hakkında ders notu istiyorum."
-                                lecture_note = generate_text(prompt, model=model5)
-                                
-                                # Convert markdown to HTML
-                                html_content = markdowner.convert(lecture_note)
-                                
-                                # Make it safe for rendering
-                                lecture_note = Markup(html_content)
-                                                            
-                                # Save the generated note to the database
-                                new_note = Note(
-                                    content=lecture_note,
-                                    course_id=course.id,  # Use course.id instead of course_id
-                                    topic_id=topic.id,
-                                    subtopic_id=subtopic.id
-                                )
-                                db.session.add(new_note)
-                                db.session.commit()
-                                flash('Note created successfully!', 'success')
-                            except Exception as e:
-                                db.session.rollback()
-                                flash(f'Error creating note: {str(e)}', 'error')
-                                return redirect(url_for('create_note', course_id=course_id))
+                            # Generate the note in the background and come back to show it
+                            job = jobs.submit(
+                                ('note', subtopic.id), build_note, course.id, topic.id, subtopic.id,
+                                success_url=url_for('create_note', course_id=course_id, topic=selected_topic, subtopic=selected_subtopic),
+                                failure_url=url_for('create_note', course_id=course_id)
+                            )
+                            return job_response(job, 'Generating your lecture note')
 
         
         # Render the template with generated note content
@@ -878,6 +763,7 @@ def create_note(course_id):
             course_name=course_info.course_name,
             topics_with_subtopics=topics_with_subtopics,
             selected_topic=selected_topic,
+            selected_subtopic=selected_subtopic,
             subtopics=subtopics,
             note_content=lecture_note
         )
@@ -887,6 +773,41 @@ def create_note(course_id):
         flash(f'An error occurred: {str(e)}', 'error')
         return redirect(url_for('student_dashboard'))
 
+@app.route('/create_note/<int:course_id>/stream', methods=['POST'])
+def stream_note(course_id):
+    course = Course.query.filter_by(course_info_id=course_id).first_or_404()
+    topic = Topic.query.filter_by(course_id=course.id, topic_name=request.form.get('topic')).first_or_404()
+    subtopic = Subtopic.query.filter_by(topic_id=topic.id, subtopic_name=request.form.get('subtopic')).first_or_404()
+
+    existing_note = Note.query.filter_by(course_id=course.id, topic_id=topic.id, subtopic_id=subtopic.id).first()
+    if existing_note:
+        return sse_response([sse_event({'html': existing_note.content})])
+
+    def events():
+        parts = []
+        try:
+            # Concurrent streams of the same note wait for the first one and show its result
+            with single_flight.hold(('note', subtopic.id)):
+                note = Note.query.filter_by(course_id=course.id, topic_id=topic.id, subtopic_id=subtopic.id).first()
+                if note is not None:
+                    yield sse_event({'html': note.content})
+                    return
+                for chunk in stream_text(note_prompt(topic.topic_name, subtopic.subtopic_name), model='note'):
+                    parts.append(chunk)
+                    yield sse_event({'delta': chunk})
+
+                # Save the rendered note once the whole text has arrived
+                lecture_note = save_note(course.id, topic.id, subtopic.id, ''.join(parts)).content
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error in stream_note: {str(e)}")
+            yield sse_event({'error': f'Error creating note: {str(e)}'})
+            return
+
+        yield sse_event({'html': str(lecture_note)})
+
+    return sse_response(events())
+
 # to be continued..
 def generate_explanation_prompt(question, options):
     """Generate a comprehensive prompt for the AI explanation"""
@@ -906,52 +827,21 @@ Please provide:
 3. Key concepts and points to remember"""
 
 @app.route('/get_ai_explanation', methods=['POST'])
+@login_required
 def get_ai_explanation():
     try:
-        markdowner = Markdown(extras={
-            'fenced-code-blocks': None,
-            'tables': None,
-            'break-on-newline': True,
-            'header-ids': None,
-            'markdown-in-html': True,
-            'math': None
-        })
-
         data = request.json
-        question = data.get('question')
-        correct_answer = data.get('correct_answer')
-        options = {
-            'A': data.get('option_a'),
-            'B': data.get('option_b'),
-            'C': data.get('option_c'),
-            'D': data.get('option_d')
-        }
+        quiz_type = data.get('quiz_type')
+        question_id = data.get('question_id')
+        if quiz_type not in ('topic', 'subtopic') or not isinstance(question_id, int):
+            return jsonify({'explanation': 'Invalid question', 'status': 'error'}), 400
 
-        # Simple prompt that lets Gemini use its system instruction
-        prompt = f'''Question: {question}
-        
-Correct Answer: {correct_answer}
+        # The explanation gives the answer away, so only after the quiz was submitted
+        if not has_attempted(current_user.id, quiz_type, question_id):
+            return jsonify({'explanation': 'Submit the quiz to see explanations', 'status': 'error'}), 403
 
-Options:
-A) {options['A']}
-B) {options['B']}
-C) {options['C']}
-D) {options['D']}'''
-
-        # Get explanation from Gemini
-        raw_explanation = generate_text(prompt, model6)
-        
-        # Convert markdown to HTML
-        html_content = markdowner.convert(raw_explanation)
-        safe_html = Markup(html_content)
-        
-        formatted_explanation = f'''
-        <div class="explanation-wrapper">
-            <div class="explanation-content">
-                {safe_html}
-            </div>
-        </div>
-        '''
+        # Generated once per question, then served from the database
+        formatted_explanation = build_explanation(quiz_type, question_id)
         
         return jsonify({
             'explanation': formatted_explanation,
@@ -965,40 +855,148 @@ D) {options['D']}'''
         }), 500
 
         
-# AI section
+def sse_event(data):
+    return f"data: {json.dumps(data)}\n\n"
 
-def generate_text(prompt, model):
-    recent_history = ChatHistory.query.order_by(ChatHistory.timestamp.desc()).limit(5).all()
-    recent_history.reverse()
-    
-    conversation_context = ""
-    for message in recent_history:
-        conversation_context += f"{message.sender.capitalize()}: {message.text}\n"
 
-    conversation_context += f"User: {prompt}\nAI:"
-    
-    response = model.generate_content(conversation_context)
-    model.generate_content
-    return response.text
+def sse_response(events):
+    response = Response(stream_with_context(events), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
-# Get data from JSON file
-def process_json_data(raw_json):
-    json_text_cleaned = raw_json.replace('```json', '').replace('```', '').strip()
-   
-    try:
-        json_text_cleaned = ' '.join(json_text_cleaned.split())
-        json_data = json.loads(json_text_cleaned)
-        return json_data
-    except json.JSONDecodeError as e:
-        print(f"JSON Decode Error: {e}")
-        print(f"Cleaned text was: {json_text_cleaned}")
-        return None
+def job_response(job, message):
+    """Job id for API clients, a page that polls the job for browsers"""
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(job.as_dict()), 202
+    return render_template('job_status.html', job=job, message=message)
+
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.as_dict())
+
+
+@app.route('/admin/pregenerate/<int:course_id>', methods=['POST'])
+@login_required
+def admin_pregenerate(course_id):
+    if current_user.role != 'teacher':
+        abort(403)
+    CourseInfo.query.get_or_404(course_id)
+
+    job = jobs.submit(
+        ('pregenerate', course_id), pregenerate_course, course_id, jobs.report_progress,
+        success_url=url_for('list_course', course_id=course_id),
+        failure_url=url_for('student_dashboard')
+    )
+    return job_response(job, 'Generating quizzes and notes for the course')
+
+
+@app.cli.command('pregenerate')
+@click.argument('course_ids', nargs=-1, type=int, required=True)
+def pregenerate_command(course_ids):
+    """Generate every quiz and note of the given courses (CourseInfo ids)."""
+    def progress(done, total, failed):
+        click.echo(f"  {done}/{total} done, {failed} failed")
+
+    for course_id in course_ids:
+        click.echo(f"Pre-generating course {course_id}")
+        summary = pregenerate_course(course_id, progress)
+        for error in summary['failed']:
+            click.echo(f"  failed: {error}", err=True)
+
+
+SEARCH_LABELS = {'course': 'Course', 'note': 'Note', 'quiz': 'Topic Quiz', 'subtopic_quiz': 'Subtopic Quiz'}
+
+def search_result_url(result):
+    if result['kind'] == 'course':
+        return url_for('list_course', course_id=result['course_id'])
+    if result['kind'] == 'note':
+        return url_for('create_note', course_id=result['course_id'], topic=result['topic'], subtopic=result['subtopic'])
+    if result['kind'] == 'quiz':
+        return url_for('take_topic_quiz', topic_id=result['topic_id'])
+    return url_for('take_subtopic_quiz', subtopic_id=result['subtopic_id'])
+
+
+@app.route('/search')
+@login_required
+def search():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing query'}), 400
+    limit = min(request.args.get('limit', app.config['SEARCH_RESULTS'], type=int), 50)
+
+    results = search_index.search(query, limit=limit)
+    for result in results:
+        result['url'] = search_result_url(result)
+    return jsonify({'query': query, 'results': results})
+
+
+@app.cli.command('search-index')
+def search_index_command():
+    """Rebuild the search index of courses, notes and quizzes."""
+    count = search_index.rebuild()
+    click.echo(f"Indexed {count} document(s) in {search_index.path}")
+
+
+@app.route('/analytics/me')
+@login_required
+def my_analytics():
+    return jsonify(analytics.student_report(current_user.id))
+
+
+@app.route('/analytics/cohort')
+@login_required
+def cohort_analytics():
+    if current_user.role != 'teacher':
+        abort(403)
+    return jsonify(analytics.cohort_report())
+
+
+@app.cli.command('migrate')
+@click.option('--list', 'list_only', is_flag=True, help='Only show the pending migrations.')
+def migrate_command(list_only):
+    """Apply pending schema migrations."""
+    if list_only:
+        for version, description, _ in pending_migrations(db.engine):
+            click.echo(f"{version}: {description}")
+        return
+
+    applied = run_migrations(db.engine, echo=click.echo)
+    click.echo(f"Applied {len(applied)} migration(s)" if applied else "Schema is up to date")
+
+
+@app.route('/llm/metrics')
+@login_required
+def llm_metrics():
+    # Usage, cache and error statistics of every model are for operators only
+    if current_user.role != 'teacher':
+        abort(403)
+    metrics = gateway.metrics()
+    # Generations running and callers that waited for one instead of starting their own
+    metrics['single_flight'] = single_flight.metrics()
+    # Chat questions grounded in stored material or answered from a note without a model call
+    metrics['retrieval'] = retriever.metrics()
+    metrics['semantic_cache'] = semantic_cache.metrics()
+    return jsonify(metrics)
 
 
 # Create tables if not exists
 with app.app_context():
+    new_database = not inspect(db.engine).get_table_names()
     db.create_all()
+    # Changes to existing tables are applied with `flask migrate`
+    if new_database:
+        stamp_migrations(db.engine)
+    pending = pending_migrations(db.engine)
+    if pending:
+        print(f"Warning: {len(pending)} pending schema migration(s), run `flask migrate`")
     
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,287 @@
+"""ASGI entry point: the LLM-bound endpoints run natively async, everything else goes to Flask.
+
+    uvicorn asgi:application --workers 2
+
+A waiting model call is just a suspended coroutine here, so one worker can
+hold hundreds of them. Database work is short and runs on the default
+thread pool inside the request's app context. Requests the async handlers
+do not cover (chatbot commands, non-form bodies) fall through to the
+unchanged Flask views.
+"""
+import asyncio
+import json
+import re
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app, is_chatbot_command, sse_event
+from llm import gateway
+from models import db, Course, Topic, Subtopic, Note
+from generation import (
+    find_explanation, save_explanation, save_note, note_prompt, chat_prompt, record_chat, current_user_id
+)
+from progress import has_attempted
+from rendering import renderer
+from singleflight import single_flight
+
+flask_application = WsgiToAsgi(app)
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+def replay(body, receive):
+    """receive callable that hands an already-read body on to Flask"""
+    sent = False
+
+    async def replayed():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return await receive()
+
+    return replayed
+
+
+def header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+
+def session_user_id(scope):
+    """Logged-in user id as the Flask views see it.
+
+    Flask-Login resolves it from the request's headers, so the session,
+    the remember-me cookie and session protection work as they do in Flask.
+    Loading the user queries the database, so this runs through run_db.
+    """
+    headers = [(key.decode('latin-1'), value.decode('latin-1')) for key, value in scope['headers']]
+    client = scope.get('client') or ('', 0)
+    # A fresh app context, so the user Flask-Login keeps on g is not carried over
+    with app.app_context(), app.test_request_context(scope['path'], headers=headers, environ_base={'REMOTE_ADDR': client[0]}):
+        return current_user_id()
+
+
+def json_message(body):
+    """'message' of a JSON object body, or None when the body is malformed"""
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        return None
+    message = data.get('message') if isinstance(data, dict) else None
+    return message if isinstance(message, str) else None
+
+
+async def send_json(send, data, status=200):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json')]
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps(data).encode('utf-8')})
+
+
+async def send_sse(send, events):
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            # Stop nginx from buffering the stream
+            (b'x-accel-buffering', b'no')
+        ]
+    })
+    async for data in events:
+        await send({'type': 'http.response.body', 'body': sse_event(data).encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def run_db(func, *args):
+    """Run a blocking database step on a thread.
+
+    The session is closed afterwards so its pooled connection is not held
+    while the handler awaits the model.
+    """
+    def step():
+        try:
+            return func(*args)
+        finally:
+            db.session.close()
+
+    return await asyncio.to_thread(step)
+
+
+# Handlers return False to hand the request over to the Flask view
+
+async def chatbot(scope, body, send):
+    user_message = json_message(body)
+    if user_message is None:
+        await send_json(send, {'error': 'Invalid request'}, status=400)
+        return
+    if is_chatbot_command(user_message):
+        return False
+
+    user_id = await run_db(session_user_id, scope)
+    prompt, ai_response = await run_db(chat_prompt, user_id, user_message)
+    if ai_response is None:
+        ai_response = await gateway.agenerate('chat', prompt)
+    await run_db(record_chat, user_id, user_message, ai_response, prompt)
+    html = await asyncio.to_thread(renderer.render, ai_response)
+    await send_json(send, {'response': ai_response, 'html': str(html)})
+
+
+async def chatbot_stream(scope, body, send):
+    user_message = json_message(body)
+    if user_message is None:
+        await send_json(send, {'error': 'Invalid request'}, status=400)
+        return
+    if is_chatbot_command(user_message):
+        return False
+
+    user_id = await run_db(session_user_id, scope)
+
+    async def events():
+        parts = []
+        try:
+            prompt, answer = await run_db(chat_prompt, user_id, user_message)
+            if answer is not None:
+                parts.append(answer)
+                yield {'delta': answer}
+            else:
+                async for chunk in gateway.astream('chat', prompt):
+                    parts.append(chunk)
+                    yield {'delta': chunk}
+        except Exception as e:
+            print(f"Error in chatbot_stream: {str(e)}")
+            yield {'error': 'Sorry, I encountered an error. Please try again.'}
+            return
+
+        # Persist the full reply once the stream is complete
+        reply = ''.join(parts)
+        await run_db(record_chat, user_id, user_message, reply, prompt)
+        html = await asyncio.to_thread(renderer.render, reply)
+        yield {'done': True, 'html': str(html)}
+
+    await send_sse(send, events())
+
+
+async def get_ai_explanation(scope, body, send):
+    try:
+        data = json.loads(body)
+        quiz_type, question_id = data.get('quiz_type'), data.get('question_id')
+        user_id = await run_db(session_user_id, scope)
+        if user_id is None or quiz_type not in ('topic', 'subtopic') or not isinstance(question_id, int):
+            # Let the Flask view answer with its login redirect or error
+            return False
+        if not await run_db(has_attempted, user_id, quiz_type, question_id):
+            return False
+
+        formatted_explanation, prompt = await run_db(find_explanation, quiz_type, question_id)
+        if formatted_explanation is None:
+            raw_explanation = await gateway.agenerate('explanation', prompt)
+            formatted_explanation = await run_db(save_explanation, quiz_type, question_id, raw_explanation)
+        await send_json(send, {'explanation': formatted_explanation, 'status': 'success'})
+    except Exception as e:
+        await send_json(send, {'explanation': f'An error occurred: {str(e)}', 'status': 'error'}, status=500)
+
+
+def find_note_target(course_id, topic_name, subtopic_name):
+    course = Course.query.filter_by(course_info_id=course_id).first()
+    topic = course and Topic.query.filter_by(course_id=course.id, topic_name=topic_name).first()
+    subtopic = topic and Subtopic.query.filter_by(topic_id=topic.id, subtopic_name=subtopic_name).first()
+    if subtopic is None:
+        return None
+    note = Note.query.filter_by(course_id=course.id, topic_id=topic.id, subtopic_id=subtopic.id).first()
+    return course.id, topic.id, subtopic.id, note.content if note else None
+
+
+def stored_note(course_id, topic_id, subtopic_id):
+    note = Note.query.filter_by(course_id=course_id, topic_id=topic_id, subtopic_id=subtopic_id).first()
+    return note.content if note else None
+
+
+def store_note(course_id, topic_id, subtopic_id, text):
+    # The stream holds the note's single-flight lock on another thread
+    return str(save_note(course_id, topic_id, subtopic_id, text, held=True).content)
+
+
+async def stream_note(scope, body, send, course_id):
+    if not header(scope, b'content-type').startswith('application/x-www-form-urlencoded'):
+        return False
+    # Undecodable bytes cannot match a stored name, so they are replaced instead of failing the request
+    form = parse_qs(body.decode('utf-8', errors='replace'))
+    topic, subtopic = form.get('topic', [None])[0], form.get('subtopic', [None])[0]
+    if not topic or not subtopic:
+        await send_json(send, {'error': 'Invalid request'}, status=400)
+        return
+    # The route only matches digits
+    target = await run_db(find_note_target, int(course_id), topic, subtopic)
+    if target is None:
+        await send_json(send, {'error': 'Not found'}, status=404)
+        return
+    course_id, topic_id, subtopic_id, existing_note = target
+
+    async def events():
+        if existing_note:
+            yield {'html': existing_note}
+            return
+
+        parts = []
+        try:
+            # Concurrent streams of the same note, on any worker, wait for the first one and show its result
+            async with single_flight.ahold(('note', subtopic_id)):
+                lecture_note = await run_db(stored_note, course_id, topic_id, subtopic_id)
+                if lecture_note is None:
+                    async for chunk in gateway.astream('note', note_prompt(topic, subtopic)):
+                        parts.append(chunk)
+                        yield {'delta': chunk}
+
+                    # Save the rendered note once the whole text has arrived
+                    lecture_note = await run_db(store_note, course_id, topic_id, subtopic_id, ''.join(parts))
+        except Exception as e:
+            print(f"Error in stream_note: {str(e)}")
+            yield {'error': f'Error creating note: {str(e)}'}
+            return
+
+        yield {'html': lecture_note}
+
+    await send_sse(send, events())
+
+
+# The quiz and note generation routes already return straight away and leave
+# the model calls to the job queue, so only these hold a request open.
+ROUTES = [
+    (re.compile(r'^/chatbot$'), chatbot),
+    (re.compile(r'^/chatbot/stream$'), chatbot_stream),
+    (re.compile(r'^/get_ai_explanation$'), get_ai_explanation),
+    (re.compile(r'^/create_note/(\d+)/stream$'), stream_note)
+]
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['method'] == 'POST':
+        for pattern, handler in ROUTES:
+            match = pattern.match(scope['path'])
+            if match is None:
+                continue
+            body = await read_body(receive)
+            with app.app_context():
+                handled = await handler(scope, body, send, *match.groups())
+            if handled is False:
+                receive = replay(body, receive)
+            else:
+                return
+            break
+
+    await flask_application(scope, receive, send)
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, LLMCacheEntry
+
+
+def make_key(model_name, fingerprint, prompt):
+    """Content address of a model call: model, system instruction, config and prompt"""
+    payload = json.dumps([model_name, fingerprint, prompt], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe in-process LRU with a per-entry TTL"""
+
+    def __init__(self, max_size=1024, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResponseCache:
+    """Two-tier cache for model responses: in-process LRU in front of the llm_cache table"""
+
+    def __init__(self, max_size=1024, ttl=3600, persistent_ttl=7 * 24 * 3600, persistent=True):
+        self.memory = LRUCache(max_size=max_size, ttl=ttl)
+        self.persistent = persistent
+        self.persistent_ttl = persistent_ttl
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value
+
+        if self.persistent:
+            value = self._db_get(key)
+            if value is not None:
+                self.db_hits += 1
+                self.memory.set(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+    def set(self, key, model_name, value):
+        self.memory.set(key, value)
+        if self.persistent:
+            self._db_set(key, model_name, value)
+
+    def _db_get(self, key):
+        table = LLMCacheEntry.__table__
+        # Own connection so cache reads never touch the request's session
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                db.select(table.c.response, table.c.created_at).where(table.c.key == key)
+            ).first()
+        if row is None:
+            return None
+        if row.created_at < datetime.utcnow() - timedelta(seconds=self.persistent_ttl):
+            with db.engine.begin() as conn:
+                conn.execute(table.delete().where(table.c.key == key))
+            return None
+        return row.response
+
+    def _db_set(self, key, model_name, value):
+        table = LLMCacheEntry.__table__
+        values = {'model_name': model_name, 'response': value, 'created_at': datetime.utcnow()}
+        try:
+            with db.engine.begin() as conn:
+                updated = conn.execute(table.update().where(table.c.key == key).values(**values))
+                if updated.rowcount == 0:
+                    conn.execute(table.insert().values(key=key, **values))
+        except IntegrityError:
+            # Another worker stored the same response first
+            pass
+
+    def metrics(self):
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'hit_rate': round((self.memory_hits + self.db_hits) / lookups, 4) if lookups else 0,
+            'memory_size': len(self.memory)
+        }
@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict, deque
+
+from models import db, ChatHistory
+
+
+class ConversationContext:
+    """Recent turns of each conversation, kept in bounded in-memory rings.
+
+    A conversation is a (channel, user_id) pair. Rings are seeded from
+    ChatHistory on first use and afterwards only fetch rows newer than the
+    last one seen, so other workers' turns are picked up without rescanning
+    the table.
+    """
+
+    def __init__(self, app=None, max_turns=5, max_conversations=1000):
+        self.max_turns = max_turns
+        self.max_conversations = max_conversations
+        self.channels = ()
+        self._rings = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_turns = app.config['CHAT_CONTEXT_TURNS']
+        self.channels = app.config['CHAT_CONTEXT_MODELS']
+        app.extensions['conversation_context'] = self
+
+    def build_prompt(self, channel, user_id, prompt):
+        lines = [f"{sender.capitalize()}: {text}" for sender, text in self.recent_turns(channel, user_id)]
+        lines.append(f"User: {prompt}")
+        lines.append("AI:")
+        return "\n".join(lines)
+
+    def recent_turns(self, channel, user_id):
+        key = (channel, user_id)
+        with self._lock:
+            _, last_id = self._rings.get(key, (None, None))
+
+        query = ChatHistory.query.filter_by(channel=channel, user_id=user_id)
+        if last_id is not None:
+            query = query.filter(ChatHistory.id > last_id)
+        rows = query.order_by(ChatHistory.id.desc()).limit(self.max_turns).all()
+        rows.reverse()
+
+        with self._lock:
+            # Another thread may have refreshed this ring in the meantime
+            ring, last_id = self._rings.get(key, (deque(maxlen=self.max_turns), None))
+            for row in rows:
+                if last_id is None or row.id > last_id:
+                    ring.append((row.sender, row.text))
+                    last_id = row.id
+            self._rings[key] = (ring, last_id)
+            self._rings.move_to_end(key)
+            while len(self._rings) > self.max_conversations:
+                self._rings.popitem(last=False)
+            return list(ring)
+
+    def record(self, channel, user_id, prompt, reply, course_id=None):
+        """Persist one user/AI exchange; rings pick it up on their next refresh"""
+        db.session.add(ChatHistory(sender='user', text=prompt, channel=channel, user_id=user_id, course_id=course_id))
+        db.session.add(ChatHistory(sender='ai', text=reply, channel=channel, user_id=user_id, course_id=course_id))
+        db.session.commit()
+
+
+conversations = ConversationContext()
@@ -0,0 +1,51 @@
+from analytics import analytics
+from models import db, ChatHistory, CourseInfo, Course, Topic, Subtopic, Quiz, SubtopicQuiz, Note, QuizAttempt
+
+
+def course_subtopic_count(course_info_id):
+    """Size of a course tree, used to decide whether to delete it in the background"""
+    return (
+        db.session.query(db.func.count(Subtopic.id))
+        .join(Topic, Subtopic.topic_id == Topic.id)
+        .join(Course, Topic.course_id == Course.id)
+        .filter(Course.course_info_id == course_info_id)
+        .scalar()
+    )
+
+
+def delete_course_tree(course_info_id):
+    """Delete a course and everything generated for it in one transaction.
+
+    Every table is cleared with a single set-based DELETE over subqueries of
+    the course's ids, children first, so the number of statements does not
+    grow with the size of the course. Returns the deleted row counts by table.
+    """
+    course_ids = db.select(Course.id).where(Course.course_info_id == course_info_id)
+    topic_ids = db.select(Topic.id).where(Topic.course_id.in_(course_ids))
+    subtopic_ids = db.select(Subtopic.id).where(Subtopic.topic_id.in_(topic_ids))
+
+    steps = [
+        (QuizAttempt, QuizAttempt.topic_id.in_(topic_ids)),
+        (SubtopicQuiz, SubtopicQuiz.subtopic_id.in_(subtopic_ids)),
+        (Quiz, Quiz.topic_id.in_(topic_ids)),
+        (Note, Note.course_id.in_(course_ids)),
+        (Subtopic, Subtopic.topic_id.in_(topic_ids)),
+        (Topic, Topic.course_id.in_(course_ids)),
+        (Course, Course.course_info_id == course_info_id),
+        (ChatHistory, ChatHistory.course_id == course_info_id),
+        (CourseInfo, CourseInfo.id == course_info_id)
+    ]
+
+    deleted = {}
+    try:
+        for model, criterion in steps:
+            result = db.session.execute(model.__table__.delete().where(criterion))
+            deleted[model.__tablename__] = result.rowcount
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    # Rows deleted in bulk may still sit in the identity map
+    db.session.expire_all()
+    analytics.invalidate(rebuild=True)
+    return deleted
@@ -1,61 +1,45 @@
+import copy
+
 import google.generativeai as genai
 
-# Create the model
-generation_config = {
-  "temperature": 1,
-  "top_p": 0.95,
-  "top_k": 64,
-  "max_output_tokens": 8192,
-  "response_mime_type": "text/plain",
-}
+from parsing import SCHEMAS
 
 # Course Model
-model1 = genai.GenerativeModel(
-  model_name="gemini-1.5-pro",
-  generation_config=generation_config,
-  system_instruction='''
+COURSE_INSTRUCTION = '''
   Give all your responses in the custom JSON format I specified for the course information. 
   Do not add any information outside this format and return only the requested JSON object. 
   Answer the question about each course in the format below: 
   { 
-  “course_code": “<Type the course code in this field>”, 
-  “course_name": “<Type the name of the course in this field>”,
-  “description": “<Write a paragraph in this field describing the content and purpose of the course.” 
+  "course_code": "<Type the course code in this field>", 
+  "course_name": "<Type the name of the course in this field>",
+  "description": "<Write a paragraph in this field describing the content and purpose of the course." 
   }.  
   If the question is irrelevant to the course information, return an empty JSON object.
-  ''' 
-)
+  '''
 
 # Listing Model
-model2 = genai.GenerativeModel(
-  model_name="gemini-1.5-pro",
-  generation_config=generation_config,
-  system_instruction=''''Give all your answers in the special JSON format I have specified for the course information. 
+LISTING_INSTRUCTION = '''Give all your answers in the special JSON format I have specified for the course information. 
   Do not add any information outside this format and return only the requested JSON object. 
   Answer the question about each course in the format below:
     {
-    “course_code": “<Type course code here>”,
-    “course_name": “<Type course name here>”,
-    “topics": [
+    "course_code": "<Type course code here>",
+    "course_name": "<Type course name here>",
+    "topics": [
         {
-        “name": “<Type the main topic title here>”,
-        “subtopics": [
-            “<Subtopic 1>”,
-            “<Subtopic 2>”,
-            “<Subtopic 3>”,
-            “...”
+        "name": "<Type the main topic title here>",
+        "subtopics": [
+            "<Subtopic 1>",
+            "<Subtopic 2>",
+            "<Subtopic 3>",
+            "..."
         ]
         },
         ...
     ]
-    }''' 
-)
+    }'''
 
 # Quiz Model
-model3 = genai.GenerativeModel(
-  model_name="gemini-1.5-pro",
-    generation_config=generation_config,
-    system_instruction='''Generate quiz questions in the following JSON format only:
+QUIZ_INSTRUCTION = '''Generate quiz questions in the following JSON format only:
     {
         "questions": [
             {
@@ -75,14 +59,10 @@ model3 = genai.GenerativeModel(
     Make sure the correct answer is clearly marked with A, B, C, or D.
     Do not include any additional text or explanations outside the JSON structure.
     '''
-)
 
 
 # Normal Student Talk AI Model
-model4 = genai.GenerativeModel(
-  model_name="gemini-1.5-pro",
-  generation_config=generation_config,
-  system_instruction='''
+CHAT_INSTRUCTION = '''
   Your goal as an artificial intelligence to help university students with their studies, 
   students' course work, homework preparations, 
   To provide support for exam preparation processes and general academic success, 
@@ -111,14 +91,10 @@ model4 = genai.GenerativeModel(
   Identify areas where they do not understand or need more information and offer specific suggestions based on their progress. 
   When a student needs to study more on a particular lesson or topic, 
   contribute to his/her progress by suggesting additional resources and practical materials.
-  '''  
-)
+  '''
 
 # Lecture Note Model
-model5 = genai.GenerativeModel(
-  model_name="gemini-1.5-pro",
-  generation_config=generation_config,
-  system_instruction='''
+NOTE_INSTRUCTION = '''
   Pay attention to the following points when creating these lecture notes:
   
   1. Create separate lecture notes for the main topics and subtopics of the course. Write a detailed lecture note of at least 300-500 words for each topic/subtopic. 
@@ -132,13 +108,9 @@ model5 = genai.GenerativeModel(
   explain formulas, examples, exam focus. 
   Make lecture notes useful for students to prepare for exams.
   '''
-)
 
 # Explanation Model
-model6 = genai.GenerativeModel(
-  model_name="gemini-1.5-pro",
-  generation_config=generation_config,
-  system_instruction='''
+EXPLANATION_INSTRUCTION = '''
     You are an expert educational AI tutor. Your task is to provide clear, comprehensive explanations for quiz questions. Format your response as follows:
 
     # Question Explanation
@@ -157,4 +129,100 @@ model6 = genai.GenerativeModel(
 
     Format all text using Markdown. Use **bold** for emphasis on key terms. Include relevant formulas or equations if applicable. Maintain a professional, educational tone throughout. Avoid unnecessary jargon or overly technical language unless essential to the explanation. Your entire explanation should be thorough yet concise, focusing on clarity and understanding rather than length.
   '''
-  )
\ No newline at end of file
+
+# Batched Quiz Model
+QUIZ_BATCH_INSTRUCTION = '''Generate multiple choice quizzes for a topic and its subtopics as a single JSON document.
+    Write one section for each key requested, with exactly the requested number of questions.
+    Each question has exactly 4 options starting with "A) ", "B) ", "C) " and "D) ",
+    and the correct answer is marked with A, B, C, or D.
+    Generate challenging but fair questions that test understanding of the topic.
+    '''
+
+SYSTEM_INSTRUCTIONS = {
+  "course": COURSE_INSTRUCTION,
+  "listing": LISTING_INSTRUCTION,
+  "quiz": QUIZ_INSTRUCTION,
+  "quiz_batch": QUIZ_BATCH_INSTRUCTION,
+  "chat": CHAT_INSTRUCTION,
+  "note": NOTE_INSTRUCTION,
+  "explanation": EXPLANATION_INSTRUCTION,
+}
+
+# Generation settings by task. Tasks with a schema answer in native JSON
+# mode, constrained to the schema their answers are parsed with. The course
+# model only gets JSON mode, since it must be able to answer with {}.
+MODEL_CONFIGS = {
+  "course": {"model": "gemini-1.5-pro", "temperature": 0.2, "max_output_tokens": 1024, "json": True},
+  "listing": {"model": "gemini-1.5-pro", "temperature": 0.4, "max_output_tokens": 4096, "schema": "syllabus"},
+  "quiz": {"model": "gemini-1.5-pro", "temperature": 0.8, "max_output_tokens": 4096, "schema": "quiz"},
+  "quiz_batch": {"model": "gemini-1.5-pro", "temperature": 0.8, "max_output_tokens": 8192, "schema": "quiz_batch"},
+  "chat": {"model": "gemini-1.5-pro", "temperature": 0.9, "max_output_tokens": 2048},
+  "note": {"model": "gemini-1.5-pro", "temperature": 0.7, "max_output_tokens": 8192},
+  "explanation": {"model": "gemini-1.5-pro", "temperature": 0.4, "max_output_tokens": 2048},
+}
+
+CONFIG_KEYS = {"model", "temperature", "top_p", "top_k", "max_output_tokens", "json", "schema"}
+MAX_OUTPUT_TOKENS = 8192
+
+
+def model_configs(overrides=None):
+  """MODEL_CONFIGS with per-task overrides, e.g. {"quiz": {"temperature": 0.5}}"""
+  configs = {task: dict(config) for task, config in MODEL_CONFIGS.items()}
+  for task, override in (overrides or {}).items():
+    configs.setdefault(task, {}).update(override)
+  return configs
+
+
+def validate_model_configs(configs):
+  """List of problems with a model configuration, empty when it is usable"""
+  errors = []
+  for task in SYSTEM_INSTRUCTIONS:
+    if task not in configs:
+      errors.append(f"{task}: no configuration")
+  for task, config in configs.items():
+    if task not in SYSTEM_INSTRUCTIONS:
+      errors.append(f"{task}: unknown task")
+    unknown = set(config) - CONFIG_KEYS
+    if unknown:
+      errors.append(f"{task}: unknown settings {', '.join(sorted(unknown))}")
+    if not isinstance(config.get("model"), str) or not config.get("model"):
+      errors.append(f"{task}: model name is required")
+    temperature = config.get("temperature", 1)
+    if not isinstance(temperature, (int, float)) or not 0 <= temperature <= 2:
+      errors.append(f"{task}: temperature must be between 0 and 2")
+    top_p = config.get("top_p", 0.95)
+    if not isinstance(top_p, (int, float)) or not 0 < top_p <= 1:
+      errors.append(f"{task}: top_p must be between 0 and 1")
+    max_tokens = config.get("max_output_tokens")
+    if not isinstance(max_tokens, int) or not 0 < max_tokens <= MAX_OUTPUT_TOKENS:
+      errors.append(f"{task}: max_output_tokens must be between 1 and {MAX_OUTPUT_TOKENS}")
+    if config.get("schema") is not None and config["schema"] not in SCHEMAS:
+      errors.append(f"{task}: unknown schema {config['schema']}")
+  return errors
+
+
+def generation_config(config):
+  result = {
+    "temperature": config.get("temperature", 1),
+    "top_p": config.get("top_p", 0.95),
+    "top_k": config.get("top_k", 64),
+    "max_output_tokens": config["max_output_tokens"],
+    "response_mime_type": "text/plain",
+  }
+  if config.get("json") or config.get("schema"):
+    result["response_mime_type"] = "application/json"
+  if config.get("schema"):
+    result["response_schema"] = copy.deepcopy(SCHEMAS[config["schema"]])
+  return result
+
+
+def build_models(configs):
+  """Models by task, used by the LLM gateway"""
+  return {
+    task: genai.GenerativeModel(
+      model_name=config["model"],
+      generation_config=generation_config(config),
+      system_instruction=SYSTEM_INSTRUCTIONS[task]
+    )
+    for task, config in configs.items()
+  }
@@ -0,0 +1,520 @@
+import json
+import random
+
+from flask import current_app, has_request_context
+from flask_login import current_user
+
+from models import db, ChatHistory, CourseInfo, Course, Topic, Subtopic, Quiz, SubtopicQuiz, Note
+from llm import gateway
+from context import conversations
+from rendering import renderer
+from parsing import ParseError, parse_json, is_valid
+from grading import QUIZ_TABLES
+from jobs import jobs
+from singleflight import single_flight
+from search import queue_index_update
+from retrieval import retriever
+from semantic_cache import semantic_cache, course_code
+
+
+# AI section
+
+def generate_text(prompt, model, refresh=False):
+    # Only conversational models need the recent turns of the user's conversation
+    if model in conversations.channels:
+        prompt = conversations.build_prompt(model, current_user_id(), prompt)
+
+    return gateway.generate(model, prompt, refresh=refresh)
+
+
+def stream_text(prompt, model):
+    """Streaming variant of generate_text, yields the answer in chunks"""
+    if model in conversations.channels:
+        prompt = conversations.build_prompt(model, current_user_id(), prompt)
+
+    return gateway.stream(model, prompt)
+
+
+def course_answer(question):
+    """Answer of the course model to a course question on the dashboard.
+
+    A course code that is already in the course table is answered from it,
+    then near-duplicates of earlier questions from the semantic cache; only
+    the rest reach the model.
+    """
+    code = course_code(question)
+    if code is not None:
+        normalized_code = db.func.upper(db.func.replace(db.func.replace(CourseInfo.course_code, ' ', ''), '-', ''))
+        course_info = CourseInfo.query.filter(normalized_code == code).first()
+        if course_info is not None:
+            semantic_cache.record_exact_hit()
+            return json.dumps({
+                'course_code': course_info.course_code,
+                'course_name': course_info.course_name,
+                'description': course_info.description
+            }, ensure_ascii=False)
+
+    answer = semantic_cache.get('course', question)
+    if answer is not None:
+        return answer
+    answer = generate_text(question, model='course')
+    # Only answers that describe a course are worth repeating
+    try:
+        parse_json(answer, 'course')
+    except ParseError:
+        return answer
+    semantic_cache.put('course', question, answer)
+    return answer
+
+
+def chat_prompt(user_id, user_message):
+    """(prompt, None) for the chat model, grounded in the student's notes and
+    quizzes, or (None, answer) when the student's earlier answer to the same
+    question or a stored note answers the message by itself"""
+    # Replies were generated with the asker's conversation, so they are only reused for the same user
+    answer = semantic_cache.get('chat', user_message, scope=user_id)
+    if answer is not None:
+        return None, answer
+    selected = retriever.retrieve(user_message)
+    answer = retriever.fast_answer(user_message, selected)
+    retriever.record(selected, fast_path=answer is not None)
+    if answer is not None:
+        return None, answer
+    conversation = conversations.build_prompt('chat', user_id, user_message)
+    return retriever.grounded_prompt(selected, conversation), None
+
+
+def record_chat(user_id, user_message, reply, prompt):
+    """Persist a chat exchange; replies of the model (prompt is not None) are cached for similar questions"""
+    conversations.record('chat', user_id, user_message, reply)
+    if prompt is not None:
+        semantic_cache.put('chat', user_message, reply, scope=user_id)
+
+
+def current_user_id():
+    # Background jobs run without a request, and so without a user
+    if not has_request_context():
+        return None
+    user_id = current_user.get_id()
+    return int(user_id) if user_id else None
+
+
+def process_and_randomize_quiz(questions_data):
+    """Helper function to process quiz data and randomize answers"""
+    if not questions_data or 'questions' not in questions_data:
+        return None
+
+    for question in questions_data['questions']:
+        # Get the correct answer's content
+        correct_option = question['options'][ord(question['correct']) - ord('A')]
+
+        # Randomly shuffle the options
+        random.shuffle(question['options'])
+
+        # Find the new position of the correct answer
+        for i, option in enumerate(question['options']):
+            if option == correct_option:
+                question['correct'] = chr(ord('A') + i)
+                break
+
+    return questions_data
+
+
+# Generators used by the routes and the background job queue.
+# Each one stores its result and returns the id of what it created.
+# They run under single_flight and look for an existing result once they
+# hold it, so concurrent requests for the same item generate it only once.
+
+def build_course(course_info_id):
+    """Generate the syllabus of a course and save its topic/subtopic tree"""
+    with single_flight.hold(('course', course_info_id)):
+        existing_course = Course.query.filter_by(course_info_id=course_info_id).first()
+        if existing_course:
+            return existing_course.id
+        return _build_course(course_info_id)
+
+
+def _build_course(course_info_id):
+
+    # Use the latest AI message text to generate data
+    ai_message = ChatHistory.query.filter_by(course_id=course_info_id, sender='ai').order_by(ChatHistory.id.desc()).first()
+    if ai_message is None:
+        raise ValueError('No AI messages found for this course')
+    raw_data = parse_json(ai_message.text, 'course')
+
+    data = generate_text(json.dumps(raw_data, ensure_ascii=False), model='listing')
+    data = parse_json(data, 'syllabus')
+
+    # Create a new Course object
+    course = Course(course_name=data['course_name'], course_code=data['course_code'], course_info_id=course_info_id)
+
+    # Add topics and subtopics
+    for topic_data in data['topics']:
+        topic = Topic(topic_name=topic_data['name'])
+        for subtopic_name in topic_data['subtopics']:
+            subtopic = Subtopic(subtopic_name=subtopic_name)
+            topic.subtopics.append(subtopic)
+
+        course.topics.append(topic)
+
+    db.session.add(course)
+    db.session.commit()
+    return course.id
+
+
+def quiz_prompt(subject, count, focus):
+    return f"""Create {count} multiple choice questions in JSON format about {subject}.
+        {focus}
+        Each question should have 4 options (A, B, C, D) and indicate the correct answer.
+
+        The response should be in this exact JSON format:
+        {{
+            "questions": [
+                {{
+                    "question": "What is...",
+                    "options": [
+                        "A) First option",
+                        "B) Second option",
+                        "C) Third option",
+                        "D) Fourth option"
+                    ],
+                    "correct": "A"
+                }},
+                ...
+            ]
+        }}"""
+
+
+def generate_questions(subject, count, focus, refresh=False):
+    """Ask the quiz model for questions, retrying once with a simpler prompt"""
+    response = generate_text(quiz_prompt(subject, count, focus), model='quiz', refresh=refresh)
+    try:
+        questions_data = parse_json(response, 'quiz')
+    except ParseError as e:
+        # Only answers that cannot be repaired cost a second call with a simpler prompt
+        print(f"Quiz answer for {subject} could not be parsed: {e}")
+        fallback_prompt = f"""Create {count} basic multiple choice questions about {subject}.
+        Focus only on fundamental concepts. Return in JSON format with question, options, and correct answer."""
+
+        response = generate_text(fallback_prompt, model='quiz', refresh=refresh)
+        try:
+            questions_data = parse_json(response, 'quiz')
+        except ParseError:
+            raise ValueError('Unable to generate quiz questions')
+
+    # Randomize the answers
+    return process_and_randomize_quiz(questions_data)['questions']
+
+
+def save_topic_quiz(topic_id, questions):
+    # Delete any existing quiz
+    Quiz.query.filter_by(topic_id=topic_id).delete()
+
+    for q_data in questions:
+        db.session.add(Quiz(
+            topic_id=topic_id,
+            question=q_data['question'],
+            option_a=q_data['options'][0][3:],
+            option_b=q_data['options'][1][3:],
+            option_c=q_data['options'][2][3:],
+            option_d=q_data['options'][3][3:],
+            correct_answer=q_data['correct']
+        ))
+
+
+def save_subtopic_quiz(subtopic_id, questions):
+    # Delete existing quiz if it exists
+    SubtopicQuiz.query.filter_by(subtopic_id=subtopic_id).delete()
+
+    for q_data in questions:
+        db.session.add(SubtopicQuiz(
+            subtopic_id=subtopic_id,
+            question=q_data['question'],
+            option_a=q_data['options'][0][3:],
+            option_b=q_data['options'][1][3:],
+            option_c=q_data['options'][2][3:],
+            option_d=q_data['options'][3][3:],
+            correct_answer=q_data['correct']
+        ))
+
+
+def build_topic_quiz(topic_id, refresh=False):
+    with single_flight.hold(('topic_quiz', topic_id)):
+        # refresh only bypasses the response cache, a recreated quiz is deleted first
+        if Quiz.query.filter_by(topic_id=topic_id).first():
+            return topic_id
+        return _build_topic_quiz(topic_id, refresh)
+
+
+def _build_topic_quiz(topic_id, refresh):
+    topic = Topic.query.get(topic_id)
+    if topic is None:
+        raise ValueError('Topic not found')
+
+    questions = generate_questions(
+        topic.topic_name, 10,
+        focus="Focus on fundamental concepts and general understanding.",
+        refresh=refresh
+    )
+    save_topic_quiz(topic_id, questions)
+    db.session.commit()
+    queue_explanations('topic', topic_id)
+    queue_index_update()
+    return topic_id
+
+
+def build_subtopic_quiz(subtopic_id, refresh=False):
+    with single_flight.hold(('subtopic_quiz', subtopic_id)):
+        if SubtopicQuiz.query.filter_by(subtopic_id=subtopic_id).first():
+            return subtopic_id
+        return _build_subtopic_quiz(subtopic_id, refresh)
+
+
+def _build_subtopic_quiz(subtopic_id, refresh):
+    subtopic = Subtopic.query.get(subtopic_id)
+    if subtopic is None:
+        raise ValueError('Subtopic not found')
+
+    questions = generate_questions(
+        subtopic.subtopic_name, 5,
+        focus="Focus on testing understanding of basic concepts related to this specific subtopic.",
+        refresh=refresh
+    )
+    save_subtopic_quiz(subtopic_id, questions)
+    db.session.commit()
+    queue_explanations('subtopic', subtopic_id)
+    queue_index_update()
+    return subtopic_id
+
+
+def batch_quiz_prompt(topic, subtopics, include_topic):
+    sections = []
+    if include_topic:
+        sections.append(f'- key "topic": 10 questions about {topic.topic_name}')
+    for subtopic in subtopics:
+        sections.append(f'- key "subtopic_{subtopic.id}": 5 questions about {subtopic.subtopic_name}')
+    sections = "\n".join(sections)
+
+    return f"""Create multiple choice quizzes for the topic {topic.topic_name} and its subtopics in a single JSON document.
+        Write one section for each line below, using exactly the given key and number of questions:
+{sections}
+        Focus on fundamental concepts and general understanding.
+        Each question should have 4 options (A, B, C, D) and indicate the correct answer.
+
+        The response should be in this exact JSON format:
+        {{
+            "sections": [
+                {{
+                    "key": "topic",
+                    "questions": [
+                        {{
+                            "question": "What is...",
+                            "options": [
+                                "A) First option",
+                                "B) Second option",
+                                "C) Third option",
+                                "D) Fourth option"
+                            ],
+                            "correct": "A"
+                        }},
+                        ...
+                    ]
+                }},
+                ...
+            ]
+        }}"""
+
+
+def build_topic_quizzes(topic_id, subtopic_ids=None, include_topic=True, refresh=False):
+    """Generate a topic's quiz and its subtopics' quizzes with a single model call.
+
+    Sections missing from the answer or failing validation fall back to the
+    one-quiz-per-call generators. subtopic_ids defaults to all subtopics.
+    Quizzes that already exist are kept.
+    """
+    topic = Topic.query.get(topic_id)
+    if topic is None:
+        raise ValueError('Topic not found')
+    subtopics = [s for s in topic.subtopics if subtopic_ids is None or s.id in subtopic_ids]
+
+    keys = [('subtopic_quiz', subtopic.id) for subtopic in subtopics]
+    if include_topic:
+        keys.append(('topic_quiz', topic.id))
+    with single_flight.hold(*keys):
+        include_topic = include_topic and not Quiz.query.filter_by(topic_id=topic.id).first()
+        existing = {
+            row.subtopic_id for row in db.session.query(SubtopicQuiz.subtopic_id)
+            .filter(SubtopicQuiz.subtopic_id.in_([subtopic.id for subtopic in subtopics])).distinct()
+        } if subtopics else set()
+        subtopics = [subtopic for subtopic in subtopics if subtopic.id not in existing]
+        if not include_topic and not subtopics:
+            return {'batched': 0, 'fallback': 0}
+        return _build_topic_quizzes(topic, subtopics, include_topic, refresh)
+
+
+def _build_topic_quizzes(topic, subtopics, include_topic, refresh):
+    response = generate_text(batch_quiz_prompt(topic, subtopics, include_topic), model='quiz_batch', refresh=refresh)
+    # Sections are validated one by one, so a bad section only falls back by itself
+    sections = {}
+    try:
+        data = parse_json(response)
+    except ParseError as e:
+        print(f"Batched quiz answer for topic {topic.id} could not be parsed: {e}")
+        data = {}
+    if isinstance(data, dict) and isinstance(data.get('sections'), list):
+        sections = {
+            section.get('key'): section.get('questions')
+            for section in data['sections'] if isinstance(section, dict)
+        }
+
+    fallback, saved = [], []
+    if include_topic:
+        questions = sections.get('topic')
+        if is_valid(questions, 'questions'):
+            save_topic_quiz(topic.id, process_and_randomize_quiz({'questions': questions})['questions'])
+            saved.append(('topic', topic.id))
+        else:
+            fallback.append((build_topic_quiz, topic.id))
+    for subtopic in subtopics:
+        questions = sections.get(f'subtopic_{subtopic.id}')
+        if is_valid(questions, 'questions'):
+            save_subtopic_quiz(subtopic.id, process_and_randomize_quiz({'questions': questions})['questions'])
+            saved.append(('subtopic', subtopic.id))
+        else:
+            fallback.append((build_subtopic_quiz, subtopic.id))
+    db.session.commit()
+
+    for quiz_type, quiz_id in saved:
+        queue_explanations(quiz_type, quiz_id)
+    if saved:
+        queue_index_update()
+
+    for build, item_id in fallback:
+        build(item_id, refresh=refresh)
+
+    batched = int(include_topic) + len(subtopics) - len(fallback)
+    return {'batched': batched, 'fallback': len(fallback)}
+
+
+def explanation_prompt(question):
+    """Prompt for the explanation model from a stored question"""
+    # Simple prompt that lets Gemini use its system instruction
+    return f'''Question: {question.question}
+        
+Correct Answer: {question.correct_answer}
+
+Options:
+A) {question.option_a}
+B) {question.option_b}
+C) {question.option_c}
+D) {question.option_d}'''
+
+
+def format_explanation(raw_explanation):
+    # Convert markdown to HTML
+    safe_html = renderer.render(raw_explanation)
+
+    return f'''
+        <div class="explanation-wrapper">
+            <div class="explanation-content">
+                {safe_html}
+            </div>
+        </div>
+        '''
+
+
+def find_explanation(quiz_type, question_id):
+    """Stored explanation HTML of a question, or the prompt to generate it with.
+
+    Returns (explanation, prompt); exactly one of them is None.
+    """
+    model = QUIZ_TABLES[quiz_type][0]
+    question = model.query.get(question_id)
+    if question is None:
+        raise ValueError('Question not found')
+    if question.explanation:
+        return question.explanation, None
+    return None, explanation_prompt(question)
+
+
+def save_explanation(quiz_type, question_id, raw_explanation):
+    """Store a generated explanation unless one was stored meanwhile; returns the stored HTML"""
+    table = QUIZ_TABLES[quiz_type][0].__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.id == question_id, table.c.explanation.is_(None))
+        .values(explanation=format_explanation(raw_explanation), explanation_source=raw_explanation)
+    )
+    db.session.commit()
+    return db.session.execute(db.select(table.c.explanation).where(table.c.id == question_id)).scalar()
+
+
+def build_explanation(quiz_type, question_id):
+    """Explanation of a question, generated on first use and served from the database afterwards"""
+    explanation, prompt = find_explanation(quiz_type, question_id)
+    if explanation is not None:
+        return explanation
+    return save_explanation(quiz_type, question_id, generate_text(prompt, model='explanation'))
+
+
+def build_explanations(quiz_type, quiz_id):
+    """Generate the missing explanations of every question of a quiz"""
+    model, quiz_column = QUIZ_TABLES[quiz_type]
+    question_ids = [
+        row.id for row in
+        db.session.query(model.id).filter(quiz_column == quiz_id, model.explanation.is_(None)).order_by(model.id)
+    ]
+    for question_id in question_ids:
+        build_explanation(quiz_type, question_id)
+    return len(question_ids)
+
+
+def queue_explanations(quiz_type, quiz_id):
+    # Explanations of new quizzes are pre-generated in the background when enabled
+    if current_app.config['QUIZ_EXPLANATIONS_EAGER']:
+        jobs.submit(('explanations', quiz_type, quiz_id), build_explanations, quiz_type, quiz_id)
+
+
+def note_prompt(topic_name, subtopic_name):
+    return f"{topic_name} - {subtopic_name} hakkında ders notu istiyorum."
+
+
+def build_note(course_id, topic_id, subtopic_id):
+    with single_flight.hold(('note', subtopic_id)):
+        # Check if the note already exists
+        existing_note = Note.query.filter_by(course_id=course_id, topic_id=topic_id, subtopic_id=subtopic_id).first()
+        if existing_note:
+            return existing_note.id
+        return _build_note(course_id, topic_id, subtopic_id)
+
+
+def _build_note(course_id, topic_id, subtopic_id):
+    topic = Topic.query.get(topic_id)
+    subtopic = Subtopic.query.get(subtopic_id)
+    lecture_note = generate_text(note_prompt(topic.topic_name, subtopic.subtopic_name), model='note')
+    return save_note(course_id, topic_id, subtopic_id, lecture_note).id
+
+
+def save_note(course_id, topic_id, subtopic_id, source, held=False):
+    """Save a generated note as markdown and as rendered HTML, unless one was saved first.
+
+    held tells that the caller already holds the note's single_flight lock
+    on another thread, as the ASGI note stream does. Returns the stored Note.
+    """
+    if not held:
+        with single_flight.hold(('note', subtopic_id)):
+            return save_note(course_id, topic_id, subtopic_id, source, held=True)
+
+    note = Note.query.filter_by(course_id=course_id, topic_id=topic_id, subtopic_id=subtopic_id).first()
+    if note is None:
+        note = Note(
+            content=renderer.render(source),
+            source=source,
+            course_id=course_id,
+            topic_id=topic_id,
+            subtopic_id=subtopic_id
+        )
+        db.session.add(note)
+        db.session.commit()
+        queue_index_update()
+    return note
@@ -0,0 +1,41 @@
+from models import Quiz, SubtopicQuiz
+
+# Question table and the column linking it to its quiz, by quiz type
+QUIZ_TABLES = {
+    'topic': (Quiz, Quiz.topic_id),
+    'subtopic': (SubtopicQuiz, SubtopicQuiz.subtopic_id)
+}
+
+
+def parse_answers(form):
+    """Chosen answer letters of a submitted quiz form, by question id"""
+    answers = {}
+    for key, value in form.items():
+        if key.startswith('question_'):
+            question_id = key.replace('question_', '')
+            if question_id.isdigit():
+                answers[int(question_id)] = value
+    return answers
+
+
+def grade_quiz(quiz_type, quiz_id, answers):
+    """Grade a whole submission against the stored answer key.
+
+    All questions of the quiz are loaded in one query; unanswered questions
+    count as wrong and answers to questions of other quizzes are ignored.
+    """
+    model, quiz_column = QUIZ_TABLES[quiz_type]
+    questions = model.query.filter(quiz_column == quiz_id).order_by(model.id).all()
+
+    results = []
+    for question in questions:
+        selected = answers.get(question.id)
+        results.append({
+            'question_id': question.id,
+            'selected': selected,
+            'correct_answer': question.correct_answer,
+            'is_correct': selected == question.correct_answer
+        })
+
+    correct = sum(1 for result in results if result['is_correct'])
+    return {'correct': correct, 'total': len(results), 'results': results}
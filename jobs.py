@@ -0,0 +1,184 @@
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from models import db, BackgroundJob
+
+
+class Job:
+    def __init__(self, key, success_url=None, failure_url=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = 'queued'  # queued, running, finished or failed
+        self.result = None
+        self.error = None
+        self.progress = None
+        self.success_url = success_url
+        self.failure_url = failure_url
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def done(self):
+        return self.status in ('finished', 'failed')
+
+    @property
+    def tracked(self):
+        # Jobs with redirects are polled by the browser, possibly through another worker
+        return self.success_url is not None or self.failure_url is not None
+
+    @classmethod
+    def from_row(cls, row):
+        job = cls((row.kind,), success_url=row.success_url, failure_url=row.failure_url)
+        job.id = row.id
+        job.status = row.status
+        job.result = json.loads(row.result) if row.result else None
+        job.error = row.error
+        job.progress = json.loads(row.progress) if row.progress else None
+        return job
+
+    def as_dict(self):
+        redirect = None
+        if self.status == 'finished':
+            redirect = self.success_url
+        elif self.status == 'failed':
+            redirect = self.failure_url
+        return {
+            'id': self.id,
+            'kind': self.key[0],
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'progress': self.progress,
+            'redirect': redirect
+        }
+
+
+class JobQueue:
+    """Runs generation work on a thread pool so requests can return immediately.
+
+    Jobs are de-duplicated by key: submitting a key that is still queued or
+    running returns the existing job instead of starting a second one.
+
+    Jobs the browser polls (those with redirect URLs) are also written to
+    the background_job table, so /jobs/<id> answers on every worker process,
+    not only on the one running the job. Internal jobs, like search index
+    and analytics refreshes, stay in memory.
+    """
+    purge_every = 100
+
+    def __init__(self, app=None):
+        self.app = None
+        self.executor = None
+        self.max_jobs = 1000
+        self.retention = 24 * 3600
+        self._jobs = OrderedDict()
+        self._active = {}
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix='job')
+        self.max_jobs = app.config['JOB_HISTORY_SIZE']
+        self.retention = app.config['JOB_RETENTION']
+        app.extensions['job_queue'] = self
+
+    def submit(self, key, func, *args, success_url=None, failure_url=None):
+        with self._lock:
+            job_id = self._active.get(key)
+            if job_id is not None:
+                return self._jobs[job_id]
+
+            job = Job(key, success_url=success_url, failure_url=failure_url)
+            self._jobs[job.id] = job
+            self._active[key] = job.id
+            # Forget the oldest finished jobs
+            while len(self._jobs) > self.max_jobs:
+                oldest_id, oldest = next(iter(self._jobs.items()))
+                if not oldest.done:
+                    break
+                del self._jobs[oldest_id]
+
+        self._save(job, new=True)
+        self.executor.submit(self._run, job, func, args)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        # Submitted through another worker
+        table = BackgroundJob.__table__
+        with db.engine.connect() as conn:
+            row = conn.execute(table.select().where(table.c.id == job_id)).first()
+        return Job.from_row(row) if row else None
+
+    def report_progress(self, done, total, failed=0):
+        """Called from inside a job to publish how far it has got"""
+        job = getattr(self._local, 'job', None)
+        if job is not None:
+            job.progress = {'done': done, 'total': total, 'failed': failed}
+            self._save(job)
+
+    def _save(self, job, new=False):
+        if not job.tracked:
+            return
+        table = BackgroundJob.__table__
+        values = {
+            'status': job.status,
+            'result': json.dumps(job.result, default=str) if job.result is not None else None,
+            'error': job.error,
+            'progress': json.dumps(job.progress) if job.progress is not None else None
+        }
+        try:
+            # Own connection, so a job's status never commits or rolls back the job's session
+            with db.engine.begin() as conn:
+                if new:
+                    conn.execute(table.insert().values(
+                        id=job.id, kind=job.key[0], success_url=job.success_url, failure_url=job.failure_url,
+                        created_at=datetime.utcnow(), **values
+                    ))
+                    self._writes += 1
+                    # Old jobs are swept now and then instead of on every submit
+                    if self._writes % self.purge_every == 0:
+                        conn.execute(table.delete().where(
+                            table.c.created_at < datetime.utcnow() - timedelta(seconds=self.retention)
+                        ))
+                else:
+                    conn.execute(table.update().where(table.c.id == job.id).values(**values))
+        except Exception as e:
+            # The job itself goes on; only other workers cannot report it
+            print(f"Error in job status {job.key}: {str(e)}")
+
+    def _run(self, job, func, args):
+        self._local.job = job
+        with self.app.app_context():
+            job.status = 'running'
+            self._save(job)
+            try:
+                job.result = func(*args)
+                job.status = 'finished'
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error in job {job.key}: {str(e)}")
+                job.error = str(e)
+                job.status = 'failed'
+            finally:
+                db.session.remove()
+                job.finished_at = time.time()
+                self._save(job)
+                self._local.job = None
+                with self._lock:
+                    self._active.pop(job.key, None)
+
+
+jobs = JobQueue()
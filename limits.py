@@ -0,0 +1,242 @@
+import asyncio
+import random
+import threading
+import time
+
+
+class ModelUnavailableError(RuntimeError):
+    """The model call was not attempted: quota, queue or circuit breaker"""
+
+
+class RateLimitExceeded(ModelUnavailableError):
+    pass
+
+
+class CircuitOpenError(ModelUnavailableError):
+    pass
+
+
+# Error types of google.api_core and the standard library worth another try
+RETRIABLE_ERRORS = {
+    'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'InternalServerError',
+    'DeadlineExceeded', 'GatewayTimeout', 'TimeoutError', 'ConnectionError'
+}
+RETRIABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def status_code(error):
+    """HTTP status of an API error: google.api_core's code, or that of the response it carries"""
+    response = getattr(error, 'response', None)
+    for code in (getattr(error, 'code', None), getattr(error, 'status_code', None), getattr(response, 'status_code', None)):
+        if isinstance(code, int) and not isinstance(code, bool):
+            return code
+    return None
+
+
+def is_retriable(error):
+    if isinstance(error, ModelUnavailableError):
+        return False
+    if any(cls.__name__ in RETRIABLE_ERRORS for cls in type(error).__mro__):
+        return True
+    return status_code(error) in RETRIABLE_STATUS_CODES
+
+
+def is_rate_limited(error):
+    # google.api_core raises ResourceExhausted for HTTP 429 quota errors
+    return type(error).__name__ == 'ResourceExhausted' or status_code(error) == 429
+
+
+def retry_delay(attempt, base=1.0, cap=30.0):
+    """Exponential backoff with full jitter, so retries of a burst spread out"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at rate_per_minute.
+
+    reserve() takes tokens even when the bucket runs into debt and returns
+    how long the caller has to wait for them, so waiting callers are served
+    in the order they arrived.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, max_wait=None):
+        """Take amount tokens; returns the seconds to wait, or None if that exceeds max_wait"""
+        with self._lock:
+            self._refill()
+            delay = max(0.0, (amount - self.tokens) / self.rate)
+            if max_wait is not None and delay > max_wait:
+                return None
+            self.tokens -= amount
+            return delay
+
+    def adjust(self, amount):
+        """Take (or give back, when negative) tokens once the real cost is known"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class RateLimiter:
+    """Requests and tokens per minute for each provider model"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute, overrides=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.overrides = overrides or {}
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def _buckets(self, model):
+        with self._lock:
+            if model not in self.buckets:
+                limits = self.overrides.get(model, {})
+                rpm = limits.get('rpm', self.requests_per_minute)
+                tpm = limits.get('tpm', self.tokens_per_minute)
+                self.buckets[model] = (TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None)
+            return self.buckets[model]
+
+    def reserve(self, model, tokens, max_wait):
+        """Seconds to wait before calling model; raises RateLimitExceeded past max_wait"""
+        requests, token_bucket = self._buckets(model)
+        delay = 0.0
+        if requests is not None:
+            delay = requests.reserve(1, max_wait)
+            if delay is None:
+                raise RateLimitExceeded(f'Request quota of {model} exhausted, try again shortly')
+        if token_bucket is not None:
+            token_delay = token_bucket.reserve(tokens, max_wait)
+            if token_delay is None:
+                if requests is not None:
+                    requests.adjust(-1)
+                raise RateLimitExceeded(f'Token quota of {model} exhausted, try again shortly')
+            delay = max(delay, token_delay)
+        return delay
+
+    def adjust(self, model, tokens):
+        token_bucket = self._buckets(model)[1]
+        if token_bucket is not None and tokens:
+            token_bucket.adjust(tokens)
+
+    def release(self, model, tokens):
+        """Give back a reservation whose call never happened"""
+        requests, token_bucket = self._buckets(model)
+        if requests is not None:
+            requests.adjust(-1)
+        if token_bucket is not None:
+            token_bucket.adjust(-tokens)
+
+
+class InflightLimiter:
+    """Caps the model calls running at once; callers past the cap queue up to timeout"""
+
+    def __init__(self, limit, timeout=30.0):
+        self.limit = limit
+        self.timeout = timeout
+        self.active = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def try_acquire(self):
+        with self._condition:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            return True
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            while self.active >= self.limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    raise RateLimitExceeded('Too many model calls in progress, try again shortly')
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    async def aacquire(self):
+        # Threads and coroutines share the count, so the event loop polls instead of blocking
+        deadline = time.monotonic() + self.timeout
+        delay = 0.01
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                raise RateLimitExceeded('Too many model calls in progress, try again shortly')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class CircuitBreaker:
+    """Fails fast once the backend keeps failing.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    are rejected for reset_timeout seconds; then a single trial call is let
+    through, and its outcome closes or reopens the circuit. Only the caller
+    that before_call() admitted as the trial passes trial=True when it
+    reports the outcome, so other callers cannot end the trial early.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def before_call(self):
+        """Raises CircuitOpenError while the circuit is open; returns whether the caller makes the trial call"""
+        with self._lock:
+            state = self.state
+            if state == 'open' or (state == 'half-open' and self.trial_running):
+                raise CircuitOpenError('The model service is unavailable, try again later')
+            if state == 'half-open':
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self, trial=False):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            if trial:
+                self.trial_running = False
+
+    def record_failure(self, trial=False):
+        with self._lock:
+            self.failures += 1
+            if trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            if trial:
+                self.trial_running = False
+
+    def record_ignored(self, trial=False):
+        # Errors that say nothing about the backend's health, e.g. a rejected prompt,
+        # or a trial call that never reached the backend: the next caller gets the trial
+        if trial:
+            with self._lock:
+                self.trial_running = False
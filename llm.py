@@ -0,0 +1,592 @@
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+
+from cache import ResponseCache, make_key
+from limits import (
+    CircuitBreaker, CircuitOpenError, InflightLimiter, ModelUnavailableError, RateLimiter, is_retriable, retry_delay
+)
+
+
+class LLMResult:
+    """Text returned by a backend together with its token usage"""
+
+    def __init__(self, text, prompt_tokens=0, output_tokens=0):
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+
+
+class LLMBackend:
+    """Base class for the model backends used by the gateway"""
+    name = None
+
+    def generate(self, model_name, prompt):
+        raise NotImplementedError
+
+    def stream(self, model_name, prompt):
+        """Yield the answer as LLMResult chunks; the last one carries token usage"""
+        yield self.generate(model_name, prompt)
+
+    async def agenerate(self, model_name, prompt):
+        """Async variant of generate; backends without an async client use a thread"""
+        return await asyncio.to_thread(self.generate, model_name, prompt)
+
+    async def astream(self, model_name, prompt):
+        yield await self.agenerate(model_name, prompt)
+
+    def fingerprint(self, model_name):
+        """Everything besides the prompt that changes a model's output"""
+        return self.name
+
+
+class GeminiBackend(LLMBackend):
+    name = 'gemini'
+
+    def __init__(self, api_key, model_configs, timeout=None):
+        import google.generativeai as genai
+        from gemini import build_models
+
+        genai.configure(api_key=api_key)
+        self.models = build_models(model_configs)
+        self.request_options = {'timeout': timeout} if timeout else {}
+
+    def generate(self, model_name, prompt):
+        response = self.models[model_name].generate_content(prompt, request_options=self.request_options)
+        return self._result(response.text, response)
+
+    def stream(self, model_name, prompt):
+        response = self.models[model_name].generate_content(prompt, stream=True, request_options=self.request_options)
+        for chunk in response:
+            yield LLMResult(chunk.text)
+        yield self._result('', response)
+
+    async def agenerate(self, model_name, prompt):
+        response = await self.models[model_name].generate_content_async(prompt, request_options=self.request_options)
+        return self._result(response.text, response)
+
+    async def astream(self, model_name, prompt):
+        response = await self.models[model_name].generate_content_async(prompt, stream=True, request_options=self.request_options)
+        async for chunk in response:
+            yield LLMResult(chunk.text)
+        yield self._result('', response)
+
+    def _result(self, text, response):
+        usage = getattr(response, 'usage_metadata', None)
+        return LLMResult(
+            text,
+            prompt_tokens=getattr(usage, 'prompt_token_count', 0) or 0,
+            output_tokens=getattr(usage, 'candidates_token_count', 0) or 0
+        )
+
+    def fingerprint(self, model_name):
+        model = self.models[model_name]
+        instruction = str(model._system_instruction or '')
+        return json.dumps({
+            'model': model.model_name,
+            'system_instruction': hashlib.sha256(instruction.encode('utf-8')).hexdigest(),
+            'generation_config': model._generation_config
+        }, sort_keys=True, default=str)
+
+
+class LocalBackend(LLMBackend):
+    """Deterministic stand-in for Gemini, used for benchmarks and load tests"""
+    name = 'local'
+
+    def __init__(self, latency=0):
+        self.latency = latency
+
+    def generate(self, model_name, prompt):
+        if self.latency:
+            time.sleep(self.latency)
+        text = getattr(self, f'_{model_name}')(prompt)
+        return LLMResult(text, prompt_tokens=estimate_tokens(prompt), output_tokens=estimate_tokens(text))
+
+    def stream(self, model_name, prompt):
+        text = getattr(self, f'_{model_name}')(prompt)
+        words = text.split(' ')
+        for i, word in enumerate(words):
+            if self.latency:
+                time.sleep(self.latency / len(words))
+            yield LLMResult(word if i == len(words) - 1 else word + ' ')
+        yield LLMResult('', prompt_tokens=estimate_tokens(prompt), output_tokens=estimate_tokens(text))
+
+    async def agenerate(self, model_name, prompt):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        text = getattr(self, f'_{model_name}')(prompt)
+        return LLMResult(text, prompt_tokens=estimate_tokens(prompt), output_tokens=estimate_tokens(text))
+
+    async def astream(self, model_name, prompt):
+        text = getattr(self, f'_{model_name}')(prompt)
+        words = text.split(' ')
+        for i, word in enumerate(words):
+            if self.latency:
+                await asyncio.sleep(self.latency / len(words))
+            yield LLMResult(word if i == len(words) - 1 else word + ' ')
+        yield LLMResult('', prompt_tokens=estimate_tokens(prompt), output_tokens=estimate_tokens(text))
+
+    def _course(self, prompt):
+        matches = re.findall(r'\b([A-Za-z]{2,4})\s?(\d{3})\b', prompt)
+        if not matches:
+            return '{}'
+        code = f"{matches[-1][0].upper()}{matches[-1][1]}"
+        return json.dumps({
+            "course_code": code,
+            "course_name": f"Introduction to {code}",
+            "description": f"{code} covers the fundamental concepts of the subject and prepares students for advanced courses."
+        })
+
+    def _listing(self, prompt):
+        matches = re.findall(r'course_code[\'"]:\s*[\'"]([^\'"]+)', prompt)
+        code = matches[-1] if matches else "COURSE101"
+        return json.dumps({
+            "course_code": code,
+            "course_name": f"Introduction to {code}",
+            "topics": [
+                {
+                    "name": f"Topic {i}",
+                    "subtopics": [f"Subtopic {i}.{j}" for j in range(1, 4)]
+                }
+                for i in range(1, 5)
+            ]
+        })
+
+    def _quiz(self, prompt):
+        sections = re.findall(r'key "([^"]+)": (\d+) questions', prompt)
+        if sections:
+            return json.dumps({
+                "sections": [
+                    {"key": key, "questions": self._questions(int(count))}
+                    for key, count in sections
+                ]
+            })
+
+        matches = re.findall(r'\b(\d+) (?:basic )?multiple choice questions', prompt)
+        count = int(matches[-1]) if matches else 5
+        return json.dumps({"questions": self._questions(count)})
+
+    def _questions(self, count):
+        return [
+            {
+                "question": f"Sample question {i}?",
+                "options": [
+                    f"A) Correct answer {i}",
+                    f"B) Wrong answer {i}",
+                    f"C) Wrong answer {i}",
+                    f"D) Wrong answer {i}"
+                ],
+                "correct": "A"
+            }
+            for i in range(1, count + 1)
+        ]
+
+    def _quiz_batch(self, prompt):
+        return self._quiz(prompt)
+
+    def _chat(self, prompt):
+        return "This is a local test response from the EduAI assistant."
+
+    def _note(self, prompt):
+        return "# Lecture Note\n\n## Key Concepts\n\n- First concept\n- Second concept\n\n## Example\n\n```python\nprint('hello')\n```\n"
+
+    def _explanation(self, prompt):
+        return "# Question Explanation\n\n## ✓ Correct Answer: A\n\nThis is the correct answer.\n\n## ❌ Why Other Options are Incorrect:\n\n- They are not correct.\n"
+
+
+def estimate_tokens(text):
+    # Rough estimate when the backend does not report usage
+    return max(1, len(text) // 4)
+
+
+class ModelStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.streams = 0
+        self.total_first_chunk_latency = 0.0
+        self.retries = 0
+        self.rejected = 0
+        self.aborted = 0
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'aborted': self.aborted,
+            'avg_latency': round(self.total_latency / self.calls, 4) if self.calls else 0,
+            'max_latency': round(self.max_latency, 4),
+            'streams': self.streams,
+            'avg_first_chunk_latency': round(self.total_first_chunk_latency / self.streams, 4) if self.streams else 0,
+            'prompt_tokens': self.prompt_tokens,
+            'output_tokens': self.output_tokens
+        }
+
+
+BACKENDS = {
+    'gemini': lambda config, model_configs: GeminiBackend(config['GEMINI_API_KEY'], model_configs, timeout=config['LLM_TIMEOUT']),
+    'local': lambda config, model_configs: LocalBackend(latency=config['LLM_LOCAL_LATENCY'])
+}
+
+
+class LLMGateway:
+    """Single entry point for every model call made by the app"""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.model_configs = {}
+        self.limiter = RateLimiter(0, 0)
+        self.inflight = InflightLimiter(limit=16)
+        self.breaker = CircuitBreaker()
+        self.retries = 2
+        self.retry_base = 1.0
+        self.cache = None
+        self.cache_models = ()
+        self.stats = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from gemini import model_configs, validate_model_configs
+
+        backend_name = app.config['LLM_BACKEND']
+        if backend_name not in BACKENDS:
+            raise ValueError(f"Unknown LLM backend: {backend_name}")
+
+        # A bad model setting should stop the app here, not fail its first request
+        self.model_configs = model_configs(app.config['LLM_MODEL_OVERRIDES'])
+        errors = validate_model_configs(self.model_configs)
+        errors += [f"{name}: cached but not configured" for name in app.config['LLM_CACHE_MODELS'] if name not in self.model_configs]
+        if errors:
+            raise ValueError("Invalid model configuration: " + '; '.join(errors))
+        self.backend = BACKENDS[backend_name](app.config, self.model_configs)
+
+        # Outbound traffic control, shared by every request and job of this process
+        self.limiter = RateLimiter(app.config['LLM_RPM'], app.config['LLM_TPM'], overrides=app.config['LLM_RATE_LIMITS'])
+        self.inflight = InflightLimiter(limit=app.config['LLM_MAX_IN_FLIGHT'], timeout=app.config['LLM_QUEUE_TIMEOUT'])
+        self.breaker = CircuitBreaker(
+            failure_threshold=app.config['LLM_BREAKER_FAILURES'],
+            reset_timeout=app.config['LLM_BREAKER_RESET']
+        )
+        self.retries = app.config['LLM_RETRIES']
+        self.retry_base = app.config['LLM_RETRY_BASE']
+        if app.config['LLM_CACHE_ENABLED']:
+            self.cache = ResponseCache(
+                max_size=app.config['LLM_CACHE_SIZE'],
+                ttl=app.config['LLM_CACHE_TTL'],
+                persistent_ttl=app.config['LLM_CACHE_PERSISTENT_TTL']
+            )
+            self.cache_models = app.config['LLM_CACHE_MODELS']
+        app.extensions['llm_gateway'] = self
+
+    def generate(self, model_name, prompt, refresh=False):
+        """Return the model's answer, served from the cache when possible.
+
+        refresh skips the cache lookup (e.g. when a quiz is recreated) but
+        still stores the new answer.
+        """
+        key = self._cache_key(model_name, prompt)
+        if key is not None and not refresh:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        text = self._call_backend(model_name, prompt)
+        if key is not None:
+            self.cache.set(key, model_name, text)
+        return text
+
+    def stream(self, model_name, prompt):
+        """Like generate, but yields text chunks as soon as the backend produces them"""
+        key = self._cache_key(model_name, prompt)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                yield cached
+                return
+
+        attempt = 0
+        while True:
+            trial = self._admit(model_name, prompt)
+            start = time.perf_counter()
+            first_chunk_latency = None
+            parts = []
+            usage = LLMResult('')
+            error = None
+            try:
+                for chunk in self.backend.stream(model_name, prompt):
+                    if chunk.text:
+                        if first_chunk_latency is None:
+                            first_chunk_latency = time.perf_counter() - start
+                        parts.append(chunk.text)
+                        yield chunk.text
+                    if chunk.prompt_tokens or chunk.output_tokens:
+                        usage = chunk
+            except Exception as e:
+                error = e
+            except GeneratorExit:
+                # The client went away mid-stream
+                self._abort(model_name, prompt, usage, trial)
+                raise
+
+            if error is None:
+                self._complete(model_name, prompt, start, result=usage, first_chunk_latency=first_chunk_latency, trial=trial)
+                break
+            self._complete(model_name, prompt, start, error=error, trial=trial)
+            # Text already sent cannot be taken back, so only a stream that failed before its first chunk is retried
+            delay = None if parts else self._retry_wait(model_name, error, attempt)
+            if delay is None:
+                raise error
+            attempt += 1
+            time.sleep(delay)
+
+        if key is not None:
+            self.cache.set(key, model_name, ''.join(parts))
+
+    async def agenerate(self, model_name, prompt, refresh=False):
+        """Async generate for the ASGI entry point.
+
+        The model call is awaited on the event loop; cache reads and writes
+        may hit the database, so they run on a worker thread.
+        """
+        key = self._cache_key(model_name, prompt)
+        if key is not None and not refresh:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                return cached
+
+        attempt = 0
+        while True:
+            trial = await self._aadmit(model_name, prompt)
+            start = time.perf_counter()
+            try:
+                result = await self.backend.agenerate(model_name, prompt)
+            except Exception as e:
+                self._complete(model_name, prompt, start, error=e, trial=trial)
+                delay = self._retry_wait(model_name, e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            except asyncio.CancelledError:
+                self._abort(model_name, prompt, LLMResult(''), trial)
+                raise
+            self._complete(model_name, prompt, start, result=result, trial=trial)
+            break
+
+        if key is not None:
+            await asyncio.to_thread(self.cache.set, key, model_name, result.text)
+        return result.text
+
+    async def astream(self, model_name, prompt):
+        """Async variant of stream"""
+        key = self._cache_key(model_name, prompt)
+        if key is not None:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                yield cached
+                return
+
+        attempt = 0
+        while True:
+            trial = await self._aadmit(model_name, prompt)
+            start = time.perf_counter()
+            first_chunk_latency = None
+            parts = []
+            usage = LLMResult('')
+            error = None
+            try:
+                async for chunk in self.backend.astream(model_name, prompt):
+                    if chunk.text:
+                        if first_chunk_latency is None:
+                            first_chunk_latency = time.perf_counter() - start
+                        parts.append(chunk.text)
+                        yield chunk.text
+                    if chunk.prompt_tokens or chunk.output_tokens:
+                        usage = chunk
+            except Exception as e:
+                error = e
+            except (GeneratorExit, asyncio.CancelledError):
+                self._abort(model_name, prompt, usage, trial)
+                raise
+
+            if error is None:
+                self._complete(model_name, prompt, start, result=usage, first_chunk_latency=first_chunk_latency, trial=trial)
+                break
+            self._complete(model_name, prompt, start, error=error, trial=trial)
+            delay = None if parts else self._retry_wait(model_name, error, attempt)
+            if delay is None:
+                raise error
+            attempt += 1
+            await asyncio.sleep(delay)
+
+        if key is not None:
+            await asyncio.to_thread(self.cache.set, key, model_name, ''.join(parts))
+
+    def _cache_key(self, model_name, prompt):
+        if self.cache is None or model_name not in self.cache_models:
+            return None
+        return make_key(model_name, self.backend.fingerprint(model_name), prompt)
+
+    def _call_backend(self, model_name, prompt):
+        attempt = 0
+        while True:
+            trial = self._admit(model_name, prompt)
+            start = time.perf_counter()
+            try:
+                result = self.backend.generate(model_name, prompt)
+            except Exception as e:
+                self._complete(model_name, prompt, start, error=e, trial=trial)
+                delay = self._retry_wait(model_name, e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._complete(model_name, prompt, start, result=result, trial=trial)
+            return result.text
+
+    def _provider_model(self, model_name):
+        # Quotas belong to the provider's model, which several tasks may share
+        return self.model_configs.get(model_name, {}).get('model', model_name)
+
+    def _admit(self, model_name, prompt):
+        """Wait until the circuit breaker, the rate limits and the in-flight cap let a call through.
+
+        Returns whether the call is the circuit breaker's trial call, which
+        is passed on to _complete.
+        """
+        trial = self._check_circuit(model_name)
+        model, tokens = self._provider_model(model_name), estimate_tokens(prompt)
+        try:
+            delay = self.limiter.reserve(model, tokens, self.inflight.timeout)
+        except ModelUnavailableError:
+            self._reject(model_name, trial)
+            raise
+        try:
+            if delay:
+                time.sleep(delay)
+            self.inflight.acquire()
+        except ModelUnavailableError:
+            # The call never happens, so its quota is given back
+            self.limiter.release(model, tokens)
+            self._reject(model_name, trial)
+            raise
+        return trial
+
+    async def _aadmit(self, model_name, prompt):
+        trial = self._check_circuit(model_name)
+        model, tokens = self._provider_model(model_name), estimate_tokens(prompt)
+        try:
+            delay = self.limiter.reserve(model, tokens, self.inflight.timeout)
+        except ModelUnavailableError:
+            self._reject(model_name, trial)
+            raise
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+            await self.inflight.aacquire()
+        except (ModelUnavailableError, asyncio.CancelledError):
+            self.limiter.release(model, tokens)
+            self._reject(model_name, trial)
+            raise
+        return trial
+
+    def _check_circuit(self, model_name):
+        try:
+            return self.breaker.before_call()
+        except CircuitOpenError:
+            # Another caller may own the trial call, so the breaker is left alone
+            self._reject(model_name)
+            raise
+
+    def _reject(self, model_name, trial=False):
+        self.breaker.record_ignored(trial)
+        with self._lock:
+            self.stats.setdefault(model_name, ModelStats()).rejected += 1
+
+    def _complete(self, model_name, prompt, start, result=None, error=None, first_chunk_latency=None, trial=False):
+        """Free the in-flight slot and feed the outcome to the breaker, the token quota and the stats"""
+        self.inflight.release()
+        latency = time.perf_counter() - start
+        if error is not None:
+            # Only failures of the service itself count towards opening the circuit
+            if is_retriable(error):
+                self.breaker.record_failure(trial)
+            else:
+                self.breaker.record_ignored(trial)
+            self._record(model_name, latency, error=True)
+            return
+
+        self.breaker.record_success(trial)
+        # The quota was charged with an estimate of the prompt; settle it with the real usage
+        estimate = estimate_tokens(prompt)
+        used = (result.prompt_tokens or estimate) + result.output_tokens
+        self.limiter.adjust(self._provider_model(model_name), used - estimate)
+        self._record(model_name, latency, result=result, first_chunk_latency=first_chunk_latency)
+
+    def _abort(self, model_name, prompt, usage, trial):
+        """Free the in-flight slot of a call its caller gave up on.
+
+        The call says nothing about the backend's health, so a trial call
+        leaves the circuit as it was for the next caller. The request did
+        reach the provider: the quota keeps the estimate unless usage was
+        reported before the call was cut off.
+        """
+        self.inflight.release()
+        self.breaker.record_ignored(trial)
+        if usage.prompt_tokens or usage.output_tokens:
+            estimate = estimate_tokens(prompt)
+            self.limiter.adjust(self._provider_model(model_name), usage.prompt_tokens + usage.output_tokens - estimate)
+        with self._lock:
+            self.stats.setdefault(model_name, ModelStats()).aborted += 1
+
+    def _retry_wait(self, model_name, error, attempt):
+        """Backoff before the next attempt, or None when the error is final"""
+        if attempt >= self.retries or not is_retriable(error):
+            return None
+        with self._lock:
+            self.stats.setdefault(model_name, ModelStats()).retries += 1
+        return retry_delay(attempt, self.retry_base)
+
+    def _record(self, model_name, latency, result=None, error=False, first_chunk_latency=None):
+        with self._lock:
+            stats = self.stats.setdefault(model_name, ModelStats())
+            stats.calls += 1
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+            if first_chunk_latency is not None:
+                stats.streams += 1
+                stats.total_first_chunk_latency += first_chunk_latency
+            if error:
+                stats.errors += 1
+            else:
+                stats.prompt_tokens += result.prompt_tokens
+                stats.output_tokens += result.output_tokens
+
+    def metrics(self):
+        with self._lock:
+            metrics = {
+                'backend': self.backend.name,
+                'models': {name: stats.as_dict() for name, stats in self.stats.items()},
+                'in_flight': self.inflight.active,
+                'peak_in_flight': self.inflight.peak,
+                'circuit': self.breaker.state
+            }
+        if self.cache is not None:
+            metrics['cache'] = self.cache.metrics()
+        return metrics
+
+
+gateway = LLMGateway()
@@ -0,0 +1,225 @@
+"""Versioned schema migrations.
+
+db.create_all() only creates missing tables, so changes to existing tables
+live here. Every migration is a list of idempotent steps and is recorded in
+schema_migrations once it has run. Apply pending migrations with:
+
+    flask migrate
+
+On PostgreSQL indexes are built with CREATE INDEX CONCURRENTLY, so tables
+stay writable while a migration runs.
+"""
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from models import SchemaMigration
+
+
+def quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def add_column(table, column, ddl):
+    """Step that adds a column unless it already exists"""
+    def step(conn):
+        if column in {c['name'] for c in inspect(conn).get_columns(table)}:
+            return
+        conn.execute(text(f"ALTER TABLE {quote(conn, table)} ADD COLUMN {quote(conn, column)} {ddl}"))
+    return step
+
+
+def drop_invalid_index(conn, name):
+    # An interrupted concurrent build leaves an invalid index behind
+    invalid = conn.execute(text(
+        "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name AND NOT i.indisvalid"
+    ), {'name': name}).first()
+    if invalid:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY {quote(conn, name)}"))
+
+
+def create_index(name, table, columns, unique=False):
+    """Step that builds an index without locking the table against writes"""
+    def step(conn):
+        concurrently = ''
+        if conn.dialect.name == 'postgresql':
+            concurrently = 'CONCURRENTLY '
+            drop_invalid_index(conn, name)
+
+        column_list = ', '.join(quote(conn, column) for column in columns)
+        conn.execute(text(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX {concurrently}IF NOT EXISTS {quote(conn, name)} "
+            f"ON {quote(conn, table)} ({column_list})"
+        ))
+    return step
+
+
+def create_fts_index(name, table, *columns):
+    """Step that builds a full-text (GIN) index on PostgreSQL; other databases search without one.
+
+    With several columns the first that is not NULL is indexed.
+    """
+    def step(conn):
+        if conn.dialect.name != 'postgresql':
+            return
+        drop_invalid_index(conn, name)
+        document = ', '.join(quote(conn, column) for column in columns)
+        if len(columns) > 1:
+            document = f"coalesce({document})"
+        conn.execute(text(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {quote(conn, name)} "
+            f"ON {quote(conn, table)} USING gin (to_tsvector('simple'::regconfig, {document}))"
+        ))
+    return step
+
+
+def drop_index(name):
+    def step(conn):
+        concurrently = 'CONCURRENTLY ' if conn.dialect.name == 'postgresql' else ''
+        conn.execute(text(f"DROP INDEX {concurrently}IF EXISTS {quote(conn, name)}"))
+    return step
+
+
+def execute(sql):
+    def step(conn):
+        conn.execute(text(sql))
+    return step
+
+
+# Unique indexes fail on existing duplicates, so those are cleaned up first
+DEDUPLICATE_NOTES = """
+    DELETE FROM note WHERE id NOT IN (
+        SELECT MIN(id) FROM note GROUP BY course_id, topic_id, subtopic_id
+    )"""
+
+# Syllabi generated twice left several courses per course_info. Pages always
+# opened the first one, so the trees of the others are deleted, children first
+DUPLICATE_COURSES = """
+    SELECT id FROM course WHERE id NOT IN (
+        SELECT MIN(id) FROM course GROUP BY course_info_id
+    )"""
+DUPLICATE_TOPICS = f"SELECT id FROM topic WHERE course_id IN ({DUPLICATE_COURSES})"
+DUPLICATE_SUBTOPICS = f"SELECT id FROM subtopic WHERE topic_id IN ({DUPLICATE_TOPICS})"
+DELETE_DUPLICATE_COURSES = [
+    ('quiz_attempt', f"topic_id IN ({DUPLICATE_TOPICS})"),
+    ('subtopic_quiz', f"subtopic_id IN ({DUPLICATE_SUBTOPICS})"),
+    ('quiz', f"topic_id IN ({DUPLICATE_TOPICS})"),
+    ('note', f"course_id IN ({DUPLICATE_COURSES})"),
+    ('subtopic', f"topic_id IN ({DUPLICATE_TOPICS})"),
+    ('topic', f"course_id IN ({DUPLICATE_COURSES})"),
+    ('course', f"id IN ({DUPLICATE_COURSES})"),
+]
+
+
+def delete_duplicate_courses(conn):
+    # quiz_attempt is newer than some databases this runs on
+    tables = set(inspect(conn).get_table_names())
+    for table, condition in DELETE_DUPLICATE_COURSES:
+        if table in tables:
+            conn.execute(text(f"DELETE FROM {quote(conn, table)} WHERE {condition}"))
+
+
+MERGE_STUDENT_PROGRESS = """
+    UPDATE student_progress SET
+        total_questions = (SELECT SUM(s.total_questions) FROM student_progress s
+                           WHERE s.quiz_name = student_progress.quiz_name AND s.quiz_course_name = student_progress.quiz_course_name),
+        correct_questions = (SELECT SUM(s.correct_questions) FROM student_progress s
+                             WHERE s.quiz_name = student_progress.quiz_name AND s.quiz_course_name = student_progress.quiz_course_name),
+        quiz_counter = (SELECT SUM(s.quiz_counter) FROM student_progress s
+                        WHERE s.quiz_name = student_progress.quiz_name AND s.quiz_course_name = student_progress.quiz_course_name)
+    WHERE id IN (
+        SELECT MIN(id) FROM student_progress GROUP BY quiz_name, quiz_course_name HAVING COUNT(*) > 1
+    )"""
+
+DEDUPLICATE_STUDENT_PROGRESS = """
+    DELETE FROM student_progress WHERE id NOT IN (
+        SELECT MIN(id) FROM student_progress GROUP BY quiz_name, quiz_course_name
+    )"""
+
+
+# (version, description, steps), applied in order
+MIGRATIONS = [
+    ('0001', 'Conversation columns on chat_history', [
+        add_column('chat_history', 'user_id', 'INTEGER REFERENCES "user" (id)'),
+        add_column('chat_history', 'channel', "VARCHAR(20) NOT NULL DEFAULT 'course'"),
+    ]),
+    ('0002', 'Indexes for hot lookup columns', [
+        create_index('ix_quiz_topic_id', 'quiz', ['topic_id']),
+        create_index('ix_subtopic_quiz_subtopic_id', 'subtopic_quiz', ['subtopic_id']),
+        create_index('ix_topic_course_id', 'topic', ['course_id']),
+        create_index('ix_subtopic_topic_id', 'subtopic', ['topic_id']),
+        create_index('ix_course_info_course_code', 'course_info', ['course_code']),
+        create_index('ix_chat_history_course_sender_timestamp', 'chat_history', ['course_id', 'sender', 'timestamp']),
+        create_index('ix_chat_history_channel_user', 'chat_history', ['channel', 'user_id', 'id']),
+    ]),
+    ('0003', 'Unique constraints for notes, courses and progress', [
+        execute(DEDUPLICATE_NOTES),
+        create_index('uq_note_course_topic_subtopic', 'note', ['course_id', 'topic_id', 'subtopic_id'], unique=True),
+        delete_duplicate_courses,
+        create_index('uq_course_course_info_id', 'course', ['course_info_id'], unique=True),
+        execute(MERGE_STUDENT_PROGRESS),
+        execute(DEDUPLICATE_STUDENT_PROGRESS),
+        create_index('uq_student_progress_quiz', 'student_progress', ['quiz_name', 'quiz_course_name'], unique=True),
+    ]),
+    ('0004', 'Per-user student progress', [
+        add_column('student_progress', 'user_id', 'INTEGER REFERENCES "user" (id)'),
+        create_index('uq_student_progress_user_quiz', 'student_progress', ['user_id', 'quiz_name', 'quiz_course_name'], unique=True),
+        drop_index('uq_student_progress_quiz'),
+    ]),
+    ('0005', 'Markdown source of notes', [
+        add_column('note', 'source', 'TEXT'),
+    ]),
+    ('0006', 'Stored quiz explanations', [
+        add_column('quiz', 'explanation', 'TEXT'),
+        add_column('quiz', 'explanation_source', 'TEXT'),
+        add_column('subtopic_quiz', 'explanation', 'TEXT'),
+        add_column('subtopic_quiz', 'explanation_source', 'TEXT'),
+    ]),
+    ('0007', 'Full-text search indexes', [
+        create_fts_index('ix_course_info_description_fts', 'course_info', 'description'),
+        create_fts_index('ix_note_content_fts', 'note', 'content'),
+        create_fts_index('ix_quiz_question_fts', 'quiz', 'question'),
+        create_fts_index('ix_subtopic_quiz_question_fts', 'subtopic_quiz', 'question'),
+    ]),
+    ('0008', 'Full-text search of note markdown instead of HTML', [
+        # Notes from before 0005 have no markdown, their HTML stays searchable
+        create_fts_index('ix_note_source_fts', 'note', 'source', 'content'),
+        drop_index('ix_note_content_fts'),
+    ]),
+]
+
+
+def applied_versions(engine):
+    table = SchemaMigration.__table__
+    table.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return {row.version for row in conn.execute(table.select())}
+
+
+def pending_migrations(engine):
+    applied = applied_versions(engine)
+    return [migration for migration in MIGRATIONS if migration[0] not in applied]
+
+
+def stamp_migrations(engine):
+    """Mark every migration as applied, for databases created from the current models"""
+    table = SchemaMigration.__table__
+    with engine.begin() as conn:
+        for version, description, _ in pending_migrations(engine):
+            conn.execute(table.insert().values(version=version, description=description, applied_at=datetime.utcnow()))
+
+
+def run_migrations(engine, echo=print):
+    """Apply every pending migration and return the versions applied"""
+    table = SchemaMigration.__table__
+    applied = []
+    for version, description, steps in pending_migrations(engine):
+        echo(f"Applying {version}: {description}")
+        # Concurrent index builds cannot run inside a transaction
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            for step in steps:
+                step(conn)
+            conn.execute(table.insert().values(version=version, description=description, applied_at=datetime.utcnow()))
+        applied.append(version)
+    return applied
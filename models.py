@@ -6,6 +6,13 @@ from flask_bcrypt import Bcrypt
 db = SQLAlchemy()
 bcrypt = Bcrypt()
 
+
+def fts_index(name, column):
+    """PostgreSQL full-text index of a column, used by search.py; skipped on other databases"""
+    vector = db.func.to_tsvector(db.literal_column("'simple'::regconfig"), column)
+    return db.Index(name, vector, postgresql_using='gin').ddl_if(dialect='postgresql')
+
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), unique=True, nullable=False)
@@ -19,9 +26,16 @@ class User(db.Model, UserMixin):
 class ChatHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     course_id = db.Column(db.Integer, db.ForeignKey('course_info.id', ondelete='CASCADE'))  # Link to CourseInfo
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    channel = db.Column(db.String(20), nullable=False, default='course', server_default='course')  # 'course' (dashboard) or 'chat' (chatbot)
     sender = db.Column(db.String(10), nullable=False)  # 'user' or 'ai'
     text = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_chat_history_course_sender_timestamp', 'course_id', 'sender', 'timestamp'),
+        db.Index('ix_chat_history_channel_user', 'channel', 'user_id', 'id'),
+    )
     
 class CourseInfo(db.Model):
     __tablename__ = 'course_info'
@@ -31,6 +45,11 @@ class CourseInfo(db.Model):
     description = db.Column(db.Text, nullable=False)
     course = db.relationship('Course',backref='course_info',lazy=True,cascade="all, delete-orphan")
 
+    __table_args__ = (
+        db.Index('ix_course_info_course_code', 'course_code'),
+        fts_index('ix_course_info_description_fts', description),
+    )
+
 class Course(db.Model):
     __tablename__ = 'course'
     id = db.Column(db.Integer, primary_key=True)
@@ -39,6 +58,8 @@ class Course(db.Model):
     topics = db.relationship('Topic',backref='course', lazy=True, cascade="all, delete-orphan")
     course_info_id = db.Column(db.Integer,db.ForeignKey('course_info.id'), nullable = False)
 
+    __table_args__ = (db.Index('uq_course_course_info_id', 'course_info_id', unique=True),)
+
 class Topic(db.Model):
     __tablename__ = 'topic'
     id = db.Column(db.Integer, primary_key=True)
@@ -46,11 +67,15 @@ class Topic(db.Model):
     subtopics = db.relationship('Subtopic', backref='topic',lazy = True, cascade="all, delete-orphan")
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
     
+    __table_args__ = (db.Index('ix_topic_course_id', 'course_id'),)
+
 class Subtopic(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     subtopic_name= db.Column(db.Text,nullable = False)
     topic_id = db.Column(db.Integer, db.ForeignKey('topic.id'), nullable=False)
     
+    __table_args__ = (db.Index('ix_subtopic_topic_id', 'topic_id'),)
+
 class Quiz(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     topic_id = db.Column(db.Integer, db.ForeignKey('topic.id'), nullable=False)
@@ -60,6 +85,13 @@ class Quiz(db.Model):
     option_c = db.Column(db.String(200), nullable=False)
     option_d = db.Column(db.String(200), nullable=False)
     correct_answer = db.Column(db.String(1), nullable=False)
+    explanation = db.Column(db.Text)  # Rendered HTML, generated once on first request
+    explanation_source = db.Column(db.Text)  # Markdown the explanation was rendered from
+
+    __table_args__ = (
+        db.Index('ix_quiz_topic_id', 'topic_id'),
+        fts_index('ix_quiz_question_fts', question),
+    )
 
 class SubtopicQuiz(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -70,13 +102,21 @@ class SubtopicQuiz(db.Model):
     option_c = db.Column(db.String(200), nullable=False)
     option_d = db.Column(db.String(200), nullable=False)
     correct_answer = db.Column(db.String(1), nullable=False)
+    explanation = db.Column(db.Text)  # Rendered HTML, generated once on first request
+    explanation_source = db.Column(db.Text)  # Markdown the explanation was rendered from
     
     subtopic = db.relationship('Subtopic', backref='quizzes')
 
+    __table_args__ = (
+        db.Index('ix_subtopic_quiz_subtopic_id', 'subtopic_id'),
+        fts_index('ix_subtopic_quiz_question_fts', question),
+    )
+
 class Note(db.Model):
     __tablename__ = 'note'
     id = db.Column(db.Integer, primary_key=True)
-    content = db.Column(db.Text, nullable=False)
+    content = db.Column(db.Text, nullable=False)  # Rendered HTML
+    source = db.Column(db.Text)  # Markdown the content was rendered from
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
     topic_id = db.Column(db.Integer, db.ForeignKey('topic.id'), nullable=False)
     subtopic_id = db.Column(db.Integer, db.ForeignKey('subtopic.id'), nullable=False)
@@ -86,11 +126,64 @@ class Note(db.Model):
     topic = db.relationship('Topic', backref='notes')
     subtopic = db.relationship('Subtopic', backref='notes')
 
+    __table_args__ = (
+        db.Index('uq_note_course_topic_subtopic', 'course_id', 'topic_id', 'subtopic_id', unique=True),
+        fts_index('ix_note_source_fts', db.func.coalesce(source, content)),
+    )
+
 class StudentProgress(db.Model):
     __tablename__ = 'student_progress'
     id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # NULL for rows from before progress was per user
     quiz_name = db.Column(db.Text, nullable=False)
     quiz_course_name = db.Column(db.Text, nullable=False)
     total_questions = db.Column(db.Integer, nullable=False)
     correct_questions = db.Column(db.Integer, nullable=False)
-    quiz_counter = db.Column(db.Integer, nullable=False)
\ No newline at end of file
+    quiz_counter = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (db.Index('uq_student_progress_user_quiz', 'user_id', 'quiz_name', 'quiz_course_name', unique=True),)
+
+class QuizAttempt(db.Model):
+    __tablename__ = 'quiz_attempt'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    quiz_type = db.Column(db.String(10), nullable=False)  # 'topic' or 'subtopic'
+    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id'), nullable=False)
+    subtopic_id = db.Column(db.Integer, db.ForeignKey('subtopic.id'))
+    total_questions = db.Column(db.Integer, nullable=False)
+    correct_questions = db.Column(db.Integer, nullable=False)
+    answers = db.Column(db.Text, nullable=False)  # JSON list of per-question results
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_quiz_attempt_user_created', 'user_id', 'created_at'),)
+
+class LLMCacheEntry(db.Model):
+    __tablename__ = 'llm_cache'
+    key = db.Column(db.String(64), primary_key=True)  # sha256 of model, system instruction, config and prompt
+    model_name = db.Column(db.String(50), nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class QuizState(db.Model):
+    __tablename__ = 'quiz_state'
+    key = db.Column(db.String(80), primary_key=True)  # opaque session id and quiz name
+    data = db.Column(db.Text, nullable=False)  # JSON
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class BackgroundJob(db.Model):
+    __tablename__ = 'background_job'
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(10), nullable=False)  # queued, running, finished or failed
+    result = db.Column(db.Text)  # JSON
+    error = db.Column(db.Text)
+    progress = db.Column(db.Text)  # JSON
+    success_url = db.Column(db.String(500))
+    failure_url = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.String(50), primary_key=True)
+    description = db.Column(db.Text, nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,219 @@
+"""Parsing and validation of the JSON answers of the course, listing and quiz models.
+
+Answers are parsed in increasingly forgiving steps: as-is (what the models
+return in native JSON mode), the first balanced JSON value cut out of the
+surrounding text, and finally that value with common defects repaired.
+The schemas use the subset of JSON Schema that Gemini accepts as a
+response_schema, so the same dicts describe and check the answers.
+"""
+import json
+import re
+
+
+class ParseError(ValueError):
+    pass
+
+
+QUESTION_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'question': {'type': 'string'},
+        'options': {'type': 'array', 'items': {'type': 'string'}, 'min_items': 4, 'max_items': 4},
+        'correct': {'type': 'string', 'enum': ['A', 'B', 'C', 'D']}
+    },
+    'required': ['question', 'options', 'correct']
+}
+
+QUESTIONS_SCHEMA = {'type': 'array', 'items': QUESTION_SCHEMA, 'min_items': 1}
+
+SCHEMAS = {
+    'course': {
+        'type': 'object',
+        'properties': {
+            'course_code': {'type': 'string'},
+            'course_name': {'type': 'string'},
+            'description': {'type': 'string'}
+        },
+        'required': ['course_code', 'course_name', 'description']
+    },
+    'syllabus': {
+        'type': 'object',
+        'properties': {
+            'course_code': {'type': 'string'},
+            'course_name': {'type': 'string'},
+            'topics': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'name': {'type': 'string'},
+                        'subtopics': {'type': 'array', 'items': {'type': 'string'}}
+                    },
+                    'required': ['name', 'subtopics']
+                },
+                'min_items': 1
+            }
+        },
+        'required': ['course_code', 'course_name', 'topics']
+    },
+    'quiz': {
+        'type': 'object',
+        'properties': {'questions': QUESTIONS_SCHEMA},
+        'required': ['questions']
+    },
+    'quiz_batch': {
+        'type': 'object',
+        'properties': {
+            'sections': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {'key': {'type': 'string'}, 'questions': QUESTIONS_SCHEMA},
+                    'required': ['key', 'questions']
+                }
+            }
+        },
+        'required': ['sections']
+    },
+    'questions': QUESTIONS_SCHEMA
+}
+
+JSON_TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'integer': int,
+    'number': (int, float),
+    'boolean': bool
+}
+
+# Typographic quotes the models sometimes copy from the prompts
+SMART_QUOTES = str.maketrans({'“': '"', '”': '"', '„': '"', '″': '"'})
+TRAILING_COMMA = re.compile(r',(\s*[}\]])')
+CLOSING = {'{': '}', '[': ']'}
+
+
+class JsonScanner:
+    """Finds the first complete JSON object or array in text fed in chunks.
+
+    feed() returns the JSON text as soon as its brackets balance, so a
+    streamed answer can be parsed without waiting for the rest of it.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+
+    def feed(self, chunk):
+        start = 0
+        for i, char in enumerate(chunk):
+            if not self.started:
+                if char not in CLOSING:
+                    continue
+                self.started = True
+                start = i
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in CLOSING:
+                self.stack.append(CLOSING[char])
+            elif char in '}]' and self.stack:
+                self.stack.pop()
+                if not self.stack:
+                    self.parts.append(chunk[start:i + 1])
+                    return ''.join(self.parts)
+        if self.started:
+            self.parts.append(chunk[start:])
+        return None
+
+    def close(self):
+        """Text seen so far with open strings and brackets closed, for truncated answers"""
+        if not self.started:
+            return None
+        text = ''.join(self.parts)
+        if self.in_string:
+            text += '"'
+        return text + ''.join(reversed(self.stack))
+
+
+def extract_json(text):
+    """First balanced JSON object or array in text, closed off if the text ends early"""
+    scanner = JsonScanner()
+    return scanner.feed(text) or scanner.close()
+
+
+def repair_json(text):
+    text = text.translate(SMART_QUOTES)
+    return TRAILING_COMMA.sub(r'\1', text)
+
+
+def loads(text):
+    # strict=False accepts raw newlines and tabs inside strings
+    return json.loads(text, strict=False)
+
+
+def parse_json(text, schema=None):
+    """Parse a model answer and check it against a schema name from SCHEMAS.
+
+    Raises ParseError when no JSON can be recovered or it does not match.
+    """
+    if not text:
+        raise ParseError('Empty answer')
+
+    candidates = [text, extract_json(text), extract_json(repair_json(text))]
+    for candidate in candidates:
+        if candidate is None:
+            continue
+        try:
+            data = loads(candidate)
+            break
+        except json.JSONDecodeError:
+            continue
+    else:
+        raise ParseError(f'No JSON found in answer: {text[:200]}')
+
+    if schema is not None:
+        errors = validate(data, SCHEMAS[schema])
+        if errors:
+            raise ParseError(f'Answer does not match the {schema} schema: ' + '; '.join(errors[:5]))
+    return data
+
+
+def validate(data, schema, path='$'):
+    """List of the places where data does not match schema, empty when it does"""
+    expected = JSON_TYPES[schema['type']]
+    if not isinstance(data, expected) or (expected is not bool and isinstance(data, bool)):
+        return [f"{path} should be of type {schema['type']}"]
+
+    errors = []
+    if 'enum' in schema and data not in schema['enum']:
+        errors.append(f"{path} should be one of {', '.join(map(str, schema['enum']))}")
+    if isinstance(data, dict):
+        for key in schema.get('required', []):
+            if key not in data:
+                errors.append(f'{path}.{key} is missing')
+        for key, subschema in schema.get('properties', {}).items():
+            if key in data:
+                errors += validate(data[key], subschema, f'{path}.{key}')
+    elif isinstance(data, list):
+        if len(data) < schema.get('min_items', 0):
+            errors.append(f"{path} should have at least {schema['min_items']} items")
+        if 'max_items' in schema and len(data) > schema['max_items']:
+            errors.append(f"{path} should have at most {schema['max_items']} items")
+        if 'items' in schema:
+            for i, item in enumerate(data):
+                errors += validate(item, schema['items'], f'{path}[{i}]')
+    return errors
+
+
+def is_valid(data, schema):
+    return not validate(data, SCHEMAS[schema])
@@ -0,0 +1,101 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from flask import current_app
+
+from models import db, Course, Subtopic, Quiz, SubtopicQuiz, Note
+from generation import build_course, build_topic_quizzes, build_note, build_explanations
+from limits import TokenBucket, is_rate_limited
+
+
+def pending_tasks(course):
+    """Quizzes and notes of a course that have not been generated yet"""
+    topic_ids = [topic.id for topic in course.topics]
+    subtopics = Subtopic.query.filter(Subtopic.topic_id.in_(topic_ids)).all() if topic_ids else []
+    subtopic_ids = [subtopic.id for subtopic in subtopics]
+
+    topics_with_quiz = {row.topic_id for row in db.session.query(Quiz.topic_id).filter(Quiz.topic_id.in_(topic_ids)).distinct()}
+    subtopics_with_quiz = {row.subtopic_id for row in db.session.query(SubtopicQuiz.subtopic_id).filter(SubtopicQuiz.subtopic_id.in_(subtopic_ids)).distinct()}
+    subtopics_with_note = {row.subtopic_id for row in db.session.query(Note.subtopic_id).filter(Note.course_id == course.id).distinct()}
+
+    # One batched quiz call per topic covers its missing subtopic quizzes too
+    tasks = []
+    for topic_id in topic_ids:
+        missing_subtopics = [s.id for s in subtopics if s.topic_id == topic_id and s.id not in subtopics_with_quiz]
+        include_topic = topic_id not in topics_with_quiz
+        if include_topic or missing_subtopics:
+            tasks.append((f'quizzes of topic {topic_id}', build_topic_quizzes, (topic_id, missing_subtopics, include_topic)))
+    for subtopic in subtopics:
+        if subtopic.id not in subtopics_with_note:
+            tasks.append((f'note {subtopic.id}', build_note, (course.id, subtopic.topic_id, subtopic.id)))
+
+    # New quizzes queue their own explanations, existing ones are caught up here
+    if current_app.config['QUIZ_EXPLANATIONS_EAGER']:
+        unexplained_topics = db.session.query(Quiz.topic_id).filter(Quiz.topic_id.in_(topic_ids), Quiz.explanation.is_(None)).distinct()
+        unexplained_subtopics = db.session.query(SubtopicQuiz.subtopic_id).filter(SubtopicQuiz.subtopic_id.in_(subtopic_ids), SubtopicQuiz.explanation.is_(None)).distinct()
+        for row in unexplained_topics:
+            tasks.append((f'explanations of topic {row.topic_id}', build_explanations, ('topic', row.topic_id)))
+        for row in unexplained_subtopics:
+            tasks.append((f'explanations of subtopic {row.subtopic_id}', build_explanations, ('subtopic', row.subtopic_id)))
+    return tasks
+
+
+def pregenerate_course(course_info_id, progress=None):
+    """Generate the syllabus, every quiz and every note of a course.
+
+    Work is spread over a bounded pool, paced to PREGENERATE_RPM (below the
+    gateway's own limits, so interactive requests keep some of the quota)
+    and retried with jittered exponential backoff. progress(done, total, failed) is called
+    after every task. Returns a summary dict.
+    """
+    config = current_app.config
+    app = current_app._get_current_object()
+    budget = TokenBucket(config['PREGENERATE_RPM'], capacity=1) if config['PREGENERATE_RPM'] else None
+    retries = config['PREGENERATE_RETRIES']
+
+    def pace():
+        if budget is not None:
+            time.sleep(budget.reserve(1))
+
+    pace()
+    course_id = build_course(course_info_id)
+    course = Course.query.get(course_id)
+    tasks = pending_tasks(course)
+    db.session.remove()
+
+    def run(name, func, args):
+        for attempt in range(retries + 1):
+            pace()
+            with app.app_context():
+                try:
+                    func(*args)
+                    return None
+                except Exception as e:
+                    db.session.rollback()
+                    error = e
+                finally:
+                    db.session.remove()
+            delay = (2 ** attempt) + random.uniform(0, 1)
+            if is_rate_limited(error) and budget is not None:
+                # A quota error pushes every worker's next start back
+                budget.adjust(budget.rate * delay * 5)
+            print(f"Pre-generation of {name} failed (attempt {attempt + 1}): {error}")
+            if attempt < retries:
+                time.sleep(delay)
+        return f'{name}: {error}'
+
+    done, failed = 0, []
+    if progress:
+        progress(done, len(tasks), len(failed))
+    with ThreadPoolExecutor(max_workers=config['PREGENERATE_WORKERS'], thread_name_prefix='pregenerate') as pool:
+        futures = [pool.submit(run, *task) for task in tasks]
+        for future in as_completed(futures):
+            error = future.result()
+            if error:
+                failed.append(error)
+            done += 1
+            if progress:
+                progress(done, len(tasks), len(failed))
+
+    return {'course_id': course_id, 'total': len(tasks), 'failed': failed}
@@ -0,0 +1,90 @@
+import json
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from grading import QUIZ_TABLES
+from models import db, QuizAttempt, StudentProgress
+
+# Dialects whose INSERT supports ON CONFLICT DO UPDATE ... RETURNING
+UPSERT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert
+}
+
+
+def record_attempt(user_id, quiz_type, topic_id, subtopic_id, quiz_name, quiz_course_name, graded):
+    """Log a graded attempt and add it to the user's progress row.
+
+    The progress row is incremented in the database with a single UPSERT,
+    so concurrent submissions never overwrite each other. Nothing is
+    committed; returns the new attempt count of the quiz.
+    """
+    db.session.add(QuizAttempt(
+        user_id=user_id,
+        quiz_type=quiz_type,
+        topic_id=topic_id,
+        subtopic_id=subtopic_id,
+        total_questions=graded['total'],
+        correct_questions=graded['correct'],
+        answers=json.dumps(graded['results'])
+    ))
+
+    table = StudentProgress.__table__
+    values = {
+        'user_id': user_id,
+        'quiz_name': quiz_name,
+        'quiz_course_name': quiz_course_name,
+        'total_questions': graded['total'],
+        'correct_questions': graded['correct'],
+        'quiz_counter': 1
+    }
+    increments = {
+        'total_questions': table.c.total_questions + graded['total'],
+        'correct_questions': table.c.correct_questions + graded['correct'],
+        'quiz_counter': table.c.quiz_counter + 1
+    }
+
+    insert = UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if insert is not None:
+        statement = insert(table).values(**values).on_conflict_do_update(
+            index_elements=['user_id', 'quiz_name', 'quiz_course_name'],
+            set_=increments
+        ).returning(table.c.quiz_counter)
+        return db.session.execute(statement).scalar_one()
+
+    # Other databases: atomic increment, insert when there is no row yet
+    match = (
+        (table.c.user_id == user_id)
+        & (table.c.quiz_name == quiz_name)
+        & (table.c.quiz_course_name == quiz_course_name)
+    )
+    updated = db.session.execute(table.update().where(match).values(**increments))
+    if updated.rowcount == 0:
+        db.session.execute(table.insert().values(**values))
+    return db.session.execute(db.select(table.c.quiz_counter).where(match)).scalar_one()
+
+
+def user_progress(user_id):
+    """The user's progress rows, one per quiz"""
+    return StudentProgress.query.filter_by(user_id=user_id).order_by(StudentProgress.id).all()
+
+
+def has_attempted(user_id, quiz_type, question_id):
+    """True once the user has submitted an attempt that graded this very question.
+
+    Attempts of a quiz that was recreated since hold the old question ids,
+    so they do not open the answers of the new questions.
+    """
+    model, quiz_column = QUIZ_TABLES[quiz_type]
+    attempt_column = QuizAttempt.topic_id if quiz_type == 'topic' else QuizAttempt.subtopic_id
+    answers = db.session.query(QuizAttempt.answers).join(model, quiz_column == attempt_column).filter(
+        model.id == question_id,
+        QuizAttempt.user_id == user_id,
+        QuizAttempt.quiz_type == quiz_type,
+        # Narrows the rows to parse; the JSON below decides
+        QuizAttempt.answers.contains(f'"question_id": {question_id},')
+    )
+    return any(
+        result['question_id'] == question_id
+        for (row,) in answers for result in json.loads(row)
+    )
@@ -0,0 +1,156 @@
+from sqlalchemy import case, func
+from sqlalchemy.orm import selectinload
+
+from models import db, ChatHistory, CourseInfo, Course, Topic, Subtopic, Quiz, SubtopicQuiz, StudentProgress
+
+# Answers the course model gives for questions that are not about a course
+EMPTY_ANSWERS = ('```json\n{}\n```', '{}\n', '{}')
+
+
+# Dashboard section.
+# Joins, grouping and ordering happen in SQL; the template only loops.
+
+def dashboard_messages(limit, before_id=None):
+    """Latest dashboard chat messages (oldest first) and whether earlier ones exist"""
+    query = (
+        db.session.query(
+            ChatHistory.id,
+            ChatHistory.sender,
+            # AI answers are raw course JSON, the page only needs the course they added
+            case((ChatHistory.sender == 'user', ChatHistory.text), else_=None).label('text'),
+            ChatHistory.text.in_(EMPTY_ANSWERS).label('is_empty'),
+            CourseInfo.course_code,
+            CourseInfo.course_name
+        )
+        .outerjoin(CourseInfo, CourseInfo.id == ChatHistory.course_id)
+        .filter(ChatHistory.channel == 'course')
+    )
+    if before_id is not None:
+        query = query.filter(ChatHistory.id < before_id)
+    rows = query.order_by(ChatHistory.id.desc()).limit(limit + 1).all()
+
+    has_earlier = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    messages = [
+        {
+            'id': row.id,
+            'sender': row.sender,
+            'text': row.text,
+            'is_empty': bool(row.is_empty),
+            'course_code': row.course_code,
+            'course_name': row.course_name
+        }
+        for row in rows
+    ]
+    return messages, has_earlier
+
+
+def grouped_progress(user_id):
+    """A user's quiz progress grouped by course, with per-course totals"""
+    totals = (
+        db.session.query(
+            StudentProgress.quiz_course_name,
+            func.sum(StudentProgress.total_questions).label('total'),
+            func.sum(StudentProgress.correct_questions).label('correct')
+        )
+        .filter(StudentProgress.user_id == user_id)
+        .group_by(StudentProgress.quiz_course_name)
+        .order_by(func.min(StudentProgress.id))
+        .all()
+    )
+    quizzes = (
+        db.session.query(
+            StudentProgress.quiz_course_name,
+            StudentProgress.quiz_name,
+            StudentProgress.total_questions,
+            StudentProgress.correct_questions,
+            StudentProgress.quiz_counter
+        )
+        .filter(StudentProgress.user_id == user_id)
+        .order_by(StudentProgress.id)
+        .all()
+    )
+
+    courses = {}
+    for row in totals:
+        total, correct = int(row.total or 0), int(row.correct or 0)
+        courses[row.quiz_course_name] = {
+            'course_name': row.quiz_course_name,
+            'total': total,
+            'correct': correct,
+            # Progress bars come in steps of ten
+            'percent': int(round(correct / total * 100, -1)) if total > 0 else 0,
+            'quizzes': []
+        }
+    for row in quizzes:
+        courses[row.quiz_course_name]['quizzes'].append({
+            'name': row.quiz_name,
+            'total': row.total_questions,
+            'correct': row.correct_questions,
+            'attempts': row.quiz_counter
+        })
+    return list(courses.values())
+
+
+def dashboard_data(user_id, page=1, before_id=None, history_limit=50, courses_per_page=20):
+    """Everything student_dashboard.html renders, in one precomputed view model"""
+    messages, has_earlier = dashboard_messages(history_limit, before_id)
+    courses = db.paginate(
+        db.select(CourseInfo).order_by(CourseInfo.id),
+        page=page, per_page=courses_per_page, error_out=False
+    )
+    return {
+        'messages': messages,
+        'has_earlier': has_earlier,
+        'earliest_id': messages[0]['id'] if messages else None,
+        'progress': grouped_progress(user_id),
+        'courses': courses
+    }
+
+
+# Course tree section.
+# Pages and chatbot answers that walk course -> topics -> subtopics load the
+# whole tree up front instead of lazy-loading it level by level.
+
+def load_course_trees(*criteria):
+    """Courses matching criteria with their topics, subtopics and quiz flags.
+
+    Costs the same five queries however many courses, topics and subtopics
+    there are. Every topic and subtopic gets a has_quiz attribute.
+    """
+    courses = (
+        Course.query.filter(*criteria)
+        .options(selectinload(Course.topics).selectinload(Topic.subtopics))
+        .order_by(Course.id)
+        .all()
+    )
+    course_ids = [course.id for course in courses]
+    if not course_ids:
+        return courses
+
+    topics_with_quiz = {
+        row.id for row in db.session.query(Topic.id).filter(
+            Topic.course_id.in_(course_ids),
+            db.exists().where(Quiz.topic_id == Topic.id)
+        )
+    }
+    subtopics_with_quiz = {
+        row.id for row in db.session.query(Subtopic.id).join(Topic).filter(
+            Topic.course_id.in_(course_ids),
+            db.exists().where(SubtopicQuiz.subtopic_id == Subtopic.id)
+        )
+    }
+
+    for course in courses:
+        for topic in course.topics:
+            topic.has_quiz = topic.id in topics_with_quiz
+            for subtopic in topic.subtopics:
+                subtopic.has_quiz = subtopic.id in subtopics_with_quiz
+    return courses
+
+
+def load_course_tree(course_info_id):
+    """The course generated for a CourseInfo, as a loaded tree, or None"""
+    courses = load_course_trees(Course.course_info_id == course_info_id)
+    return courses[0] if courses else None
@@ -0,0 +1,115 @@
+import json
+import uuid
+from datetime import datetime, timedelta
+
+from flask import session
+from sqlalchemy.exc import IntegrityError
+
+from cache import LRUCache
+from models import db, QuizState
+
+
+class MemoryQuizStateBackend:
+    """Per-process LRU, only suitable when a single worker serves the app"""
+
+    def __init__(self, max_size=10000, ttl=7200):
+        self.data = LRUCache(max_size=max_size, ttl=ttl)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data.set(key, value)
+
+    def delete(self, key):
+        self.data.delete(key)
+
+
+class DatabaseQuizStateBackend:
+    """quiz_state table, shared by every worker and process"""
+    purge_every = 100
+
+    def __init__(self, ttl=7200):
+        self.ttl = ttl
+        self._writes = 0
+
+    def get(self, key):
+        table = QuizState.__table__
+        # Own connection so quiz state never touches the request's session
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                db.select(table.c.data).where(table.c.key == key, table.c.expires_at > datetime.utcnow())
+            ).first()
+        return json.loads(row.data) if row else None
+
+    def set(self, key, value):
+        table = QuizState.__table__
+        now = datetime.utcnow()
+        values = {'data': json.dumps(value), 'expires_at': now + timedelta(seconds=self.ttl)}
+        self._writes += 1
+        try:
+            with db.engine.begin() as conn:
+                updated = conn.execute(table.update().where(table.c.key == key).values(**values))
+                if updated.rowcount == 0:
+                    conn.execute(table.insert().values(key=key, **values))
+                # Expired rows are swept now and then instead of on every write
+                if self._writes % self.purge_every == 0:
+                    conn.execute(table.delete().where(table.c.expires_at <= now))
+        except IntegrityError:
+            # A parallel request of the same browser stored the quiz first
+            pass
+
+    def delete(self, key):
+        table = QuizState.__table__
+        with db.engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.key == key))
+
+
+QUIZ_STATE_BACKENDS = {
+    'memory': lambda config: MemoryQuizStateBackend(max_size=config['QUIZ_STATE_SIZE'], ttl=config['QUIZ_STATE_TTL']),
+    'database': lambda config: DatabaseQuizStateBackend(ttl=config['QUIZ_STATE_TTL'])
+}
+
+
+class QuizStateStore:
+    """Server-side state of the quizzes a browser has open.
+
+    The Flask session only carries an opaque random id; question sets and
+    answer keys stay in the configured backend and expire after
+    QUIZ_STATE_TTL seconds.
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend_name = app.config['QUIZ_STATE_BACKEND']
+        if backend_name not in QUIZ_STATE_BACKENDS:
+            raise ValueError(f"Unknown quiz state backend: {backend_name}")
+        self.backend = QUIZ_STATE_BACKENDS[backend_name](app.config)
+        app.extensions['quiz_state'] = self
+
+    def _key(self, name, create=False):
+        state_id = session.get('quiz_state_id')
+        if state_id is None:
+            if not create:
+                return None
+            state_id = session['quiz_state_id'] = uuid.uuid4().hex
+        return f'{state_id}:{name}'
+
+    def get(self, name):
+        key = self._key(name)
+        return self.backend.get(key) if key else None
+
+    def set(self, name, value):
+        self.backend.set(self._key(name, create=True), value)
+
+    def pop(self, name):
+        key = self._key(name)
+        if key:
+            self.backend.delete(key)
+
+
+quiz_states = QuizStateStore()
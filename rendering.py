@@ -0,0 +1,75 @@
+import hashlib
+import threading
+
+from markdown2 import Markdown
+from markupsafe import Markup
+
+from cache import LRUCache
+
+# Extras for model output: math, fenced code and tables
+MARKDOWN_EXTRAS = {
+    'fenced-code-blocks': None,
+    'tables': None,
+    'break-on-newline': True,
+    'header-ids': None,
+    'markdown-in-html': True,
+    'math': None
+}
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class MarkdownRenderer:
+    """Markdown to HTML conversion shared by notes, explanations and chat replies.
+
+    Each thread reuses one converter instead of building a new one per call,
+    and rendered HTML is cached by the hash of its source, so the same text
+    is only converted once per RENDER_CACHE_TTL seconds.
+    """
+
+    def __init__(self, app=None, max_size=2048, ttl=24 * 3600):
+        self.cache = LRUCache(max_size=max_size, ttl=ttl)
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache = LRUCache(max_size=app.config['RENDER_CACHE_SIZE'], ttl=app.config['RENDER_CACHE_TTL'])
+        app.extensions['renderer'] = self
+
+    @property
+    def converter(self):
+        # markdown2 converters keep state while converting, so they are not shared between threads
+        converter = getattr(self._local, 'converter', None)
+        if converter is None:
+            converter = self._local.converter = Markdown(extras=MARKDOWN_EXTRAS)
+        return converter
+
+    def render(self, text):
+        """Safe HTML of model markdown, converted at most once per distinct text"""
+        key = content_hash(text)
+        html = self.cache.get(key)
+        if html is not None:
+            self.hits += 1
+            return Markup(html)
+
+        self.misses += 1
+        html = self.converter.convert(text)
+        self.cache.set(key, str(html))
+        return Markup(html)
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+            'size': len(self.cache)
+        }
+
+
+renderer = MarkdownRenderer()
@@ -0,0 +1,188 @@
+import re
+import threading
+from collections import namedtuple
+
+from models import Note, Quiz, SubtopicQuiz
+from cache import LRUCache
+from llm import estimate_tokens
+from search import search_index, vectorize, TOKEN
+
+Chunk = namedtuple('Chunk', 'kind id title heading text tokens')
+
+HEADING = re.compile(r'^#{1,6}\s+(.*)$')
+# Question words that say nothing about the subject, in English and Turkish
+STOP_WORDS = {
+    'what', 'is', 'are', 'was', 'the', 'a', 'an', 'of', 'in', 'on', 'for', 'to', 'and', 'or', 'how', 'why',
+    'does', 'do', 'can', 'you', 'me', 'my', 'explain', 'tell', 'about', 'define', 'definition', 'meaning',
+    'mean', 'please', 'give', 'show', 'describe', 'nedir', 'ne', 'nasıl', 'neden', 'nelerdir', 'hakkında',
+    'bilgi', 'ver', 'açıkla', 'anlat', 'bir', 'ile', 've', 'mi', 'mı', 'mu', 'mü', 'için', 'bana'
+}
+QUESTION_TABLES = {'quiz': Quiz, 'subtopic_quiz': SubtopicQuiz}
+
+
+def keywords(text):
+    return [word for word in TOKEN.findall(text.lower()) if word not in STOP_WORDS]
+
+
+def note_chunks(note, max_tokens):
+    """Sections of a note's markdown, split at headings and, when too long, at paragraphs"""
+    title = f'{note.topic.topic_name} - {note.subtopic.subtopic_name}'
+    sections, heading, lines = [], None, []
+    for line in (note.source or '').splitlines():
+        match = HEADING.match(line)
+        if match:
+            sections.append((heading, lines))
+            heading, lines = match.group(1).strip(), []
+        lines.append(line)
+    sections.append((heading, lines))
+
+    chunks = []
+    for heading, lines in sections:
+        # Sections holding only their heading, like a title above the first subheading, are left out
+        if not any(line.strip() and not HEADING.match(line) for line in lines):
+            continue
+        text = '\n'.join(lines).strip()
+        parts = [text]
+        if estimate_tokens(text) > max_tokens:
+            parts, current = [], ''
+            for paragraph in text.split('\n\n'):
+                if current and estimate_tokens(current + paragraph) > max_tokens:
+                    parts.append(current.strip())
+                    current = ''
+                current += paragraph + '\n\n'
+            parts.append(current.strip())
+        chunks += [Chunk('note', note.id, title, heading, part, estimate_tokens(part)) for part in parts if part]
+    return chunks
+
+
+def question_chunk(kind, question):
+    # Only the question and its options: the chat must not hand out quiz answers
+    text = (
+        f'{question.question}\nA) {question.option_a}\nB) {question.option_b}\n'
+        f'C) {question.option_c}\nD) {question.option_d}'
+    )
+    return Chunk(kind, question.id, 'Quiz question', None, text, estimate_tokens(text))
+
+
+class Retriever:
+    """Selects the stored notes and quiz questions relevant to a chat question.
+
+    Candidates come from the search index; their chunks are scored against
+    the question and the best ones are packed into CHAT_CONTEXT_TOKENS. A
+    question that a note section answers by itself (its heading covers
+    every keyword of the question) is answered with that section, without
+    a model call.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.budget = 1200
+        self.candidates = 8
+        self.chunk_tokens = 300
+        self.min_score = 0.1
+        self.fast_path_score = 0.3
+        self.chunks = LRUCache(max_size=1024, ttl=24 * 3600)
+        self.stats = {'questions': 0, 'grounded': 0, 'fast_path': 0, 'context_tokens': 0}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['CHAT_RETRIEVAL_ENABLED']
+        self.budget = app.config['CHAT_CONTEXT_TOKENS']
+        self.candidates = app.config['CHAT_RETRIEVAL_CANDIDATES']
+        self.min_score = app.config['CHAT_RETRIEVAL_MIN_SCORE']
+        self.fast_path_score = app.config['CHAT_FAST_PATH_SCORE']
+        app.extensions['retriever'] = self
+
+    def _document_chunks(self, kind, item_id):
+        """Chunks of a document and their vectors, cached as notes and questions do not change"""
+        cached = self.chunks.get((kind, item_id))
+        if cached is not None:
+            return cached
+        if kind == 'note':
+            note = Note.query.get(item_id)
+            chunks = note_chunks(note, self.chunk_tokens) if note else []
+        else:
+            question = QUESTION_TABLES[kind].query.get(item_id)
+            chunks = [question_chunk(kind, question)] if question else []
+        texts = [f'{chunk.heading or ""} {chunk.text}' for chunk in chunks]
+        cached = (chunks, vectorize(texts, search_index.dimensions) if chunks else None)
+        self.chunks.set((kind, item_id), cached)
+        return cached
+
+    def retrieve(self, question):
+        """Chunks relevant to question, best first, together within the token budget"""
+        if not self.enabled or not question:
+            return []
+        hits = search_index.semantic_search(question, self.candidates, kinds=('note', 'quiz', 'subtopic_quiz'))
+        vector = search_index.query_vector(question)
+        if not hits or vector is None:
+            return []
+
+        scored = []
+        for kind, item_id, _ in hits:
+            chunks, vectors = self._document_chunks(kind, item_id)
+            if chunks:
+                scored += zip(vectors @ vector, range(len(scored), len(scored) + len(chunks)), chunks)
+        scored.sort(key=lambda item: (-item[0], item[1]))
+
+        selected, used, seen = [], 0, set()
+        for score, _, chunk in scored:
+            if score < self.min_score:
+                break
+            # Generated notes repeat each other, the same text is only sent once
+            if used + chunk.tokens > self.budget or chunk.text in seen:
+                continue
+            selected.append((float(score), chunk))
+            seen.add(chunk.text)
+            used += chunk.tokens
+        return selected
+
+    def fast_answer(self, question, selected):
+        """A stored note section that answers the question on its own, or None"""
+        if not selected:
+            return None
+        score, chunk = selected[0]
+        words = keywords(question)
+        if chunk.kind != 'note' or not chunk.heading or score < self.fast_path_score or not 0 < len(words) <= 4:
+            return None
+        heading = keywords(chunk.heading)
+        # Prefix matches let Turkish suffixes and plurals through
+        if not all(any(h.startswith(w) or (len(h) >= 4 and w.startswith(h)) for h in heading) for w in words):
+            return None
+        return f'{chunk.text}\n\n*From your lecture note: {chunk.title}*'
+
+    def grounded_prompt(self, selected, conversation):
+        if not selected:
+            return conversation
+        sources = '\n\n'.join(
+            f'[{i}] {chunk.title}' + (f' / {chunk.heading}' if chunk.heading else '') + f'\n{chunk.text}'
+            for i, (_, chunk) in enumerate(selected, 1)
+        )
+        return (
+            "Course material of the student that may be relevant to the last question:\n\n"
+            f"{sources}\n\n"
+            "Answer the last question using this material where it applies, citing it by number "
+            "instead of repeating it. If it does not cover the question, answer from general knowledge.\n\n"
+            f"{conversation}"
+        )
+
+    def record(self, selected, fast_path):
+        with self._lock:
+            self.stats['questions'] += 1
+            if fast_path:
+                self.stats['fast_path'] += 1
+            elif selected:
+                self.stats['grounded'] += 1
+                self.stats['context_tokens'] += sum(chunk.tokens for _, chunk in selected)
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self.stats)
+        grounded = metrics['grounded']
+        metrics['avg_context_tokens'] = round(metrics.pop('context_tokens') / grounded, 1) if grounded else 0
+        return metrics
+
+
+retriever = Retriever()
@@ -0,0 +1,422 @@
+"""Search over courses, notes and quizzes.
+
+Two rankings are merged with reciprocal rank fusion:
+
+- lexical: PostgreSQL full-text search over GIN expression indexes
+  (migrations 0007 and 0008), or substring matching on other databases;
+- semantic: cosine similarity of hashed word, word-pair and character
+  trigram vectors, kept in a NumPy index on disk. Small indexes are scanned
+  in full; from SEARCH_IVF_MIN_DOCS documents on, only the clusters nearest
+  to the query are (an inverted file over spherical k-means centroids).
+
+The index is stored as append-only segment files. New notes, quizzes and
+courses are added by update(), which indexes the rows above the highest id
+seen for each kind. Once there are SEARCH_MAX_SEGMENTS segments they are
+merged, dropping deleted rows; `flask search-index` rebuilds it from scratch.
+"""
+import contextlib
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+
+import numpy as np
+from markupsafe import Markup
+
+from models import db, CourseInfo, Note, Quiz, SubtopicQuiz
+from jobs import jobs
+
+# Kinds of document, their tables and the column with a full-text index (for notes
+# the markdown, whose HTML would match tag and class names; older notes only have HTML)
+KINDS = {'course': 0, 'note': 1, 'quiz': 2, 'subtopic_quiz': 3}
+KIND_NAMES = {code: kind for kind, code in KINDS.items()}
+TABLES = {'course': CourseInfo, 'note': Note, 'quiz': Quiz, 'subtopic_quiz': SubtopicQuiz}
+FTS_COLUMNS = {
+    'course': CourseInfo.description,
+    'note': db.func.coalesce(Note.source, Note.content),
+    'quiz': Quiz.question,
+    'subtopic_quiz': SubtopicQuiz.question
+}
+# Language-neutral parsing: courses and notes mix Turkish and English
+TS_CONFIG = db.literal_column("'simple'::regconfig")
+
+TOKEN = re.compile(r'\w+')
+TAG = re.compile(r'<[^>]+>')
+# Weight of each feature type in the hashed vectors
+WORD_WEIGHT, PAIR_WEIGHT, TRIGRAM_WEIGHT = 1.0, 0.5, 0.25
+RRF_K = 60
+
+
+def document_text(kind, row):
+    if kind == 'course':
+        return f'{row.course_name} {row.description}'
+    if kind == 'note':
+        return row.source or TAG.sub(' ', row.content)
+    return f'{row.question} {row.option_a} {row.option_b} {row.option_c} {row.option_d}'
+
+
+def features(text):
+    """Hashed features of a text: words, word pairs and trigrams of padded words"""
+    words = TOKEN.findall(text.lower())
+    result = [(word, WORD_WEIGHT) for word in words]
+    result += [(f'{a} {b}', PAIR_WEIGHT) for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f'<{word}>'
+        result += [(padded[i:i + 3], TRIGRAM_WEIGHT) for i in range(len(padded) - 2)]
+    return result
+
+
+def vectorize(texts, dimensions):
+    """L2-normalized signed hashing vectors of texts, one row each"""
+    rows, columns, values = [], [], []
+    for i, text in enumerate(texts):
+        for feature, weight in features(text):
+            h = zlib.crc32(feature.encode('utf-8'))
+            rows.append(i)
+            columns.append(h % dimensions)
+            # The top bit picks a sign, so colliding features tend to cancel out
+            values.append(weight if h >> 31 else -weight)
+
+    vectors = np.zeros((len(texts), dimensions), dtype=np.float32)
+    np.add.at(vectors, (np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64)), np.array(values, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def kmeans(vectors, clusters, iterations=8, seed=0):
+    """Spherical k-means: centroids of unit vectors and the cluster of every vector"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Empty clusters keep their previous centroid
+        centroids = np.where(norms > 0, sums / np.where(norms > 0, norms, 1), centroids)
+    return centroids, nearest(vectors, centroids)
+
+
+def nearest(vectors, centroids, chunk=8192):
+    return np.concatenate([
+        np.argmax(vectors[start:start + chunk] @ centroids.T, axis=1)
+        for start in range(0, len(vectors), chunk)
+    ]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    if not k:
+        return np.zeros(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+class SearchIndex:
+    """Lexical and vector search, with the vector index kept on disk.
+
+    The vectors of each process are loaded lazily and caught up with the
+    database by a background job at most every SEARCH_REFRESH_INTERVAL
+    seconds, so documents created by other workers show up too; queries
+    meanwhile use the index as it is. Results whose rows have since
+    been deleted are dropped when they are loaded.
+    """
+
+    def __init__(self, app=None):
+        self.path = None
+        self.dimensions = 1024
+        self.ivf_min_docs = 20000
+        self.probes = 8
+        self.refresh_interval = 30
+        self.max_segments = 32
+        self.min_score = 0.05
+        self._state = None
+        self._refreshed_at = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config['SEARCH_INDEX_PATH'] or os.path.join(app.instance_path, 'search_index')
+        self.dimensions = app.config['SEARCH_DIMENSIONS']
+        self.ivf_min_docs = app.config['SEARCH_IVF_MIN_DOCS']
+        self.probes = app.config['SEARCH_IVF_PROBES']
+        self.refresh_interval = app.config['SEARCH_REFRESH_INTERVAL']
+        self.max_segments = app.config['SEARCH_MAX_SEGMENTS']
+        self.min_score = app.config['SEARCH_MIN_SCORE']
+        app.extensions['search_index'] = self
+
+    # Index state: vectors with the kind and id of each row, document
+    # frequencies of the hashed features, the optional IVF clustering and
+    # the segment files the rows were read from
+
+    def _empty_state(self):
+        return {
+            'vectors': np.zeros((0, self.dimensions), dtype=np.float32),
+            'kinds': np.zeros(0, dtype=np.int8),
+            'ids': np.zeros(0, dtype=np.int64),
+            'df': np.zeros(self.dimensions, dtype=np.int64),
+            'centroids': None,
+            'assignments': None,
+            'segments': []
+        }
+
+    def _segments(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(
+            os.path.join(self.path, name) for name in os.listdir(self.path)
+            if name.startswith('segment-') and name.endswith('.npz')
+        )
+
+    def _load(self):
+        state = self._empty_state()
+        parts = []
+        for segment in self._segments():
+            try:
+                data = np.load(segment)
+            except FileNotFoundError:
+                # Merged by another worker since it was listed; its rows are in the merged segment
+                return self._load()
+            with data:
+                if data['vectors'].shape[1] != self.dimensions:
+                    # Built with other settings, `flask search-index` rebuilds it
+                    continue
+                parts.append((data['vectors'], data['kinds'], data['ids']))
+            state['segments'].append(segment)
+        if parts:
+            vectors, kinds, ids = (np.concatenate(column) for column in zip(*parts))
+            # Processes catching up at the same time may index a row twice, keep the last copy
+            keys = ids * len(KINDS) + kinds
+            _, last = np.unique(keys[::-1], return_index=True)
+            keep = np.sort(len(keys) - 1 - last)
+            state = self._with_rows(state, vectors[keep], kinds[keep], ids[keep])
+        return self._clustered(state)
+
+    def _with_rows(self, state, vectors, kinds, ids):
+        state = dict(state)
+        state['vectors'] = np.concatenate([state['vectors'], vectors])
+        state['kinds'] = np.concatenate([state['kinds'], kinds.astype(np.int8)])
+        state['ids'] = np.concatenate([state['ids'], ids.astype(np.int64)])
+        state['df'] = state['df'] + np.count_nonzero(vectors, axis=0)
+        if state['centroids'] is not None:
+            state['assignments'] = np.concatenate([state['assignments'], nearest(vectors, state['centroids'])])
+        return state
+
+    def _clustered(self, state):
+        count = len(state['ids'])
+        if count >= self.ivf_min_docs:
+            state['centroids'], state['assignments'] = kmeans(state['vectors'], int(np.sqrt(count)))
+        return state
+
+    def _write_segment(self, vectors, kinds, ids):
+        os.makedirs(self.path, exist_ok=True)
+        # Timestamped names keep the segments in the order they were written
+        name = f'segment-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.npz'
+        temporary = os.path.join(self.path, f'.{name}')
+        with open(temporary, 'wb') as f:
+            np.savez(f, vectors=vectors, kinds=kinds.astype(np.int8), ids=ids.astype(np.int64))
+        os.replace(temporary, os.path.join(self.path, name))
+        return os.path.join(self.path, name)
+
+    def _compact(self, state):
+        """Merge the segments of state into one, without the rows deleted since"""
+        keep = np.zeros(len(state['ids']), dtype=bool)
+        for kind, model in TABLES.items():
+            mine = state['kinds'] == KINDS[kind]
+            existing = np.array([row[0] for row in db.session.query(model.id)], dtype=np.int64)
+            keep |= mine & np.isin(state['ids'], existing)
+
+        compacted = self._with_rows(self._empty_state(), state['vectors'][keep], state['kinds'][keep], state['ids'][keep])
+        compacted['segments'] = [self._write_segment(compacted['vectors'], compacted['kinds'], compacted['ids'])]
+        # Only segments already merged are removed, others may be new from another worker
+        for segment in state['segments']:
+            # Another worker may have compacted it away already
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(segment)
+        return self._clustered(compacted)
+
+    def _new_documents(self, state, batch_size=500):
+        """Rows of every kind above the highest id already in the index, in batches"""
+        for kind, model in TABLES.items():
+            indexed = state['ids'][state['kinds'] == KINDS[kind]]
+            last_id = int(indexed.max()) if len(indexed) else 0
+            while True:
+                rows = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+                if not rows:
+                    break
+                yield kind, rows
+                last_id = rows[-1].id
+
+    def _index_rows(self, state, kind, rows):
+        vectors = vectorize([document_text(kind, row) for row in rows], self.dimensions)
+        kinds = np.full(len(rows), KINDS[kind], dtype=np.int8)
+        ids = np.array([row.id for row in rows], dtype=np.int64)
+        segment = self._write_segment(vectors, kinds, ids)
+        state = self._with_rows(state, vectors, kinds, ids)
+        state['segments'] = state['segments'] + [segment]
+        return state
+
+    def state(self):
+        with self._lock:
+            if self._state is None:
+                self._state = self._load()
+            return self._state
+
+    def update(self):
+        """Index the notes, quizzes and courses created since the last update; returns how many"""
+        with self._lock:
+            state = self._state if self._state is not None else self._load()
+            added = 0
+            for kind, rows in self._new_documents(state):
+                state = self._index_rows(state, kind, rows)
+                added += len(rows)
+            if len(state['segments']) > self.max_segments:
+                state = self._compact(state)
+            self._state = state
+            self._refreshed_at = time.monotonic()
+        return added
+
+    def rebuild(self):
+        """Index every document again into a single segment; returns how many"""
+        with self._lock:
+            state = self._empty_state()
+            parts = []
+            for kind, rows in self._new_documents(state):
+                vectors = vectorize([document_text(kind, row) for row in rows], self.dimensions)
+                parts.append((vectors, np.full(len(rows), KINDS[kind], dtype=np.int8), np.array([row.id for row in rows], dtype=np.int64)))
+            if parts:
+                vectors, kinds, ids = (np.concatenate(column) for column in zip(*parts))
+                state = self._with_rows(state, vectors, kinds, ids)
+
+            old_segments = self._segments()
+            state['segments'] = [self._write_segment(state['vectors'], state['kinds'], state['ids'])]
+            for segment in old_segments:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(segment)
+            self._state = self._clustered(state)
+            self._refreshed_at = time.monotonic()
+            return len(state['ids'])
+
+    # Queries
+
+    def query_vector(self, query, state=None):
+        """Unit vector of a query, with rare features weighted up by their inverse document frequency"""
+        state = state or self.state()
+        idf = np.log((1 + len(state['ids'])) / (1 + state['df'])).astype(np.float32) + 1
+        vector = vectorize([query], self.dimensions)[0] * idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def semantic_search(self, query, limit, kinds=None):
+        """(kind, id, score) of the documents closest to the query, optionally only of some kinds"""
+        if time.monotonic() - self._refreshed_at > self.refresh_interval:
+            # Catching up reads the database and writes segments, so requests leave it to a job
+            queue_index_update()
+        state = self.state()
+        count = len(state['ids'])
+        if not count:
+            return []
+        vector = self.query_vector(query, state)
+        if vector is None:
+            return []
+
+        if state['centroids'] is not None:
+            probed = top_k(state['centroids'] @ vector, self.probes)
+            candidates = np.flatnonzero(np.isin(state['assignments'], probed))
+        else:
+            candidates = np.arange(count)
+        if kinds is not None:
+            candidates = candidates[np.isin(state['kinds'][candidates], [KINDS[kind] for kind in kinds])]
+        scores = state['vectors'][candidates] @ vector
+        best = top_k(scores, limit)
+        return [
+            (KIND_NAMES[int(state['kinds'][candidates[i]])], int(state['ids'][candidates[i]]), float(scores[i]))
+            for i in best if scores[i] >= self.min_score
+        ]
+
+    def lexical_search(self, query, limit):
+        """(kind, id, rank) of full-text matches, best first within each kind"""
+        terms = TOKEN.findall(query)
+        if not terms:
+            return []
+        results = []
+        postgresql = db.session.get_bind().dialect.name == 'postgresql'
+        for kind, column in FTS_COLUMNS.items():
+            model = TABLES[kind]
+            if postgresql:
+                vector = db.func.to_tsvector(TS_CONFIG, column)
+                tsquery = db.func.websearch_to_tsquery(TS_CONFIG, query)
+                rank = db.func.ts_rank(vector, tsquery)
+                rows = db.session.query(model.id, rank).filter(vector.op('@@')(tsquery)).order_by(rank.desc()).limit(limit)
+            else:
+                rows = (
+                    db.session.query(model.id, db.literal(1.0))
+                    .filter(*[column.ilike(f'%{term}%') for term in terms])
+                    .order_by(model.id.desc()).limit(limit)
+                )
+            results += [(kind, row[0], float(row[1])) for row in rows]
+        return results
+
+    def search(self, query, limit=10):
+        """Best matches of both rankings, merged by reciprocal rank fusion"""
+        scores = {}
+        lexical = self.lexical_search(query, limit)
+        for ranking in (sorted(lexical, key=lambda r: -r[2]), self.semantic_search(query, limit * 2)):
+            for rank, (kind, item_id, _) in enumerate(ranking):
+                scores[(kind, item_id)] = scores.get((kind, item_id), 0) + 1 / (RRF_K + rank + 1)
+        ranked = sorted(scores, key=lambda key: -scores[key])
+        return self._hydrate(ranked, limit)
+
+    def _hydrate(self, keys, limit):
+        """Result dicts of the keys whose rows still exist, in the given order"""
+        rows = {}
+        for kind, model in TABLES.items():
+            ids = [item_id for key_kind, item_id in keys if key_kind == kind]
+            if ids:
+                rows.update(((kind, row.id), row) for row in model.query.filter(model.id.in_(ids)))
+
+        results = []
+        for key in keys:
+            row = rows.get(key)
+            if row is not None:
+                results.append(self._result(key[0], row))
+            if len(results) == limit:
+                break
+        return results
+
+    def _result(self, kind, row):
+        if kind == 'course':
+            return {'kind': kind, 'id': row.id, 'title': row.course_name, 'snippet': snippet(row.description), 'course_id': row.id}
+        if kind == 'note':
+            return {
+                'kind': kind, 'id': row.id, 'title': f'{row.topic.topic_name} - {row.subtopic.subtopic_name}',
+                'snippet': snippet(row.content),
+                'course_id': row.course.course_info_id, 'topic': row.topic.topic_name, 'subtopic': row.subtopic.subtopic_name
+            }
+        if kind == 'quiz':
+            return {'kind': kind, 'id': row.id, 'title': row.question, 'snippet': '', 'topic_id': row.topic_id}
+        return {'kind': kind, 'id': row.id, 'title': row.question, 'snippet': '', 'subtopic_id': row.subtopic_id}
+
+    def metrics(self):
+        state = self._state
+        return {
+            'documents': len(state['ids']) if state else 0,
+            'segments': len(state['segments']) if state else 0,
+            'ivf': bool(state and state['centroids'] is not None)
+        }
+
+
+def snippet(text, length=200):
+    text = ' '.join(Markup(text).striptags().split()) if text else ''
+    return text if len(text) <= length else text[:length].rsplit(' ', 1)[0] + '…'
+
+
+def queue_index_update():
+    """Add newly created documents to this process's index in the background"""
+    jobs.submit(('search_index',), search_index.update)
+
+
+search_index = SearchIndex()
@@ -0,0 +1,174 @@
+import re
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+from search import vectorize, TOKEN
+from retrieval import STOP_WORDS
+
+# "CS 101", "cs-101" and "CS101" are the same course code
+COURSE_CODE = re.compile(r'\b([a-z]{2,5})[\s_-]*(\d{2,4}[a-z]?)\b')
+# Words that do not tell questions about courses apart
+NOISE_WORDS = STOP_WORDS | {'course', 'courses', 'info', 'information', 'ders', 'dersi', 'dersin', 'dersleri'}
+# Words of a message that refers back to the conversation it is part of
+FOLLOW_UP_WORDS = {
+    'it', 'its', 'this', 'that', 'these', 'those', 'again', 'above', 'previous', 'earlier', 'last', 'more',
+    'bu', 'bunu', 'bunun', 'şu', 'şunu', 'onu', 'onun', 'tekrar', 'yine', 'yukarıdaki', 'önceki', 'daha'
+}
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = COURSE_CODE.sub(r'\1\2', text)
+    return ' '.join(word for word in TOKEN.findall(text) if word not in NOISE_WORDS)
+
+
+def course_code(text):
+    """Course code mentioned in a question, normalized like CourseInfo codes are compared, or None"""
+    match = COURSE_CODE.search(unicodedata.normalize('NFKC', text).lower())
+    return (match.group(1) + match.group(2)).upper() if match else None
+
+
+class ModelStore:
+    """Fixed-size table of prompt vectors and answers of one model"""
+
+    def __init__(self, size, dimensions):
+        self.vectors = np.zeros((size, dimensions), dtype=np.float32)
+        self.entries = [None] * size  # (normalized prompt, numbers in it, answer)
+        self.scopes = np.full(size, None, dtype=object)
+        self.created = np.full(size, -np.inf)
+        self.used = np.full(size, -np.inf)
+        self.rows = {}  # (scope, normalized prompt) -> row
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+class SemanticCache:
+    """Answers of earlier prompts that mean the same, per model.
+
+    Prompts are normalized (case, course code spelling, question words) and
+    embedded with the search index's hashing vectorizer; a lookup returns
+    the answer of the most similar stored prompt if it reaches the model's
+    threshold and mentions the same numbers, so "CS101" never answers for
+    "CS102". Each model keeps SEMANTIC_CACHE_SIZE entries, replacing expired
+    ones first and then the least recently used.
+
+    Answers that depend on who asked, like chat replies generated with the
+    user's conversation, are stored under a scope (the user id) and only
+    served within it. Their prompts must also stand on their own: messages
+    that refer back to the conversation ("explain that again") are not
+    cached at all.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.thresholds = {'course': 0.9, 'chat': 0.92}
+        # Short chat messages are often follow-ups that only make sense in their conversation
+        self.min_words = {'chat': 3}
+        self.scoped = {'chat'}
+        self.size = 1000
+        self.ttl = 24 * 3600
+        self.dimensions = 1024
+        self.exact_hits = 0
+        self.stores = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['SEMANTIC_CACHE_ENABLED']
+        self.thresholds = dict(app.config['SEMANTIC_CACHE_THRESHOLDS'])
+        self.size = app.config['SEMANTIC_CACHE_SIZE']
+        self.ttl = app.config['SEMANTIC_CACHE_TTL']
+        self.dimensions = app.config['SEARCH_DIMENSIONS']
+        app.extensions['semantic_cache'] = self
+
+    def _key(self, model_name, prompt, scope):
+        """Normalized prompt and its vector, or None when the model or prompt is not cached"""
+        if not self.enabled or model_name not in self.thresholds or not prompt:
+            return None
+        if model_name in self.scoped:
+            if scope is None or FOLLOW_UP_WORDS.intersection(TOKEN.findall(prompt.lower())):
+                return None
+        normalized = normalize(prompt)
+        if len(normalized.split()) < self.min_words.get(model_name, 1):
+            return None
+        return normalized, vectorize([normalized], self.dimensions)[0]
+
+    def _store(self, model_name):
+        store = self.stores.get(model_name)
+        if store is None:
+            store = self.stores[model_name] = ModelStore(self.size, self.dimensions)
+        return store
+
+    def get(self, model_name, prompt, scope=None):
+        key = self._key(model_name, prompt, scope)
+        if key is None:
+            return None
+        normalized, vector = key
+        numbers = {word for word in normalized.split() if any(c.isdigit() for c in word)}
+        now = time.monotonic()
+
+        with self._lock:
+            store = self._store(model_name)
+            scores = store.vectors @ vector
+            scores[store.created < now - self.ttl] = -1
+            scores[store.scopes != scope] = -1
+            row = int(np.argmax(scores))
+            entry = store.entries[row]
+            if entry is None or scores[row] < self.thresholds[model_name] or entry[1] != numbers:
+                store.misses += 1
+                return None
+            store.hits += 1
+            store.used[row] = now
+            return entry[2]
+
+    def put(self, model_name, prompt, answer, scope=None):
+        key = self._key(model_name, prompt, scope)
+        if key is None or not answer:
+            return
+        normalized, vector = key
+        numbers = {word for word in normalized.split() if any(c.isdigit() for c in word)}
+        now = time.monotonic()
+
+        with self._lock:
+            store = self._store(model_name)
+            row = store.rows.get((scope, normalized))
+            if row is None:
+                # Expired rows first (never used rows are oldest of all), then the least recently used
+                expired = np.flatnonzero(store.created < now - self.ttl)
+                row = int(expired[np.argmin(store.used[expired])]) if len(expired) else int(np.argmin(store.used))
+                if store.entries[row] is not None:
+                    store.rows.pop((store.scopes[row], store.entries[row][0]), None)
+                    store.evictions += 1
+            store.vectors[row] = vector
+            store.entries[row] = (normalized, numbers, answer)
+            store.scopes[row] = scope
+            store.created[row] = store.used[row] = now
+            store.rows[(scope, normalized)] = row
+
+    def record_exact_hit(self):
+        """Counts course questions answered from the course table before any lookup"""
+        with self._lock:
+            self.exact_hits += 1
+
+    def metrics(self):
+        with self._lock:
+            models = {}
+            for model_name, store in self.stores.items():
+                lookups = store.hits + store.misses
+                models[model_name] = {
+                    'hits': store.hits,
+                    'misses': store.misses,
+                    'hit_rate': round(store.hits / lookups, 4) if lookups else 0,
+                    'evictions': store.evictions,
+                    'size': len(store.rows),
+                    'threshold': self.thresholds[model_name]
+                }
+            return {'models': models, 'course_code_hits': self.exact_hits}
+
+
+semantic_cache = SemanticCache()
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+import zlib
+from contextlib import asynccontextmanager, contextmanager
+
+from flask import current_app
+from sqlalchemy import text
+
+from models import db
+
+
+def advisory_key(key):
+    """The two int4 keys of pg_advisory_lock for a (kind, id) key"""
+    kind, item_id = key
+    return zlib.crc32(kind.encode('utf-8')) % 2 ** 31, int(item_id)
+
+
+class SingleFlight:
+    """Lets only one caller at a time generate a given item.
+
+    Keys are (kind, id) tuples such as ('topic_quiz', 12). Callers of the
+    same key queue on a lock held in this process and, on PostgreSQL, on an
+    advisory lock shared by every worker process. Whoever holds the lock
+    looks for the item again before generating it, so callers that waited
+    find the first caller's result instead of generating and overwriting it.
+    """
+
+    def __init__(self, app=None):
+        self.timeout = 600
+        self.waits = 0
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.timeout = app.config['SINGLE_FLIGHT_TIMEOUT']
+        app.extensions['single_flight'] = self
+
+    @contextmanager
+    def hold(self, *keys):
+        """Hold the locks of keys, taken in sorted order so callers of overlapping keys cannot deadlock"""
+        held = self._held()
+        keys = sorted(set(keys) - held)
+        if not keys:
+            # Already held further up the stack, e.g. a batch falling back to single builds
+            yield
+            return
+
+        deadline = time.monotonic() + self.timeout
+        acquired = []
+        connection = None
+        try:
+            for key in keys:
+                self._acquire_local(key, deadline)
+                acquired.append(key)
+            if db.engine.dialect.name == 'postgresql':
+                connection = self._acquire_advisory(keys, deadline)
+            held.update(keys)
+            yield
+        finally:
+            held.difference_update(keys)
+            if connection is not None:
+                self._release_advisory(connection, keys)
+            for key in reversed(acquired):
+                self._release_local(key)
+
+    @asynccontextmanager
+    async def ahold(self, *keys):
+        """hold() for coroutines.
+
+        The locks belong to threads, so a thread of its own takes them, keeps
+        them until the block ends and releases them; the event loop never
+        blocks on a wait. Code in the block must not call hold() for the same
+        keys from another thread.
+        """
+        loop = asyncio.get_running_loop()
+        acquired = loop.create_future()
+        release = threading.Event()
+        app = current_app._get_current_object()
+
+        def settle(error=None):
+            if not acquired.done():
+                if error is None:
+                    acquired.set_result(None)
+                else:
+                    acquired.set_exception(error)
+
+        def holder():
+            try:
+                with app.app_context(), self.hold(*keys):
+                    loop.call_soon_threadsafe(settle)
+                    release.wait()
+            except Exception as e:
+                loop.call_soon_threadsafe(settle, e)
+
+        thread = threading.Thread(target=holder, name='single-flight', daemon=True)
+        thread.start()
+        try:
+            await acquired
+            yield
+        finally:
+            release.set()
+            await asyncio.to_thread(thread.join)
+
+    def _held(self):
+        held = getattr(self._local, 'held', None)
+        if held is None:
+            held = self._local.held = set()
+        return held
+
+    def _acquire_local(self, key, deadline):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        lock = entry[0]
+        if lock.acquire(blocking=False):
+            return
+        self.waits += 1
+        if not lock.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            self._forget(key)
+            raise TimeoutError(f'Timed out waiting for the generation of {key[0]} {key[1]}')
+
+    def _release_local(self, key):
+        self._locks[key][0].release()
+        self._forget(key)
+
+    def _forget(self, key):
+        with self._lock:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def _acquire_advisory(self, keys, deadline):
+        # Session-level locks belong to a connection, so they get one of their
+        # own instead of the request's session, which commits and returns its
+        # connection to the pool while the lock is still needed
+        connection = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        locked = []
+        try:
+            for key in keys:
+                delay = 0.05
+                # pg_try_advisory_lock is polled so the wait can time out
+                while not connection.execute(
+                    text('SELECT pg_try_advisory_lock(:kind, :id)'),
+                    dict(zip(('kind', 'id'), advisory_key(key)))
+                ).scalar():
+                    if time.monotonic() + delay > deadline:
+                        raise TimeoutError(f'Timed out waiting for the generation of {key[0]} {key[1]}')
+                    time.sleep(delay)
+                    delay = min(delay * 2, 1.0)
+                locked.append(key)
+        except Exception:
+            self._release_advisory(connection, locked)
+            raise
+        return connection
+
+    def _release_advisory(self, connection, keys):
+        try:
+            for key in keys:
+                connection.execute(
+                    text('SELECT pg_advisory_unlock(:kind, :id)'),
+                    dict(zip(('kind', 'id'), advisory_key(key)))
+                )
+        except Exception as e:
+            print(f"Error in advisory unlock: {str(e)}")
+            # Never hand a connection that may still hold locks back to the pool
+            connection.invalidate()
+        finally:
+            connection.close()
+
+    def metrics(self):
+        return {'waits': self.waits, 'in_flight': len(self._locks)}
+
+
+single_flight = SingleFlight()